@@ -6,8 +6,11 @@ import logging
 import SimpleITK as sitk
 import sitkUtils
 import math
+import multiprocessing
 import numpy
-import LabelStatistics
+import CryoMonitoringLib
+from CryoMonitoringLib import SlicerBridge
+from CryoMonitoringLib import BackgroundRunner
 
 #
 # ComputeT2Star
@@ -129,6 +132,21 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.referenceROISelector.setToolTip( "Reference ROI for scaling factor and noise estimation" )
     parametersFormLayout.addRow("Reference ROI: ", self.referenceROISelector)
 
+    #
+    # region selector
+    #
+    self.regionSelector = slicer.qMRMLNodeComboBox()
+    self.regionSelector.nodeTypes = ( ("vtkMRMLLabelMapVolumeNode"), ("vtkMRMLAnnotationROINode"), ("vtkMRMLMarkupsROINode"), "" )
+    self.regionSelector.selectNodeUponCreation = False
+    self.regionSelector.addEnabled = False
+    self.regionSelector.removeEnabled = False
+    self.regionSelector.noneEnabled = True
+    self.regionSelector.showHidden = False
+    self.regionSelector.showChildNodeTypes = False
+    self.regionSelector.setMRMLScene( slicer.mrmlScene )
+    self.regionSelector.setToolTip( "Label map or ROI box that limits the computation. The voxels outside are set to 0. If not set, the whole volume is processed." )
+    parametersFormLayout.addRow("Region: ", self.regionSelector)
+
     #
     # outputT2Star volume selector
     #
@@ -209,6 +227,18 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.scaleCalibrationR2sSpinBox.setToolTip("Scale Calibration")
     parametersFormLayout.addRow("Scale Clibration R2* (s^-1): ", self.scaleCalibrationR2sSpinBox)
 
+    #
+    # Calibration store
+    #
+    self.useCalibrationStoreFlagCheckBox = qt.QCheckBox()
+    self.useCalibrationStoreFlagCheckBox.checked = 1
+    self.useCalibrationStoreFlagCheckBox.setToolTip("If checked, the scale factor and noise levels estimated from the reference ROI are stored for the protocol (TE1, TE2, matrix and scanner), and the stored values are used when no reference ROI is selected.")
+    parametersFormLayout.addRow("Use Calibration Store", self.useCalibrationStoreFlagCheckBox)
+
+    self.scannerIDLineEdit = qt.QLineEdit()
+    self.scannerIDLineEdit.setToolTip("Scanner ID of the protocol in the calibration store. If empty, it is read from the DICOM header of echo 1 (manufacturer/model/serial number).")
+    parametersFormLayout.addRow("Scanner ID: ", self.scannerIDLineEdit)
+
     #
     # Echo 1/2 signal lower input threshold
     #
@@ -247,6 +277,14 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.useNoiseCorrectionFlagCheckBox.setToolTip("If checked, correct noise based on the estimated noise level.")
     parametersFormLayout.addRow("Use Noise Correction", self.useNoiseCorrectionFlagCheckBox)
 
+    #
+    # Check box to estimate the noise from the background
+    #
+    self.autoNoiseFlagCheckBox = qt.QCheckBox()
+    self.autoNoiseFlagCheckBox.checked = 0
+    self.autoNoiseFlagCheckBox.setToolTip("If checked and no reference ROI is selected, estimate the noise levels from the background air in the histogram of each echo.")
+    parametersFormLayout.addRow("Automatic Noise Estimation", self.autoNoiseFlagCheckBox)
+
     #
     # Noise Level
     #
@@ -300,6 +338,37 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.lowerOutputThresholdSpinBox.setToolTip("Lower threshold for the output")
     parametersFormLayout.addRow("Lower OutputThreshold (s): ", self.lowerOutputThresholdSpinBox)
 
+    #
+    # Memory budget
+    #
+    self.memoryBudgetSpinBox = qt.QSpinBox()
+    self.memoryBudgetSpinBox.objectName = 'memoryBudgetSpinBox'
+    self.memoryBudgetSpinBox.setMaximum(1000000)
+    self.memoryBudgetSpinBox.setMinimum(0)
+    self.memoryBudgetSpinBox.setValue(0)
+    self.memoryBudgetSpinBox.setToolTip("Maximum memory for the intermediate images. The volume is processed in slabs of slices that fit into the budget (0: whole volume at once).")
+    parametersFormLayout.addRow("Memory Budget (MB): ", self.memoryBudgetSpinBox)
+
+    #
+    # Number of threads
+    #
+    self.threadsSpinBox = qt.QSpinBox()
+    self.threadsSpinBox.objectName = 'threadsSpinBox'
+    self.threadsSpinBox.setMaximum(256)
+    self.threadsSpinBox.setMinimum(1)
+    self.threadsSpinBox.setValue(multiprocessing.cpu_count())
+    self.threadsSpinBox.setToolTip("Number of threads. The volume is split into slabs that are processed in parallel.")
+    parametersFormLayout.addRow("Threads: ", self.threadsSpinBox)
+
+    #
+    # Precision
+    #
+    self.precisionComboBox = qt.QComboBox()
+    self.precisionComboBox.addItem("Float64")
+    self.precisionComboBox.addItem("Float32")
+    self.precisionComboBox.setToolTip("Pixel type of the computation and the output maps. Float32 halves the memory traffic; run 'python -m CryoMonitoringLib.Precision' for its deviation from Float64.")
+    parametersFormLayout.addRow("Precision: ", self.precisionComboBox)
+
     #
     # Apply Button
     #
@@ -308,8 +377,21 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # Cancel Button and status of the background computation
+    #
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Cancel the running computation."
+    self.cancelButton.enabled = False
+    parametersFormLayout.addRow(self.cancelButton)
+
+    self.statusLabel = qt.QLabel("Idle")
+    self.statusLabel.setToolTip("Stage of the computation running in the background")
+    parametersFormLayout.addRow("Status: ", self.statusLabel)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
     self.inputTE1Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputTE2Selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.referenceROISelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -317,15 +399,73 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     self.outputR2StarSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onUseOutputThreshold)
     self.useNoiseCorrectionFlagCheckBox.connect('toggled(bool)', self.onUseNoiseCorrection)
+    self.autoNoiseFlagCheckBox.connect('toggled(bool)', self.onUseNoiseCorrection)
+
+    #
+    # Multi-Echo Area
+    #
+    multiEchoCollapsibleButton = ctk.ctkCollapsibleButton()
+    multiEchoCollapsibleButton.text = "Multi-Echo Fit"
+    multiEchoCollapsibleButton.collapsed = True
+    self.layout.addWidget(multiEchoCollapsibleButton)
+    multiEchoFormLayout = qt.QFormLayout(multiEchoCollapsibleButton)
+
+    #
+    # Check box to use the multi-echo fit
+    #
+    self.useMultiEchoFlagCheckBox = qt.QCheckBox()
+    self.useMultiEchoFlagCheckBox.checked = 0
+    self.useMultiEchoFlagCheckBox.setToolTip("If checked, fit R2* to all the echo volumes below instead of Input Volume 1 and 2. The lower input thresholds of echo 1 and 2 are extrapolated along the signal decay to the later echoes, and the noise level of each echo is estimated from its background air (the noise levels above are used only for a fit to two echoes without automatic estimation). The scaling factor is not applied.")
+    multiEchoFormLayout.addRow("Use Multi-Echo Fit", self.useMultiEchoFlagCheckBox)
+
+    #
+    # echo volumes selector
+    #
+    self.multiEchoSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.multiEchoSelector.nodeTypes = ( ("vtkMRMLScalarVolumeNode"), "" )
+    self.multiEchoSelector.addEnabled = False
+    self.multiEchoSelector.removeEnabled = False
+    self.multiEchoSelector.noneEnabled = False
+    self.multiEchoSelector.showHidden = False
+    self.multiEchoSelector.showChildNodeTypes = False
+    self.multiEchoSelector.setMRMLScene( slicer.mrmlScene )
+    self.multiEchoSelector.setToolTip( "Pick the echo volumes (at least two), in the order of the echo times" )
+    multiEchoFormLayout.addRow("Echo Volumes: ", self.multiEchoSelector)
+
+    #
+    # Echo times
+    #
+    self.multiEchoTEsLineEdit = qt.QLineEdit()
+    self.multiEchoTEsLineEdit.text = "0.00007, 0.002"
+    self.multiEchoTEsLineEdit.setToolTip("Comma-separated TEs of the echo volumes")
+    multiEchoFormLayout.addRow("TEs (s): ", self.multiEchoTEsLineEdit)
+
+    self.useMultiEchoFlagCheckBox.connect('toggled(bool)', self.onSelect)
+    self.multiEchoSelector.connect('checkedNodesChanged()', self.onSelect)
 
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Computations run in the background, one at a time
+    self.runner = BackgroundRunner.BackgroundRunner(self.onProgress)
+
+    # One logic instance for all runs, so that its caches (e.g. the background noise
+    # estimates) persist. The output thresholds and minimum T2* are applied to the maps
+    # of the last run as they are changed, without rerunning the computation
+    self.logic = ComputeT2StarLogic()
+    self.logic.setKeepUnthresholded(True)
+    self.appliedClamp = None
+    self.lowerOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.upperOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onOutputClampChanged)
+    self.MinT2sSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+
     # Refresh Apply button state
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.runner.cancel()
+    CryoMonitoringLib.closeThreadPools()
 
   def onSelect(self):
 
@@ -334,7 +474,8 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     else:
       self.ScaleSpinBox.enabled = True
 
-    if self.useNoiseCorrectionFlagCheckBox.checked and self.referenceROISelector.currentNode() == None:
+    if (self.useNoiseCorrectionFlagCheckBox.checked and self.referenceROISelector.currentNode() == None
+        and not self.autoNoiseFlagCheckBox.checked):
       self.Echo1NoiseSpinBox.enabled = True
       self.Echo2NoiseSpinBox.enabled = True
     else:
@@ -342,6 +483,8 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
       self.Echo2NoiseSpinBox.enabled = False
 
     self.applyButton.enabled = self.inputTE1Selector.currentNode() and self.inputTE1Selector.currentNode() and (self.outputT2StarSelector.currentNode() or self.outputR2StarSelector.currentNode())
+    if self.useMultiEchoFlagCheckBox.checked:
+      self.applyButton.enabled = len(self.multiEchoSelector.checkedNodes()) >= 2 and (self.outputT2StarSelector.currentNode() or self.outputR2StarSelector.currentNode())
 
   def onUseOutputThreshold(self):
     if self.useOutputThresholdFlagCheckBox.checked == True:
@@ -351,8 +494,29 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
       self.lowerOutputThresholdSpinBox.enabled = False;      
       self.upperOutputThresholdSpinBox.enabled = False;
 
+  def outputClamp(self):
+    """
+    Parameters of the final clamp stage: (output threshold, minimum T2*)
+    """
+    outputThreshold = None
+    if self.useOutputThresholdFlagCheckBox.checked == True:
+      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+    return (outputThreshold, self.MinT2sSpinBox.value)
+
+  def onOutputClampChanged(self):
+    """
+    Apply the output threshold and minimum T2* to the maps of the last run without
+    recomputing them; a running computation picks them up when it finishes
+    """
+    clamp = self.outputClamp()
+    if clamp == self.appliedClamp or self.runner.isRunning():
+      return
+    if self.logic.rethreshold(*clamp):
+      self.appliedClamp = clamp
+
   def onUseNoiseCorrection(self):
-    if self.useNoiseCorrectionFlagCheckBox.checked == True and self.referenceROISelector.currentNode() == None:
+    if (self.useNoiseCorrectionFlagCheckBox.checked == True and self.referenceROISelector.currentNode() == None
+        and not self.autoNoiseFlagCheckBox.checked):
       self.Echo1NoiseSpinBox.enabled = True;
       self.Echo2NoiseSpinBox.enabled = True;      
     else:
@@ -361,16 +525,15 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     
 
   def onApplyButton(self):
-    logic = ComputeT2StarLogic()
+    logic = self.logic
+    memoryBudget = None
+    if self.memoryBudgetSpinBox.value > 0:
+      memoryBudget = self.memoryBudgetSpinBox.value * 1024 * 1024
+    logic.setMemoryBudget(memoryBudget)
+    logic.setThreads(self.threadsSpinBox.value)
+    logic.setPrecision(self.precisionComboBox.currentText)
     #enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
     #imageOutputThreshold = self.imageOutputThresholdSliderWidget.value
-    t2name = ''
-    r2name = ''
-    if self.outputT2StarSelector.currentNode():
-      t2name = self.outputT2StarSelector.currentNode().GetName()
-    if self.outputR2StarSelector.currentNode():
-      r2name = self.outputR2StarSelector.currentNode().GetName()
-      
     inputThreshold = [self.Echo1InputThresholdSpinBox.value, self.Echo2InputThresholdSpinBox.value]
     
     minT2s = self.MinT2sSpinBox.value
@@ -378,14 +541,18 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
     outputThreshold = None
     if self.useOutputThresholdFlagCheckBox.checked == True:
       outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+    self.appliedClamp = (outputThreshold, minT2s)
       
-    noiseLevel = None
-    if self.useNoiseCorrectionFlagCheckBox.checked == True:
-      noiseLevel = [self.Echo1NoiseSpinBox.value, self.Echo2NoiseSpinBox.value]
+    if self.useMultiEchoFlagCheckBox.checked:
+      self.runMultiEcho(logic, outputThreshold, minT2s)
+      return
 
     scaleFactor = self.ScaleSpinBox.value
     noiseLevel = None
 
+    useCalibrationStore = self.useCalibrationStoreFlagCheckBox.checked
+    logic.setScannerID(self.scannerIDLineEdit.text)
+
     if self.referenceROISelector.currentNode():
       inputTE1VolumeNode = self.inputTE1Selector.currentNode()
       inputTE2VolumeNode = self.inputTE2Selector.currentNode()
@@ -398,35 +565,88 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
       noiseEcho1 = logic.CalcNoise(imageTE1, None, roiImage)
       noiseEcho2 = logic.CalcNoise(imageTE2, None, roiImage)
       noiseLevel = [noiseEcho1, noiseEcho2]
-      print "noises = [%f, %f]\n" % (noiseEcho1, noiseEcho2)
-
-      logic.CorrectNoise(imageTE1, noiseEcho1)
-      logic.CorrectNoise(imageTE2, noiseEcho2)
+      logging.info('Noise levels: %f, %f' % (noiseEcho1, noiseEcho2))
 
+      ## The scale factor is estimated from the raw echoes, as in ComputeTemp
       scaleFactor = logic.CalcScalingFactor(imageTE1, imageTE2, roiImage, 
                                             self.TE1SpinBox.value, self.TE2SpinBox.value,
                                             self.scaleCalibrationR2sSpinBox.value)
-
-      print "scale = %f\n" % scaleFactor
+      logging.info('Scale factor: %f' % scaleFactor)
 
       self.ScaleSpinBox.value = scaleFactor
       self.Echo1NoiseSpinBox.value = noiseEcho1
       self.Echo2NoiseSpinBox.value = noiseEcho2
+
+      if useCalibrationStore:
+        statistics = CryoMonitoringLib.labelStatistics([sitk.GetArrayViewFromImage(imageTE1),
+                                                        sitk.GetArrayViewFromImage(imageTE2)],
+                                                       sitk.GetArrayViewFromImage(roiImage))
+        logic.saveCalibration(inputTE1VolumeNode, self.TE1SpinBox.value, self.TE2SpinBox.value,
+                              self.scaleCalibrationR2sSpinBox.value, scaleFactor, noiseLevel, "SD",
+                              statistics, statistics)
     else:
+      (storedScaleFactor, storedNoiseLevel) = (None, None)
+      if useCalibrationStore:
+        (storedScaleFactor, storedNoiseLevel) = logic.loadCalibration(self.inputTE1Selector.currentNode(),
+                                                                      self.TE1SpinBox.value, self.TE2SpinBox.value,
+                                                                      self.scaleCalibrationR2sSpinBox.value, "SD")
+      if storedScaleFactor is not None:
+        scaleFactor = storedScaleFactor
+        self.ScaleSpinBox.value = scaleFactor
       if self.useNoiseCorrectionFlagCheckBox.checked:
+        if self.autoNoiseFlagCheckBox.checked:
+          self.Echo1NoiseSpinBox.value = logic.EstimateNoise(self.inputTE1Selector.currentNode())
+          self.Echo2NoiseSpinBox.value = logic.EstimateNoise(self.inputTE2Selector.currentNode())
+        elif storedNoiseLevel is not None:
+          self.Echo1NoiseSpinBox.value = storedNoiseLevel[0]
+          self.Echo2NoiseSpinBox.value = storedNoiseLevel[1]
         noiseLevel = [self.Echo1NoiseSpinBox.value, self.Echo2NoiseSpinBox.value]
     
-    logic.run(self.inputTE1Selector.currentNode(), self.inputTE2Selector.currentNode(),
-              self.outputT2StarSelector.currentNode(), self.outputR2StarSelector.currentNode(),
-              self.TE1SpinBox.value, self.TE2SpinBox.value, scaleFactor,
-              noiseLevel, outputThreshold, inputThreshold, minT2s)
-
-    ### Since PushToSlicer() called in logic.run() will delete the original node, obtain the new node and
-    ### reset the selector.
-    t2Node = slicer.util.getNode(t2name)
-    r2Node = slicer.util.getNode(r2name)
-    self.outputT2StarSelector.setCurrentNode(t2Node)
-    self.outputR2StarSelector.setCurrentNode(r2Node)
+    ### The default (NumPy) engine runs in the background and writes into the selected
+    ### output nodes, so the selectors do not need to be reset after the run.
+    logic.runInBackground(self.runner, self.inputTE1Selector.currentNode(), self.inputTE2Selector.currentNode(),
+                          self.outputT2StarSelector.currentNode(), self.outputR2StarSelector.currentNode(),
+                          self.TE1SpinBox.value, self.TE2SpinBox.value, scaleFactor,
+                          noiseLevel, outputThreshold, inputThreshold, minT2s, self.regionSelector.currentNode(),
+                          onFinished=self.onOutputClampChanged)
+    self.cancelButton.enabled = self.runner.isRunning()
+
+  def onCancelButton(self):
+    self.runner.cancel()
+
+  def onProgress(self, status):
+    self.statusLabel.text = status
+    self.cancelButton.enabled = self.runner.isRunning()
+
+  def runMultiEcho(self, logic, outputThreshold, minT2s):
+    echoVolumeNodes = self.multiEchoSelector.checkedNodes()
+    try:
+      TEs = [float(te) for te in self.multiEchoTEsLineEdit.text.split(',')]
+    except ValueError:
+      slicer.util.errorDisplay('Invalid TEs: %s' % self.multiEchoTEsLineEdit.text)
+      return
+    if len(TEs) != len(echoVolumeNodes):
+      slicer.util.errorDisplay('%d TEs are given for %d echo volumes.' % (len(TEs), len(echoVolumeNodes)))
+      return
+
+    ## Echo 1 and 2 take their own thresholds; the later echoes take the thresholds
+    ## extrapolated along the signal decay
+    inputThreshold = CryoMonitoringLib.echoThresholds(TEs, self.Echo1InputThresholdSpinBox.value,
+                                                      self.Echo2InputThresholdSpinBox.value)
+    ## The noise level is estimated for each echo; the noise levels entered for echo 1
+    ## and 2 are used only for those echoes of a dual-echo fit
+    noiseLevels = None
+    if self.useNoiseCorrectionFlagCheckBox.checked:
+      if len(echoVolumeNodes) == 2 and not self.autoNoiseFlagCheckBox.checked:
+        noiseLevels = [self.Echo1NoiseSpinBox.value, self.Echo2NoiseSpinBox.value]
+      else:
+        noiseLevels = [logic.EstimateNoise(node) for node in echoVolumeNodes]
+
+    logic.runMultiEchoInBackground(self.runner, echoVolumeNodes, TEs, self.outputT2StarSelector.currentNode(),
+                                   self.outputR2StarSelector.currentNode(), noiseLevels, outputThreshold,
+                                   inputThreshold, minT2s, None, self.regionSelector.currentNode(),
+                                   onFinished=self.onOutputClampChanged)
+    self.cancelButton.enabled = self.runner.isRunning()
 
   def onReload(self, moduleName="ComputeT2Star"):
     # Generic reload method for any scripted module.
@@ -441,9 +661,147 @@ class ComputeT2StarWidget(ScriptedLoadableModuleWidget):
 
 class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
 
+  ## Compute engines available for run(). "SimpleITK" chains SimpleITK filters and
+  ## replaces the output nodes through sitkUtils.PushToSlicer(), while "NumPy" computes
+  ## the maps in a single vectorized pass that reads the input voxels in place and
+  ## writes into the image buffers of the existing output nodes.
+  ENGINES = ["SimpleITK", "NumPy"]
+
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
-  
+    self.engine = "NumPy"
+    self.instrumentation = False
+    self.lastRunRecord = None
+    self.region = None
+    self.regionKey = None
+    self.memoryBudget = None
+    self.threads = 1
+    self.precision = "Float64"
+    self.dtype = numpy.float64
+    self.backgroundNoiseCache = {}
+    self.calibrationStore = None
+    self.scannerID = None
+    self.keepUnthresholded = False
+    self.unthresholdedMaps = ((None, None), (None, None))
+
+  def setEngine(self, engine):
+    if engine not in self.ENGINES:
+      raise ValueError("Unknown compute engine '%s'. Choose one of %s." % (engine, self.ENGINES))
+    self.engine = engine
+
+  def setInstrumentation(self, enabled):
+    """
+    If enabled, the wall time and allocated memory of each stage of run() are
+    recorded in self.lastRunRecord (CryoMonitoringLib.RunRecord)
+    """
+    self.instrumentation = enabled
+
+  def setMemoryBudget(self, memoryBudget):
+    """
+    Limit the intermediate buffers of the NumPy engine to memoryBudget bytes by
+    processing the volume in slabs of slices (None: whole volume at once).
+    The results are identical in both cases.
+    """
+    self.memoryBudget = memoryBudget
+
+  def setThreads(self, threads):
+    """
+    Process the volume in slabs on a pool of 'threads' threads (NumPy engine).
+    The results are identical to the single-threaded computation.
+    """
+    self.threads = max(int(threads), 1)
+
+  def setPrecision(self, precision):
+    """
+    Compute and output the maps as "Float64" (default) or "Float32" (half the memory
+    traffic; see CryoMonitoringLib.Precision for the deviation from Float64)
+    """
+    self.dtype = CryoMonitoringLib.precisionType(precision)
+    self.precision = precision
+
+  def setKeepUnthresholded(self, enabled):
+    """
+    Keep the T2* and R2* maps of the last run (NumPy engine) before the final clamp
+    stage, so that rethreshold() can apply new output thresholds and fill values
+    without recomputing the maps. The kept maps take as much memory as the outputs.
+    """
+    self.keepUnthresholded = enabled
+    if not enabled:
+      self.unthresholdedMaps = ((None, None), (None, None))
+
+  def fillValues(self, minT2s):
+    """
+    Fill values (T2*, R2*) of the voxels below the input thresholds
+    """
+    if minT2s > 0:
+      return (minT2s, 1/minT2s)
+    return (minT2s, 0.0)
+
+  def keepMaps(self, maps, mask, region):
+    """
+    CryoMonitoringLib.UnthresholdedMap of each of the (T2*, R2*) maps (None if not computed)
+    """
+    return tuple([None if array is None else CryoMonitoringLib.UnthresholdedMap(array, mask, region)
+                  for array in maps])
+
+  def clampMaps(self, kept, outs, outputThreshold, minT2s, regionFillValue, record):
+    """
+    Final clamp stage of the kept (T2*, R2*) maps into the full-size output arrays
+    """
+    record.startStage('thresholding')
+    for (unthresholded, out, fillValue) in zip(kept, outs, self.fillValues(minT2s)):
+      if unthresholded is not None and out is not None:
+        unthresholded.apply(out, outputThreshold, fillValue, regionFillValue)
+
+  def rethreshold(self, outputThreshold, minT2s, regionFillValue=0.0):
+    """
+    Apply a new output threshold, minimum T2* (the fill value of the voxels below the
+    input thresholds) and region fill value to the output nodes of the last run, from
+    the kept maps (see setKeepUnthresholded()). Only the final clamp stage is run, one
+    vectorized pass per map. Returns False if no maps are kept.
+    """
+    nodes = [(node, unthresholded, fillValue) for ((node, unthresholded), fillValue)
+             in zip(self.unthresholdedMaps, self.fillValues(minT2s)) if unthresholded is not None]
+    if not nodes:
+      return False
+    record = CryoMonitoringLib.createRunRecord('ComputeT2Star (rethreshold)', self.instrumentation)
+    for (node, unthresholded, fillValue) in nodes:
+      out = SlicerBridge.arrayFromVolume(node)
+      if not unthresholded.matches(out):
+        continue
+      record.startStage('thresholding')
+      unthresholded.apply(out, outputThreshold, fillValue, regionFillValue)
+      record.startStage('push')
+      SlicerBridge.arrayFromVolumeModified(node)
+    self.finishRunRecord(record)
+    return True
+
+  def getRegion(self, regionNode, referenceVolumeNode):
+    """
+    Return the CryoMonitoringLib.Region of a label map or ROI node on the voxel grid of
+    the reference volume (None if no region node is given). The region is reused until
+    the region node or the geometry of the reference volume changes.
+    """
+    if not regionNode:
+      return None
+    rasToIJK = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetRASToIJKMatrix(rasToIJK)
+    geometry = (referenceVolumeNode.GetImageData().GetDimensions(),
+                tuple([rasToIJK.GetElement(i, j) for i in range(4) for j in range(4)]))
+    if regionNode.IsA('vtkMRMLVolumeNode'):
+      regionTime = SlicerBridge.volumeModifiedTime(regionNode)
+    else:
+      regionTime = regionNode.GetMTime()
+    key = (regionNode.GetID(), regionTime, geometry)
+    if self.region == None or self.regionKey != key:
+      shape = geometry[0][::-1]
+      if regionNode.IsA('vtkMRMLVolumeNode'):
+        self.region = CryoMonitoringLib.Region(shape, labelArray=SlicerBridge.arrayFromVolume(regionNode))
+      else:
+        self.region = CryoMonitoringLib.Region(shape, boundingBox=SlicerBridge.boundingBoxFromROINode(regionNode, referenceVolumeNode))
+      self.regionKey = key
+    return self.region
+
   def isValidInputOutputData(self, inputTE1VolumeNode, inputTE2VolumeNode):
     """Validates if the output is not the same as input
     """
@@ -458,52 +816,125 @@ class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
   
   def CalcNoise(self, image1, image2, roiImage):
 
-    LabelStatistics = sitk.LabelStatisticsImageFilter()
-      
+    array1 = sitk.GetArrayViewFromImage(image1)
+    roiArray = sitk.GetArrayViewFromImage(roiImage)
+
     if image2:
-      #Aimage1 = sitk.Cast(sitkUtils.PullFromSlicer(image1Node.GetID()), sitk.sitkFloat32)
-      #Aimage2 = sitk.Cast(sitkUtils.PullFromSlicer(image2Node.GetID()), sitk.sitkFloat32)
-      #roiImage = sitk.Cast(sitkUtils.PullFromSlicer(roiImageNode.GetID()), sitk.sitkInt8)
-      subImage = sitk.Subtract(image1, image2)
-      absImage = sitk.Abs(subImage)
-            
-      LabelStatistics.Execute(absImage, roiImage)
-      meanAbsDiff = LabelStatistics.GetMean(1)
-      return (meanAbsDiff/math.sqrt(math.pi/2.0))
+      absArray = numpy.abs(array1 - sitk.GetArrayViewFromImage(image2))
+      return CryoMonitoringLib.calcNoise(absArray, None, roiArray, "Mean")
 
     else:
-      LabelStatistics.Execute(image1, roiImage)
-      SD = LabelStatistics.GetSigma(1)
-      return SD
+      return CryoMonitoringLib.calcNoise(array1, None, roiArray, "SD")
 
-  def CorrectNoise(self, image, noiseLevel):
+  def EstimateNoise(self, imageNode, method="SD"):
+    """
+    Noise level of the image from the histogram of its background air, without an ROI
+    (see CryoMonitoringLib.estimateBackgroundNoise()). The estimate is cached per volume
+    node, i.e. per series: later frames received by the same node reuse the estimate of
+    the first one until resetNoiseEstimates() is called.
+    """
+    key = (imageNode.GetID(), method)
+    if key not in self.backgroundNoiseCache:
+      self.backgroundNoiseCache[key] = CryoMonitoringLib.estimateBackgroundNoise(SlicerBridge.arrayFromVolume(imageNode),
+                                                                                method)
+    return self.backgroundNoiseCache[key]
 
+  def resetNoiseEstimates(self):
+    """
+    Discard the cached noise estimates; the next frame starts a new series
+    """
+    self.backgroundNoiseCache = {}
+
+  def setCalibrationStore(self, calibrationStore):
+    """
+    Keep the calibrations in the given CryoMonitoringLib.CalibrationStore instead of the
+    store shared by the modules (SlicerBridge.sharedCalibrationStore())
+    """
+    self.calibrationStore = calibrationStore
+
+  def getCalibrationStore(self):
+    if self.calibrationStore is None:
+      self.calibrationStore = SlicerBridge.sharedCalibrationStore()
+    return self.calibrationStore
+
+  def setScannerID(self, scannerID):
+    """
+    Scanner ID of the protocols in the calibration store; None or '' reads it from the
+    DICOM header of the echo images (see SlicerBridge.scannerID())
+    """
+    self.scannerID = scannerID
+
+  def getProtocol(self, echo1VolumeNode, TE1, TE2):
+    """
+    Protocol of the echo images in the calibration store (CryoMonitoringLib.makeProtocol())
+    """
+    scannerID = self.scannerID or SlicerBridge.scannerID(echo1VolumeNode)
+    return CryoMonitoringLib.makeProtocol(TE1, TE2, echo1VolumeNode.GetImageData().GetDimensions(), scannerID)
+
+  def loadCalibration(self, echo1VolumeNode, TE1, TE2, scaleCalibrationR2s, noiseMethod="SD"):
+    """
+    (scale factor, noise levels) stored for the protocol of the echo images, each None
+    if it is not in the calibration store. A store that cannot be read is ignored.
+    """
+    try:
+      store = self.getCalibrationStore()
+      protocol = self.getProtocol(echo1VolumeNode, TE1, TE2)
+      return (store.scaleFactor(protocol, scaleCalibrationR2s), store.noiseLevel(protocol, noiseMethod))
+    except (IOError, OSError, ValueError, KeyError) as e:
+      logging.warning('Cannot read the calibration store: %s' % str(e))
+      return (None, None)
+
+  def saveCalibration(self, echo1VolumeNode, TE1, TE2, scaleCalibrationR2s, scaleFactor=None, noiseLevel=None, noiseMethod="SD", scaleStatistics=None, noiseStatistics=None):
+    """
+    Store the scale factor and/or the noise levels estimated for the protocol of the echo
+    images, with the ROI statistics of both echoes they were estimated from
+    """
+    try:
+      store = self.getCalibrationStore()
+      protocol = self.getProtocol(echo1VolumeNode, TE1, TE2)
+      if scaleFactor is not None:
+        store.storeScaleFactor(protocol, scaleFactor, scaleCalibrationR2s, scaleStatistics)
+      if noiseLevel is not None:
+        store.storeNoiseLevel(protocol, noiseLevel, noiseMethod, noiseStatistics)
+    except (IOError, OSError, ValueError) as e:
+      logging.warning('Cannot update the calibration store: %s' % str(e))
+
+  def CorrectNoise(self, image, noiseLevel):
+    """
+    Noise-corrected image, sqrt(max(S^2 - noiseLevel^2, 0))
+    """
     squareImage = sitk.Pow(image, 2)
     subImage = sitk.Subtract(squareImage, noiseLevel*noiseLevel)
     subImagePositive1 = sitk.Threshold(subImage,0.0, float('Inf'), 0.0)
-    image = sitk.Sqrt(subImagePositive1)
-
-
-  def CalcScalingFactor(self, image1, image2, roiImage, TE1, TE2, scaleCalibrationR2s):
+    return sitk.Sqrt(subImagePositive1)
 
-    #image1 = sitk.Cast(sitkUtils.PullFromSlicer(image1Node.GetID()), sitk.sitkFloat32)
-    #image2 = sitk.Cast(sitkUtils.PullFromSlicer(image2Node.GetID()), sitk.sitkFloat32)
-    #roiImage = sitk.Cast(sitkUtils.PullFromSlicer(ROINode.GetID()), sitk.sitkInt8)
+  def FillOutsideRegion(self, image, region, fillValue):
+    """
+    SimpleITK image with the voxels outside the region (CryoMonitoringLib.Region) set
+    to fillValue
+    """
+    if region is None:
+      return image
+    array = sitk.GetArrayFromImage(image)
+    region.fillOutside(array, fillValue)
+    result = sitk.GetImageFromArray(array)
+    result.CopyInformation(image)
+    return result
 
-    LabelStatistics = sitk.LabelStatisticsImageFilter()
-    LabelStatistics.Execute(image1, roiImage)
-    echo1 = LabelStatistics.GetMean(1)
-    LabelStatistics.Execute(image2, roiImage)
-    echo2 = LabelStatistics.GetMean(1)
 
-    scale = echo1 / (echo2 * numpy.exp(scaleCalibrationR2s*(TE2-TE1)))
+  def CalcScalingFactor(self, image1, image2, roiImage, TE1, TE2, scaleCalibrationR2s):
 
-    return (scale)
+    return CryoMonitoringLib.calcScalingFactor(sitk.GetArrayViewFromImage(image1),
+                                               sitk.GetArrayViewFromImage(image2),
+                                               sitk.GetArrayViewFromImage(roiImage),
+                                               TE1, TE2, scaleCalibrationR2s)
 
 
-  def run(self, inputTE1VolumeNode, inputTE2VolumeNode, outputT2StarVolumeNode, outputR2StarVolumeNode, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s):
+  def run(self, inputTE1VolumeNode, inputTE2VolumeNode, outputT2StarVolumeNode, outputR2StarVolumeNode, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0):
     """
-    Run the actual algorithm
+    Run the actual algorithm. If a region node (label map or ROI) is given, the maps are
+    only computed within the region (NumPy engine) and the voxels outside are set to
+    regionFillValue.
     """
 
     echo1NoiseLevel = 0.0
@@ -516,31 +947,38 @@ class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
       return False
 
     logging.info('Processing started')
-
-    imageTE1 = sitk.Cast(sitkUtils.PullFromSlicer(inputTE1VolumeNode.GetID()), sitk.sitkFloat64)
-    imageTE2 = sitk.Cast(sitkUtils.PullFromSlicer(inputTE2VolumeNode.GetID()), sitk.sitkFloat64)
+    record = CryoMonitoringLib.createRunRecord('ComputeT2Star', self.instrumentation)
+    self.unthresholdedMaps = ((None, None), (None, None))
+
+    region = self.getRegion(regionNode, inputTE1VolumeNode)
+    if self.engine == "NumPy":
+      self.runNumPy(inputTE1VolumeNode, inputTE2VolumeNode, outputT2StarVolumeNode, outputR2StarVolumeNode,
+                    TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, record,
+                    region, regionFillValue)
+      self.finishRunRecord(record)
+      logging.info('Processing completed')
+      return True
+
+    record.startStage('pull')
+    pixelType = sitk.sitkFloat32 if self.precision == "Float32" else sitk.sitkFloat64
+    imageTE1 = sitk.Cast(sitkUtils.PullFromSlicer(inputTE1VolumeNode.GetID()), pixelType)
+    imageTE2 = sitk.Cast(sitkUtils.PullFromSlicer(inputTE2VolumeNode.GetID()), pixelType)
 
     # Noise correction
     # Echo 1
+    record.startStage('noise correction')
     if noiseLevel != None:
       echo1NoiseLevel = noiseLevel[0]
       echo2NoiseLevel = noiseLevel[1]
-
-      squareImage1 = sitk.Pow(imageTE1, 2)
-      subImage1 = sitk.Subtract(squareImage1, echo1NoiseLevel*echo1NoiseLevel)
-      subImagePositive1 = sitk.Threshold(subImage1,0.0, float('Inf'), 0.0)
-      imageTE1 = sitk.Sqrt(subImagePositive1)
-
-      squareImage2 = sitk.Pow(imageTE2, 2)
-      subImage2 = sitk.Subtract(squareImage2, echo2NoiseLevel*echo2NoiseLevel)
-      subImagePositive2 = sitk.Threshold(subImage2,0.0, float('Inf'), 0.0)
-      imageTE2 = sitk.Sqrt(subImagePositive2)
+      imageTE1 = self.CorrectNoise(imageTE1, echo1NoiseLevel)
+      imageTE2 = self.CorrectNoise(imageTE2, echo2NoiseLevel)
     else:
       # Simply remove negative values (not needed?)
       imageTE1 = sitk.Threshold(imageTE1,0.0, float('Inf'), 0.0)
       imageTE2 = sitk.Threshold(imageTE2,0.0, float('Inf'), 0.0)
 
     ## Apply scaling factor to the second echo
+    record.startStage('scaling')
     imageTE2 = sitk.Multiply(imageTE2, scaleFactor)
 
     ## Create mask to exclude invalid pixels
@@ -548,6 +986,7 @@ class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
     #   1. First or second echo signal is less than the input threshold
     #   2. Second echo signal is greater than the first
     
+    record.startStage('masking')
     mask = None
     imaskFillT2s = None
     imaskFillR2s = None
@@ -560,7 +999,7 @@ class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
       #mask = sitk.And(mask, mask3)
 
       imask = sitk.Not(mask)
-      imaskFloat = sitk.Cast(imask, sitk.sitkFloat64)
+      imaskFloat = sitk.Cast(imask, pixelType)
       imaskFillT2s = imaskFloat * minT2s
       imaskFillR2s = 0.0
 
@@ -573,32 +1012,337 @@ class ComputeT2StarLogic(ScriptedLoadableModuleLogic):
 
 
     if outputT2StarVolumeNode:
+      record.startStage('log-ratio')
       imageT2Star = sitk.Divide(TE1-TE2, sitk.Log(sitk.Divide(imageTE2, imageTE1)))
+      record.startStage('thresholding')
       if inputThreshold != None:
         imageT2Star = sitk.Mask(imageT2Star, mask)
         imageT2Star = sitk.Add(imageT2Star, imaskFillT2s)
       if outputThreshold != None:
-        imageT2StarThreshold = sitk.Threshold(imageT2Star, lowerOutputThreshold, upperOutputThreshold, 0.0)
-        sitkUtils.PushToSlicer(imageT2StarThreshold, outputT2StarVolumeNode.GetName(), 0, True)
-      else:
-        sitkUtils.PushToSlicer(imageT2Star, outputT2StarVolumeNode.GetName(), 0, True)
+        imageT2Star = sitk.Threshold(imageT2Star, lowerOutputThreshold, upperOutputThreshold, 0.0)
+      imageT2Star = self.FillOutsideRegion(imageT2Star, region, regionFillValue)
+      record.startStage('push')
+      sitkUtils.PushToSlicer(imageT2Star, outputT2StarVolumeNode.GetName(), 0, True)
 
     if outputR2StarVolumeNode:
+      record.startStage('log-ratio')
       imageR2Star = sitk.Divide(sitk.Log(sitk.Divide(imageTE2, imageTE1)), TE1-TE2)
+      record.startStage('thresholding')
       if inputThreshold != None:
         imageR2Star = sitk.Mask(imageR2Star, mask)
         imageR2Star = sitk.Add(imageR2Star, imaskFillR2s)
       if outputThreshold != None:
-        imageR2StarThreshold = sitk.Threshold(imageR2Star, lowerOutputThreshold, upperOutputThreshold, 0.0)
-        sitkUtils.PushToSlicer(imageR2StarThreshold, outputR2StarVolumeNode.GetName(), 0, True)
+        imageR2Star = sitk.Threshold(imageR2Star, lowerOutputThreshold, upperOutputThreshold, 0.0)
+      imageR2Star = self.FillOutsideRegion(imageR2Star, region, regionFillValue)
+      record.startStage('push')
+      sitkUtils.PushToSlicer(imageR2Star, outputR2StarVolumeNode.GetName(), 0, True)
+
+    self.finishRunRecord(record)
+    logging.info('Processing completed')
+
+    return True
+
+
+  def finishRunRecord(self, record):
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+      logging.info('Run record: %s' % record.toDict())
+
+
+  def runInBackground(self, runner, inputTE1VolumeNode, inputTE2VolumeNode, outputT2StarVolumeNode, outputR2StarVolumeNode, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0, onFinished=None):
+    """
+    Same as run() with the NumPy engine, but the maps are computed in a worker thread of
+    the runner (CryoMonitoringLib.BackgroundRunner) and pushed to the output nodes on the
+    main thread when done; onFinished() is called after that. The input images are
+    copied when the task is submitted, so later updates do not affect the running task.
+    """
+    if not self.isValidInputOutputData(inputTE1VolumeNode, inputTE2VolumeNode):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return False
+
+    record = CryoMonitoringLib.createRunRecord('ComputeT2Star', self.instrumentation)
+    record.startStage('pull')
+    region = self.getRegion(regionNode, inputTE1VolumeNode)
+    arrayTE1 = SlicerBridge.arrayFromVolume(inputTE1VolumeNode).copy()
+    arrayTE2 = SlicerBridge.arrayFromVolume(inputTE2VolumeNode).copy()
+    computeT2Star = outputT2StarVolumeNode is not None
+    computeR2Star = outputR2StarVolumeNode is not None
+    dtype = self.dtype
+    keepUnthresholded = self.keepUnthresholded
+
+    def compute(progress):
+      outT2Star = numpy.empty(arrayTE1.shape, dtype=dtype) if computeT2Star else None
+      outR2Star = numpy.empty(arrayTE1.shape, dtype=dtype) if computeR2Star else None
+      kept = (None, None)
+      if keepUnthresholded:
+        kept = self.computeUnthresholdedMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold,
+                                             minT2s, computeT2Star, computeR2Star, progress, region)
+        self.clampMaps(kept, (outT2Star, outR2Star), outputThreshold, minT2s, regionFillValue, progress)
+      elif region is None:
+        self.computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold,
+                         minT2s, computeT2Star, computeR2Star, outT2Star, outR2Star, progress)
       else:
-        sitkUtils.PushToSlicer(imageR2Star, outputR2StarVolumeNode.GetName(), 0, True)
+        self.computeMaps(region.crop(arrayTE1), region.crop(arrayTE2), TE1, TE2, scaleFactor, noiseLevel,
+                         outputThreshold, inputThreshold, minT2s, computeT2Star, computeR2Star,
+                         None if outT2Star is None else region.crop(outT2Star),
+                         None if outR2Star is None else region.crop(outR2Star), progress)
+        progress.startStage('thresholding')
+        for out in (outT2Star, outR2Star):
+          if out is not None:
+            region.fillOutside(out, regionFillValue)
+      return (outT2Star, outR2Star, kept)
+
+    def finish(result):
+      (outT2Star, outR2Star, kept) = result
+      self.unthresholdedMaps = ((outputT2StarVolumeNode, kept[0]), (outputR2StarVolumeNode, kept[1]))
+      record.startStage('push')
+      if outputT2StarVolumeNode:
+        SlicerBridge.updateVolumeFromArray(outputT2StarVolumeNode, outT2Star, inputTE1VolumeNode)
+      if outputR2StarVolumeNode:
+        SlicerBridge.updateVolumeFromArray(outputR2StarVolumeNode, outR2Star, inputTE1VolumeNode)
+      self.finishRunRecord(record)
+      logging.info('Processing completed')
+      if onFinished:
+        onFinished()
+
+    logging.info('Processing started')
+    runner.submit(compute, finish, record)
+    return True
 
+
+  def runNumPy(self, inputTE1VolumeNode, inputTE2VolumeNode, outputT2StarVolumeNode, outputR2StarVolumeNode, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, record=None, region=None, regionFillValue=0.0):
+    """
+    Compute the maps with the NumPy engine directly from/into the voxel buffers of the nodes
+    """
+    if record is None:
+      record = CryoMonitoringLib.NULL_RUN_RECORD
+    record.startStage('pull')
+    arrayTE1 = SlicerBridge.arrayFromVolume(inputTE1VolumeNode)
+    arrayTE2 = SlicerBridge.arrayFromVolume(inputTE2VolumeNode)
+
+    outT2Star = None
+    outR2Star = None
+    if outputT2StarVolumeNode:
+      outT2Star = SlicerBridge.allocateVolumeArray(outputT2StarVolumeNode, arrayTE1.shape,
+                                                   self.dtype, inputTE1VolumeNode)
+    if outputR2StarVolumeNode:
+      outR2Star = SlicerBridge.allocateVolumeArray(outputR2StarVolumeNode, arrayTE1.shape,
+                                                   self.dtype, inputTE1VolumeNode)
+
+    if self.keepUnthresholded:
+      kept = self.computeUnthresholdedMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold,
+                                           minT2s, outT2Star is not None, outR2Star is not None, record, region)
+      self.clampMaps(kept, (outT2Star, outR2Star), outputThreshold, minT2s, regionFillValue, record)
+      self.unthresholdedMaps = ((outputT2StarVolumeNode, kept[0]), (outputR2StarVolumeNode, kept[1]))
+    elif region is None:
+      self.computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold,
+                       minT2s, outT2Star is not None, outR2Star is not None, outT2Star, outR2Star, record)
+    else:
+      ## Compute within the bounding box of the region only
+      self.computeMaps(region.crop(arrayTE1), region.crop(arrayTE2), TE1, TE2, scaleFactor, noiseLevel,
+                       outputThreshold, inputThreshold, minT2s, outT2Star is not None, outR2Star is not None,
+                       None if outT2Star is None else region.crop(outT2Star),
+                       None if outR2Star is None else region.crop(outR2Star), record)
+      record.startStage('thresholding')
+      for out in (outT2Star, outR2Star):
+        if out is not None:
+          region.fillOutside(out, regionFillValue)
+
+    record.startStage('push')
+    if outputT2StarVolumeNode:
+      SlicerBridge.arrayFromVolumeModified(outputT2StarVolumeNode)
+    if outputR2StarVolumeNode:
+      SlicerBridge.arrayFromVolumeModified(outputR2StarVolumeNode)
+    record.endStage()
+
+
+  def computeR2Star(self, inputTE1VolumeNode, inputTE2VolumeNode, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, record=None, region=None):
+    """
+    Compute the R2* map from the echo volumes and return it as an array, without
+    writing it to the scene (e.g. as the input of the temperature computation).
+    If a region is given, the array only covers its bounding box.
+    """
+    if record is None:
+      record = CryoMonitoringLib.NULL_RUN_RECORD
+    record.startStage('pull')
+    arrayTE1 = SlicerBridge.arrayFromVolume(inputTE1VolumeNode)
+    arrayTE2 = SlicerBridge.arrayFromVolume(inputTE2VolumeNode)
+    if region is not None:
+      arrayTE1 = region.crop(arrayTE1)
+      arrayTE2 = region.crop(arrayTE2)
+    (arrayT2Star, arrayR2Star) = self.computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel,
+                                                  outputThreshold, inputThreshold, minT2s, False, True,
+                                                  record=record)
+    return arrayR2Star
+
+
+  def computeMaps(self, arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, computeT2Star=True, computeR2Star=True, outT2Star=None, outR2Star=None, record=None, outMask=None):
+    """
+    CryoMonitoringLib.computeMaps() in the selected precision, processed in slabs if a
+    memory budget or more than one thread is set
+    """
+    if self.memoryBudget or self.threads > 1:
+      return CryoMonitoringLib.computeMapsChunked(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel,
+                                                  outputThreshold, inputThreshold, minT2s, self.memoryBudget,
+                                                  computeT2Star, computeR2Star, outT2Star, outR2Star, record,
+                                                  self.threads, self.dtype, outMask)
+    return CryoMonitoringLib.computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold,
+                                         inputThreshold, minT2s, computeT2Star, computeR2Star, outT2Star, outR2Star,
+                                         record, self.dtype, outMask)
+
+
+  def computeUnthresholdedMaps(self, arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, computeT2Star, computeR2Star, record, region=None):
+    """
+    Compute the (T2*, R2*) maps without the final clamp stage, within the bounding box
+    of the region; returns a CryoMonitoringLib.UnthresholdedMap per map (None if not requested)
+    """
+    if region is not None:
+      arrayTE1 = region.crop(arrayTE1)
+      arrayTE2 = region.crop(arrayTE2)
+    mask = numpy.empty(arrayTE1.shape, dtype=numpy.bool_)
+    maps = self.computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, None, inputThreshold, minT2s,
+                            computeT2Star, computeR2Star, record=record, outMask=mask)
+    return self.keepMaps(maps, mask, region)
+
+
+  def runMultiEcho(self, inputVolumeNodes, TEs, outputT2StarVolumeNode, outputR2StarVolumeNode, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors=None, regionNode=None, regionFillValue=0.0):
+    """
+    Compute the maps from N >= 2 echo volumes by a weighted log-linear fit
+    (see CryoMonitoringLib.computeMapsMultiEcho()). noiseLevels, inputThreshold and
+    scaleFactors have one entry per echo volume (or are None). The region is handled
+    as in run().
+    """
+    if len(inputVolumeNodes) < 2 or None in inputVolumeNodes:
+      slicer.util.errorDisplay('At least two echo volumes are required for the multi-echo fit.')
+      return False
+
+    logging.info('Processing started')
+    record = CryoMonitoringLib.createRunRecord('ComputeT2Star (multi-echo)', self.instrumentation)
+    self.unthresholdedMaps = ((None, None), (None, None))
+
+    region = self.getRegion(regionNode, inputVolumeNodes[0])
+    record.startStage('pull')
+    arrays = [SlicerBridge.arrayFromVolume(node) for node in inputVolumeNodes]
+    shape = arrays[0].shape
+    outT2Star = None
+    outR2Star = None
+    if outputT2StarVolumeNode:
+      outT2Star = SlicerBridge.allocateVolumeArray(outputT2StarVolumeNode, shape, self.dtype, inputVolumeNodes[0])
+    if outputR2StarVolumeNode:
+      outR2Star = SlicerBridge.allocateVolumeArray(outputR2StarVolumeNode, shape, self.dtype, inputVolumeNodes[0])
+
+    kept = self.computeMapsMultiEchoInto(arrays, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s,
+                                         scaleFactors, outT2Star, outR2Star, record, region, regionFillValue)
+    self.unthresholdedMaps = ((outputT2StarVolumeNode, kept[0]), (outputR2StarVolumeNode, kept[1]))
+
+    record.startStage('push')
+    if outputT2StarVolumeNode:
+      SlicerBridge.arrayFromVolumeModified(outputT2StarVolumeNode)
+    if outputR2StarVolumeNode:
+      SlicerBridge.arrayFromVolumeModified(outputR2StarVolumeNode)
+
+    self.finishRunRecord(record)
     logging.info('Processing completed')
 
     return True
 
 
+  def runMultiEchoInBackground(self, runner, inputVolumeNodes, TEs, outputT2StarVolumeNode, outputR2StarVolumeNode, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors=None, regionNode=None, regionFillValue=0.0, onFinished=None):
+    """
+    Same as runMultiEcho(), but the maps are computed in a worker thread of the runner
+    as in runInBackground()
+    """
+    if len(inputVolumeNodes) < 2 or None in inputVolumeNodes:
+      slicer.util.errorDisplay('At least two echo volumes are required for the multi-echo fit.')
+      return False
+
+    record = CryoMonitoringLib.createRunRecord('ComputeT2Star (multi-echo)', self.instrumentation)
+    record.startStage('pull')
+    region = self.getRegion(regionNode, inputVolumeNodes[0])
+    arrays = [SlicerBridge.arrayFromVolume(node).copy() for node in inputVolumeNodes]
+    computeT2Star = outputT2StarVolumeNode is not None
+    computeR2Star = outputR2StarVolumeNode is not None
+    dtype = self.dtype
+
+    def compute(progress):
+      outT2Star = numpy.empty(arrays[0].shape, dtype=dtype) if computeT2Star else None
+      outR2Star = numpy.empty(arrays[0].shape, dtype=dtype) if computeR2Star else None
+      kept = self.computeMapsMultiEchoInto(arrays, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s,
+                                           scaleFactors, outT2Star, outR2Star, progress, region, regionFillValue)
+      return (outT2Star, outR2Star, kept)
+
+    def finish(result):
+      (outT2Star, outR2Star, kept) = result
+      self.unthresholdedMaps = ((outputT2StarVolumeNode, kept[0]), (outputR2StarVolumeNode, kept[1]))
+      record.startStage('push')
+      if outputT2StarVolumeNode:
+        SlicerBridge.updateVolumeFromArray(outputT2StarVolumeNode, outT2Star, inputVolumeNodes[0])
+      if outputR2StarVolumeNode:
+        SlicerBridge.updateVolumeFromArray(outputR2StarVolumeNode, outR2Star, inputVolumeNodes[0])
+      self.finishRunRecord(record)
+      logging.info('Processing completed')
+      if onFinished:
+        onFinished()
+
+    logging.info('Processing started')
+    runner.submit(compute, finish, record)
+    return True
+
+
+  def computeMapsMultiEchoInto(self, arrays, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors, outT2Star, outR2Star, record, region=None, regionFillValue=0.0):
+    """
+    Multi-echo maps written into the full-size arrays outT2Star and outR2Star (either may
+    be None), with the region handled as in run(). Returns the unthresholded maps, which
+    are kept only if setKeepUnthresholded() is on ((None, None) otherwise).
+    """
+    computeT2Star = outT2Star is not None
+    computeR2Star = outR2Star is not None
+    if self.keepUnthresholded:
+      if region is not None:
+        arrays = [region.crop(array) for array in arrays]
+      mask = numpy.empty(arrays[0].shape, dtype=numpy.bool_)
+      maps = CryoMonitoringLib.computeMapsMultiEcho(arrays, TEs, noiseLevels, None, inputThreshold, minT2s,
+                                                    scaleFactors, computeT2Star, computeR2Star,
+                                                    record=record, dtype=self.dtype, outMask=mask)
+      kept = self.keepMaps(maps, mask, region)
+      self.clampMaps(kept, (outT2Star, outR2Star), outputThreshold, minT2s, regionFillValue, record)
+      return kept
+    if region is None:
+      CryoMonitoringLib.computeMapsMultiEcho(arrays, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s,
+                                             scaleFactors, computeT2Star, computeR2Star,
+                                             outT2Star, outR2Star, record, self.dtype)
+    else:
+      CryoMonitoringLib.computeMapsMultiEcho([region.crop(array) for array in arrays], TEs, noiseLevels,
+                                             outputThreshold, inputThreshold, minT2s, scaleFactors,
+                                             computeT2Star, computeR2Star,
+                                             None if outT2Star is None else region.crop(outT2Star),
+                                             None if outR2Star is None else region.crop(outR2Star), record,
+                                             self.dtype)
+      record.startStage('thresholding')
+      for out in (outT2Star, outR2Star):
+        if out is not None:
+          region.fillOutside(out, regionFillValue)
+    return (None, None)
+
+
+  def computeR2StarMultiEcho(self, inputVolumeNodes, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors=None, record=None, region=None):
+    """
+    Same as computeR2Star() for N >= 2 echo volumes
+    """
+    if record is None:
+      record = CryoMonitoringLib.NULL_RUN_RECORD
+    record.startStage('pull')
+    arrays = [SlicerBridge.arrayFromVolume(node) for node in inputVolumeNodes]
+    if region is not None:
+      arrays = [region.crop(array) for array in arrays]
+    (arrayT2Star, arrayR2Star) = CryoMonitoringLib.computeMapsMultiEcho(arrays, TEs, noiseLevels, outputThreshold,
+                                                                        inputThreshold, minT2s, scaleFactors,
+                                                                        False, True, record=record,
+                                                                        dtype=self.dtype)
+    return arrayR2Star
+
+
 class ComputeT2StarTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -629,7 +1373,12 @@ class ComputeT2StarTest(ScriptedLoadableModuleTest):
     your test should break so they know that the feature is needed.
     """
 
-    pass
+    ## Logic-level tests of the computation library on synthetic phantoms
+    from CryoMonitoringLib import Testing
+    self.delayDisplay("Starting the test")
+    result = Testing.run()
+    self.assertTrue(result.wasSuccessful())
+    self.delayDisplay('Test passed!')
 
     #self.delayDisplay("Starting the test")
     ##
@@ -0,0 +1,139 @@
+#
+# Background execution of the computations of the module widgets (requires Slicer;
+# not imported by the CryoMonitoringLib package itself).
+#
+
+import threading
+import traceback
+import logging
+import qt
+
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['TaskCancelled', 'BackgroundTask', 'BackgroundRunner']
+
+
+class TaskCancelled(Exception):
+  pass
+
+
+class BackgroundTask(object):
+  """
+  One computation, compute(task), running in a worker thread. The task is passed to
+  the computation in place of a RunRecord: the pipeline reports each stage through
+  startStage(), which is also where a cancelled task stops (by raising TaskCancelled).
+  The computation must not access the MRML scene; its result is passed to
+  finishCallback(result) on the main thread. The stages are forwarded to record
+  (a RunRecord), if given.
+  """
+
+  def __init__(self, compute, finishCallback, record=None):
+    self.compute = compute
+    self.finishCallback = finishCallback
+    self.record = record if record is not None else NULL_RUN_RECORD
+    self.stage = None
+    self.cancelled = False
+    self.done = False
+    self.result = None
+    self.error = None
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+
+  def run(self):
+    try:
+      self.result = self.compute(self)
+    except TaskCancelled:
+      pass
+    except Exception:
+      self.error = traceback.format_exc()
+    self.done = True
+
+  def cancel(self):
+    self.cancelled = True
+
+  def startStage(self, stage):
+    if self.cancelled:
+      raise TaskCancelled()
+    self.stage = stage
+    self.record.startStage(stage)
+
+  def endStage(self):
+    self.record.endStage()
+
+  def finish(self):
+    self.record.finish()
+
+
+class BackgroundRunner(object):
+  """
+  Run the computations of a widget in a worker thread, one at a time, so that the
+  Slicer GUI stays responsive. A new task supersedes the running one, which is
+  cancelled at its next stage and whose result is discarded. A timer on the main
+  thread reports the current stage to progressCallback(status) and calls the finish
+  callback of the task (e.g. to push the result to the scene) when it is done.
+  """
+
+  POLL_INTERVAL = 50  # ms
+
+  def __init__(self, progressCallback=None):
+    self.progressCallback = progressCallback
+    self.currentTask = None
+    self.tasks = []
+    self.lastStatus = None
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL)
+    self.timer.connect('timeout()', self.poll)
+
+  def isRunning(self):
+    return self.currentTask is not None
+
+  def submit(self, compute, finishCallback, record=None):
+    """
+    Start compute(task) in a worker thread (see BackgroundTask), cancelling the running task
+    """
+    if self.currentTask:
+      self.currentTask.cancel()
+    task = BackgroundTask(compute, finishCallback, record)
+    self.currentTask = task
+    self.tasks.append(task)
+    task.thread.start()
+    self.timer.start()
+    return task
+
+  def cancel(self):
+    if self.currentTask:
+      self.currentTask.cancel()
+      self.currentTask = None
+      self.reportStatus('Cancelled')
+
+  def reportStatus(self, status):
+    if status == self.lastStatus:
+      return
+    self.lastStatus = status
+    if self.progressCallback:
+      self.progressCallback(status)
+
+  def poll(self):
+    for task in list(self.tasks):
+      if not task.done:
+        continue
+      self.tasks.remove(task)
+      if task is not self.currentTask:
+        continue
+      self.currentTask = None
+      if task.error:
+        logging.error('Background computation failed:\n%s' % task.error)
+        self.reportStatus('Failed')
+      elif not task.cancelled:
+        try:
+          task.finishCallback(task.result)
+        except Exception:
+          logging.error('Pushing the result of the background computation failed:\n%s' % traceback.format_exc())
+          self.reportStatus('Failed')
+          continue
+        self.reportStatus('Done')
+
+    if self.currentTask and self.currentTask.stage:
+      self.reportStatus('Running: %s' % self.currentTask.stage)
+    if len(self.tasks) == 0:
+      self.timer.stop()
@@ -0,0 +1,255 @@
+#
+# Batch processing of a whole session of dual-echo images.
+#
+# Computes the R2* and temperature maps (as ComputeTempLogic.run()) for every frame
+# in a process pool and writes them to disk. Run with:
+#
+#   python -m CryoMonitoringLib.Batch --help
+#
+
+import os
+import sys
+import csv
+import time
+import logging
+import argparse
+import multiprocessing
+
+from .T2Star import calcScalingFactor, computeMaps
+from .Noise import calcNoise, estimateBackgroundNoise
+from .Temperature import computeTemp
+from .Chunking import computeMapsChunked, computeTempFromEchoesChunked
+from .VolumeIO import readVolume, writeVolume, openVolume
+
+__all__ = ['loadImageList', 'findFrames', 'loadROI', 'processFrame', 'processFrames', 'main']
+
+## Parameters of the frames processed by a worker process (see processFrames())
+_workerParams = None
+
+
+def loadImageList(path):
+  """
+  Read the frame IDs from the first column of an image list (CSV). Empty lines and
+  lines starting with '#' are skipped.
+  """
+  frames = []
+  with open(path) as f:
+    for row in csv.reader(f):
+      if len(row) == 0 or row[0].strip() == '' or row[0].startswith('#'):
+        continue
+      frames.append(row[0].strip())
+  return frames
+
+
+def findFrames(dataDir, echo1Prefix, echo2Prefix, extension='.nrrd'):
+  """
+  Frame IDs of all echo pairs '<echo1Prefix><ID><extension>' / '<echo2Prefix><ID><extension>'
+  in the directory
+  """
+  frames = []
+  for name in sorted(os.listdir(dataDir)):
+    if name.startswith(echo1Prefix) and name.endswith(extension):
+      frameID = name[len(echo1Prefix):len(name)-len(extension)]
+      if os.path.exists(os.path.join(dataDir, echo2Prefix + frameID + extension)):
+        frames.append(frameID)
+  return frames
+
+
+def _sizeText(shape):
+  return 'x'.join([str(n) for n in shape[::-1]])
+
+
+def loadROI(path, shape):
+  """
+  Read a label map (ROI) for echo images of the given shape (k, j, i); raises
+  ValueError if its size differs from that of the echo images
+  """
+  roi = readVolume(path)[0]
+  if roi.shape != tuple(shape):
+    raise ValueError("The label map '%s' (%s) does not match the size of the echo images (%s)."
+                     % (path, _sizeText(roi.shape), _sizeText(shape)))
+  return roi
+
+
+def processFrame(frameID, params):
+  """
+  Compute the maps of one frame and write them to the output directory.
+  Returns (frameID, processing time in s).
+  """
+  startTime = time.time()
+  dataDir = params['dataDir']
+  extension = params['extension']
+
+  ## Uncompressed NRRD echoes are memory-mapped, so only the voxels that are used are read
+  read = openVolume if params['mapVolumes'] else readVolume
+  (echo1, geometry) = read(os.path.join(dataDir, params['echo1Prefix'] + frameID + extension))
+  echo2 = read(os.path.join(dataDir, params['echo2Prefix'] + frameID + extension))[0]
+  for (name, array) in (('echo 2', echo2), ('scale ROI', params['scaleROI']), ('noise ROI', params['noiseROI'])):
+    if array is not None and array.shape != echo1.shape:
+      raise ValueError("The %s (%s) does not match the size of echo 1 (%s) in frame %s."
+                       % (name, _sizeText(array.shape), _sizeText(echo1.shape), frameID))
+
+  ## Scale factor
+  scaleFactor = params['scaleFactor']
+  if params['scaleROI'] is not None:
+    scaleFactor = calcScalingFactor(echo1, echo2, params['scaleROI'], params['TE1'], params['TE2'],
+                                    params['scaleCalibrationR2s'])
+
+  ## Noise level
+  noiseLevel = params['noiseLevel']
+  if params['noiseROI'] is not None:
+    noiseLevel = [calcNoise(echo1, None, params['noiseROI'], params['noiseMethod']),
+                  calcNoise(echo2, None, params['noiseROI'], params['noiseMethod'])]
+
+  memoryBudget = params['memoryBudget']
+  if memoryBudget is not None and not params['writeR2Star']:
+    ## Streamed through slabs from the echoes to the temperature map
+    arrayTemp = computeTempFromEchoesChunked(echo1, echo2, params['TE1'], params['TE2'], scaleFactor, noiseLevel,
+                                             params['inputThreshold'], params['minT2s'], params['paramA'],
+                                             params['paramB'], params['outputThreshold'], memoryBudget * 1024 * 1024)
+    writeVolume(os.path.join(params['outputDir'], params['tempPrefix'] + frameID + extension),
+                arrayTemp, geometry)
+    return (frameID, time.time() - startTime)
+
+  if memoryBudget is not None:
+    arrayR2Star = computeMapsChunked(echo1, echo2, params['TE1'], params['TE2'], scaleFactor, noiseLevel, None,
+                                     params['inputThreshold'], params['minT2s'], memoryBudget * 1024 * 1024,
+                                     False, True)[1]
+  else:
+    arrayR2Star = computeMaps(echo1, echo2, params['TE1'], params['TE2'], scaleFactor, noiseLevel,
+                              None, params['inputThreshold'], params['minT2s'], False, True)[1]
+  if params['writeR2Star']:
+    writeVolume(os.path.join(params['outputDir'], params['r2StarPrefix'] + frameID + extension),
+                arrayR2Star, geometry)
+
+  arrayTemp = computeTemp(arrayR2Star, params['paramA'], params['paramB'], params['outputThreshold'],
+                          arrayR2Star if not params['writeR2Star'] else None)
+  writeVolume(os.path.join(params['outputDir'], params['tempPrefix'] + frameID + extension),
+              arrayTemp, geometry)
+
+  return (frameID, time.time() - startTime)
+
+
+def _initWorker(params):
+  global _workerParams
+  _workerParams = params
+
+
+def _processFrameInWorker(frameID):
+  return processFrame(frameID, _workerParams)
+
+
+def processFrames(frames, params, processes=None):
+  """
+  Process the frames in a pool of 'processes' worker processes (default: number of cores).
+  The parameters (with the ROI arrays) are passed to each worker once, not per frame.
+  Returns a list of (frameID, processing time).
+  """
+  if processes == None:
+    processes = multiprocessing.cpu_count()
+  processes = max(1, min(processes, len(frames)))
+
+  results = []
+  if processes == 1:
+    for frameID in frames:
+      results.append(processFrame(frameID, params))
+      logging.info('Frame %s processed (%.3f s)' % results[-1])
+    return results
+
+  pool = multiprocessing.Pool(processes, _initWorker, (params,))
+  try:
+    for result in pool.imap_unordered(_processFrameInWorker, frames):
+      results.append(result)
+      logging.info('Frame %s processed (%.3f s)' % result)
+  finally:
+    pool.close()
+    pool.join()
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compute R2* and temperature maps for all frames of a session.')
+  parser.add_argument('dataDir', help='directory with the echo images (e.g. PETRA-NRRD)')
+  parser.add_argument('outputDir', help='directory for the output maps')
+  parser.add_argument('--image-list', dest='imageList', default=None,
+                      help='CSV file with the frame IDs in the first column (default: all echo pairs in dataDir)')
+  parser.add_argument('--echo1-prefix', dest='echo1Prefix', default='echo1-')
+  parser.add_argument('--echo2-prefix', dest='echo2Prefix', default='echo2-')
+  parser.add_argument('--extension', default='.nrrd')
+  parser.add_argument('--temp-prefix', dest='tempPrefix', default='temp-')
+  parser.add_argument('--r2star-prefix', dest='r2StarPrefix', default='r2s-')
+  parser.add_argument('--write-r2star', dest='writeR2Star', action='store_true', help='also write the R2* maps')
+  parser.add_argument('--te1', dest='TE1', type=float, default=0.00007, help='TE for echo 1 (s)')
+  parser.add_argument('--te2', dest='TE2', type=float, default=0.002, help='TE for echo 2 (s)')
+  parser.add_argument('--scale-factor', dest='scaleFactor', type=float, default=0.7899,
+                      help='scale factor for the second echo')
+  parser.add_argument('--scale-roi', dest='scaleROI', default=None,
+                      help='label map to estimate the scale factor for each frame')
+  parser.add_argument('--scale-calibration-r2s', dest='scaleCalibrationR2s', type=float, default=129.565,
+                      help='R2* in the scale calibration ROI (s^-1)')
+  parser.add_argument('--noise', dest='noiseLevel', type=float, nargs=2, default=None,
+                      help='noise levels of echo 1 and 2 for noise correction')
+  parser.add_argument('--noise-roi', dest='noiseROI', default=None,
+                      help='label map to estimate the noise levels for each frame')
+  parser.add_argument('--noise-method', dest='noiseMethod', choices=['Mean', 'SD'], default='Mean')
+  parser.add_argument('--noise-auto', dest='noiseAuto', action='store_true',
+                      help='estimate the noise levels from the background histogram of the first frame')
+  parser.add_argument('--input-threshold', dest='inputThreshold', type=float, nargs=2, default=[0.0, 0.0],
+                      help='lower input thresholds for echo 1 and 2')
+  parser.add_argument('--min-t2s', dest='minT2s', type=float, default=0.00125, help='minimum T2* for output (s)')
+  parser.add_argument('--param-a', dest='paramA', type=float, default=-0.089465444, help='Temp = A * R2* + B')
+  parser.add_argument('--param-b', dest='paramB', type=float, default=31.06195482, help='Temp = A * R2* + B')
+  parser.add_argument('--output-threshold', dest='outputThreshold', type=float, nargs=2, default=None,
+                      help='lower and upper output thresholds for the temperature map')
+  parser.add_argument('-j', '--processes', type=int, default=None,
+                      help='number of worker processes (default: number of cores)')
+  parser.add_argument('--memory-budget', dest='memoryBudget', type=float, default=None,
+                      help='stream each frame through slabs with at most this many MB of intermediates')
+  parser.add_argument('--no-mmap', dest='mapVolumes', action='store_false',
+                      help='read the echo images fully instead of memory-mapping uncompressed NRRD files')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  if args.imageList:
+    frames = loadImageList(args.imageList)
+  else:
+    frames = findFrames(args.dataDir, args.echo1Prefix, args.echo2Prefix, args.extension)
+  if len(frames) == 0:
+    logging.error('No frames found.')
+    return 1
+
+  if not os.path.isdir(args.outputDir):
+    os.makedirs(args.outputDir)
+
+  params = dict(vars(args))
+  del params['imageList']
+  del params['processes']
+  del params['noiseAuto']
+  read = openVolume if args.mapVolumes else readVolume
+  firstEchoes = [read(os.path.join(args.dataDir, prefix + frames[0] + args.extension))[0]
+                 for prefix in (args.echo1Prefix, args.echo2Prefix)]
+
+  ## The ROIs are read once and checked against the first frame before any work starts
+  try:
+    for key in ('scaleROI', 'noiseROI'):
+      if params[key] is not None:
+        params[key] = loadROI(params[key], firstEchoes[0].shape)
+  except ValueError as e:
+    logging.error(str(e))
+    return 1
+
+  ## The noise level of the series is estimated once, from the first frame
+  if args.noiseAuto and params['noiseROI'] is None:
+    params['noiseLevel'] = [estimateBackgroundNoise(echo, args.noiseMethod) for echo in firstEchoes]
+    logging.info('Noise levels: %f, %f' % tuple(params['noiseLevel']))
+  del firstEchoes
+
+  startTime = time.time()
+  results = processFrames(frames, params, args.processes)
+  logging.info('%d frames processed in %.1f s' % (len(results), time.time() - startTime))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,250 @@
+#
+# Benchmark of the processing stages on synthetic dual-echo phantoms.
+#
+# Times noise estimation, scale estimation, R2* computation, baseline preparation,
+# temperature conversion (absolute and relative to a baseline) and the output push
+# for each volume size, and records the peak memory allocated in each stage. Run with:
+#
+#   python -m CryoMonitoringLib.Benchmark --sizes 256x256x256 512x512x200 --output results.json
+#
+# Inside Slicer, the output push writes into a scalar volume node through SlicerBridge;
+# otherwise it is a copy into a preallocated array.
+#
+# With --threads N, the slab-parallel pipeline is also timed with 1 to N threads and
+# the speedup over a single thread is reported.
+#
+
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import multiprocessing
+
+import numpy
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+from .T2Star import calcScalingFactor, computeMaps
+from .Noise import calcNoise
+from .Temperature import computeTemp, PreparedBaseline, computeTempFromBaseline
+from .Phantom import makeDualEchoPhantom
+from .Chunking import computeMapsChunked, computeTempFromEchoesChunked, computeTempFromBaselineChunked
+
+__all__ = ['parseSize', 'timeStage', 'runBenchmark', 'runScalingBenchmark', 'machineInfo', 'main']
+
+TE1 = 0.00007
+TE2 = 0.002
+PARAM_A = -0.089465444
+PARAM_B = 31.06195482
+SCALE_CALIBRATION_R2S = 129.565
+MIN_T2S = 0.00125
+
+
+def parseSize(text):
+  """
+  '512x512x200' (i x j x k) -> (k, j, i) array shape
+  """
+  (ni, nj, nk) = [int(n) for n in text.lower().split('x')]
+  return (nk, nj, ni)
+
+
+def timeStage(function, repeat):
+  """
+  Run the function 'repeat' times. Returns (list of wall times in s, peak memory
+  allocated during a run in bytes or None if it cannot be traced, last result).
+  Tracing slows down allocation, so the peak memory is measured in one extra run
+  that is not timed.
+  """
+  peak = None
+  if tracemalloc:
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  times = []
+  result = None
+  for n in range(repeat):
+    # The result of the previous run is released before the next run
+    result = None
+    startTime = time.time()
+    result = function()
+    times.append(time.time() - startTime)
+  return (times, peak, result)
+
+
+def pushFunction(shape):
+  """
+  Function that pushes an output array to Slicer (or copies it into a preallocated array)
+  """
+  try:
+    import slicer
+    from . import SlicerBridge
+  except ImportError:
+    output = numpy.empty(shape, dtype=numpy.float64)
+    def push(array):
+      output[...] = array
+    return ('copy', push)
+
+  volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'BenchmarkOutput')
+  def push(array):
+    SlicerBridge.updateVolumeFromArray(volumeNode, array)
+  return ('SlicerBridge', push)
+
+
+def runBenchmark(shape, repeat=3):
+  """
+  Benchmark all stages for one volume size. Returns a list of result dictionaries.
+  """
+  logging.info('Generating phantom %s' % (shape,))
+  phantom = makeDualEchoPhantom(shape, TE1, TE2, paramA=PARAM_A, paramB=PARAM_B,
+                                scaleCalibrationR2s=SCALE_CALIBRATION_R2S)
+  echo1 = phantom['echo1']
+  echo2 = phantom['echo2']
+  noiseROI = phantom['noiseROI']
+  scaleROI = phantom['scaleROI']
+  baseline = phantom['r2Star']
+  noiseLevel = [calcNoise(echo1, None, noiseROI), calcNoise(echo2, None, noiseROI)]
+  scaleFactor = calcScalingFactor(echo1, echo2, scaleROI, TE1, TE2, SCALE_CALIBRATION_R2S)
+  (pushMethod, push) = pushFunction(shape)
+
+  stages = [
+    ('noise estimation', lambda: [calcNoise(echo1, None, noiseROI), calcNoise(echo2, None, noiseROI)]),
+    ('scale estimation', lambda: calcScalingFactor(echo1, echo2, scaleROI, TE1, TE2, SCALE_CALIBRATION_R2S)),
+    ('R2* computation', lambda: computeMaps(echo1, echo2, TE1, TE2, scaleFactor, noiseLevel, None,
+                                            [0.0, 0.0], MIN_T2S, False, True)[1]),
+    ]
+
+  results = []
+  arrays = {}
+  for (name, function) in stages:
+    (times, peak, arrays[name]) = timeStage(function, repeat)
+    results.append(stageResult(shape, name, times, peak))
+
+  r2Star = arrays['R2* computation']
+  (times, peak, preparedBaseline) = timeStage(lambda: PreparedBaseline(baseline, PARAM_A, PARAM_B, [0.0, 800.0]), repeat)
+  results.append(stageResult(shape, 'baseline preparation', times, peak))
+
+  moreStages = [
+    ('temperature conversion', lambda: computeTemp(r2Star, PARAM_A, PARAM_B, None)),
+    ('relative temperature conversion', lambda: computeTempFromBaseline(preparedBaseline, r2Star, None)),
+    ('output push (%s)' % pushMethod, lambda: push(r2Star)),
+    ]
+  for (name, function) in moreStages:
+    (times, peak, result) = timeStage(function, repeat)
+    results.append(stageResult(shape, name, times, peak))
+
+  return results
+
+
+def runScalingBenchmark(shape, maxThreads, repeat=3):
+  """
+  Time the slab-parallel pipeline with 1 to maxThreads threads for one volume size.
+  Returns a list of result dictionaries with the speedup over one thread.
+  """
+  logging.info('Generating phantom %s' % (shape,))
+  phantom = makeDualEchoPhantom(shape, TE1, TE2, paramA=PARAM_A, paramB=PARAM_B,
+                                scaleCalibrationR2s=SCALE_CALIBRATION_R2S)
+  echo1 = phantom['echo1']
+  echo2 = phantom['echo2']
+  noiseLevel = [calcNoise(echo1, None, phantom['noiseROI']), calcNoise(echo2, None, phantom['noiseROI'])]
+  scaleFactor = calcScalingFactor(echo1, echo2, phantom['scaleROI'], TE1, TE2, SCALE_CALIBRATION_R2S)
+  preparedBaseline = PreparedBaseline(phantom['r2Star'], PARAM_A, PARAM_B, [0.0, 800.0])
+  out = numpy.empty(shape, dtype=numpy.float64)
+  r2Star = numpy.empty(shape, dtype=numpy.float64)
+  computeMapsChunked(echo1, echo2, TE1, TE2, scaleFactor, noiseLevel, None, [0.0, 0.0], MIN_T2S, None,
+                     False, True, None, r2Star)
+
+  stages = [
+    ('R2* computation', lambda threads: computeMapsChunked(echo1, echo2, TE1, TE2, scaleFactor, noiseLevel, None,
+                                                          [0.0, 0.0], MIN_T2S, None, False, True, None, out,
+                                                          threads=threads)),
+    ('temperature from echoes', lambda threads: computeTempFromEchoesChunked(echo1, echo2, TE1, TE2, scaleFactor,
+                                                                            noiseLevel, [0.0, 0.0], MIN_T2S,
+                                                                            PARAM_A, PARAM_B, None, None, out,
+                                                                            threads=threads)),
+    ('relative temperature conversion', lambda threads: computeTempFromBaselineChunked(preparedBaseline, r2Star,
+                                                                                      None, -40.0, None, out,
+                                                                                      threads=threads)),
+    ]
+
+  results = []
+  for (name, function) in stages:
+    singleThread = None
+    for threads in range(1, maxThreads + 1):
+      times = timeStage(lambda: function(threads), repeat)[0]
+      if threads == 1:
+        singleThread = min(times)
+      speedup = singleThread / min(times)
+      result = stageResult(shape, '%s (%d threads, x%.2f)' % (name, threads, speedup), times, None)
+      result['stage'] = name
+      result['threads'] = threads
+      result['speedup'] = speedup
+      results.append(result)
+
+  return results
+
+
+def stageResult(shape, stage, times, peak):
+  logging.info('%-40s min %8.3f s  median %8.3f s  peak %s' % (stage, min(times), numpy.median(times),
+                                                            'n/a' if peak == None else '%.1f MB' % (peak / 1.0e6)))
+  return {
+    'size': [shape[2], shape[1], shape[0]],
+    'stage': stage,
+    'times': times,
+    'min': min(times),
+    'median': float(numpy.median(times)),
+    'peakMemoryBytes': peak,
+    }
+
+
+def machineInfo():
+  return {
+    'platform': platform.platform(),
+    'processor': platform.processor(),
+    'cpuCount': multiprocessing.cpu_count(),
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the processing stages on synthetic dual-echo phantoms.')
+  parser.add_argument('--sizes', nargs='+', default=['256x256x256', '512x512x200'],
+                      help='volume sizes (i x j x k)')
+  parser.add_argument('--repeat', type=int, default=3, help='number of runs per stage')
+  parser.add_argument('--threads', type=int, default=0,
+                      help='also report the speedup of the slab-parallel pipeline for 1 to THREADS threads')
+  parser.add_argument('--output', default=None, help='JSON file for the results (default: standard output)')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  report = {
+    'machine': machineInfo(),
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'repeat': args.repeat,
+    'results': [],
+    }
+  for size in args.sizes:
+    report['results'] += runBenchmark(parseSize(size), args.repeat)
+  if args.threads > 0:
+    report['scaling'] = []
+    for size in args.sizes:
+      report['scaling'] += runScalingBenchmark(parseSize(size), args.threads, args.repeat)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    sys.stdout.write(json.dumps(report, indent=2) + '\n')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,249 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from .Kernels import allocateFlags, divideITK, finalizeMap
+from .T2Star import correctNoise
+from .Temperature import computeTemp
+from .Chunking import forEachSlab
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['contentKey', 'IntermediateCache', 'computeR2StarCached', 'computeTempFromEchoesCached']
+
+## The stages of the cached pipeline are processed in slabs of this many bytes per
+## voxel (scratch flags only; the stage outputs are full-size cache entries)
+CACHED_BYTES_PER_VOXEL = 2
+
+
+def contentKey(array):
+  """
+  Key of the content of an array: its shape, type and the SHA-1 digest of its voxels.
+  Arrays with the same key hold the same data, wherever they come from.
+  """
+  digest = hashlib.sha1()
+  if array.flags.c_contiguous:
+    digest.update(array.data)
+  else:
+    ## e.g. the bounding box of a region; hashed slice by slice to avoid a full copy
+    for k in range(array.shape[0]):
+      digest.update(numpy.ascontiguousarray(array[k]).data)
+  return (array.shape, array.dtype.str, digest.hexdigest())
+
+
+def _nbytes(value):
+  if isinstance(value, tuple):
+    return sum([_nbytes(item) for item in value])
+  return value.nbytes
+
+
+def _freeze(value):
+  if isinstance(value, tuple):
+    for item in value:
+      _freeze(item)
+  else:
+    value.flags.writeable = False
+  return value
+
+
+class IntermediateCache(object):
+  """
+  In-memory cache of intermediate arrays (or tuples of arrays) with a byte budget and
+  least-recently-used eviction. The keys are built from the content keys of the inputs
+  (see contentKey()) and the parameters the intermediate depends on, so an entry never
+  needs to be invalidated: changed data or parameters simply make a new key. Cached
+  arrays are read-only. The cache can be shared between threads.
+  """
+
+  def __init__(self, byteBudget):
+    self.byteBudget = int(byteBudget)
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    with self.lock:
+      return len(self.entries)
+
+  def __contains__(self, key):
+    with self.lock:
+      return key in self.entries
+
+  def setByteBudget(self, byteBudget):
+    with self.lock:
+      self.byteBudget = int(byteBudget)
+      self.evict()
+
+  def get(self, key):
+    """
+    Cached value of the key (which becomes the most recently used), or None
+    """
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    """
+    Cache the value (made read-only) and evict the least recently used entries beyond
+    the budget. A value larger than the whole budget is not cached. Returns the value.
+    """
+    _freeze(value)
+    size = _nbytes(value)
+    with self.lock:
+      if key in self.entries:
+        self.nbytes -= _nbytes(self.entries.pop(key))
+      if size > self.byteBudget:
+        return value
+      self.entries[key] = value
+      self.nbytes += size
+      self.evict()
+    return value
+
+  def evict(self):
+    ## Called with the lock held
+    while self.nbytes > self.byteBudget and self.entries:
+      self.nbytes -= _nbytes(self.entries.popitem(last=False)[1])
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def statistics(self):
+    with self.lock:
+      return {'entries': len(self.entries), 'bytes': self.nbytes, 'byteBudget': self.byteBudget,
+              'hits': self.hits, 'misses': self.misses}
+
+
+def _cached(cache, key, compute):
+  value = cache.get(key)
+  if value is None:
+    value = cache.put(key, compute())
+  return value
+
+
+def computeR2StarCached(cache, arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, out=None, record=None, threads=1, dtype=numpy.float64):
+  """
+  R2* map as computeMaps(), with the intermediates kept in an IntermediateCache. Each
+  stage is keyed by the content of the echo arrays and the parameters it depends on:
+
+    noise-corrected echoes  <- echo, noise level
+    scaled echo 2           <- noise-corrected echo 2, scale factor
+    log-ratio               <- noise-corrected echo 1, scaled echo 2
+    validity mask           <- noise-corrected echo 1, scaled echo 2, input thresholds
+    R2* map                 <- log-ratio, mask, TE1, TE2, minT2s, output threshold
+
+  so that a changed parameter only recomputes the stages downstream of it, and a rerun
+  with unchanged inputs only hashes the echoes. The stages that are not cached are
+  processed in slabs on 'threads' threads. The result is bit-identical to computeMaps()
+  and is written into out, if given (otherwise the returned array is read-only).
+  """
+  if record is None:
+    record = NULL_RUN_RECORD
+  shape = arrayTE1.shape
+  dtypeName = numpy.dtype(dtype).str
+
+  record.startStage('cache lookup')
+  (noise1, noise2) = (None, None)
+  if noiseLevel != None:
+    (noise1, noise2) = (float(noiseLevel[0]), float(noiseLevel[1]))
+  echo1Key = ('noise-corrected echo', contentKey(arrayTE1), noise1, dtypeName)
+  echo2Key = ('noise-corrected echo', contentKey(arrayTE2), noise2, dtypeName)
+  scaledKey = ('scaled echo', echo2Key, float(scaleFactor))
+  logRatioKey = ('log-ratio', echo1Key, scaledKey)
+  maskKey = None
+  if inputThreshold != None:
+    maskKey = ('mask', echo1Key, scaledKey, tuple([float(t) for t in inputThreshold]))
+  if outputThreshold != None:
+    outputThreshold = tuple([float(t) for t in outputThreshold])
+  r2StarKey = ('R2*', logRatioKey, maskKey, float(TE1), float(TE2), float(minT2s), outputThreshold)
+
+  def eachSlab(function):
+    forEachSlab(function, shape, CACHED_BYTES_PER_VOXEL, None, threads)
+
+  def noiseCorrected(array, noise):
+    record.startStage('noise correction')
+    echo = numpy.empty(shape, dtype=dtype)
+    eachSlab(lambda slab: correctNoise(array[slab], noise, echo[slab]))
+    return echo
+
+  def echo1():
+    return _cached(cache, echo1Key, lambda: noiseCorrected(arrayTE1, noise1))
+
+  def scaledEcho2():
+    def compute():
+      echo2 = _cached(cache, echo2Key, lambda: noiseCorrected(arrayTE2, noise2))
+      record.startStage('scaling')
+      scaled = numpy.empty(shape, dtype=dtype)
+      eachSlab(lambda slab: numpy.multiply(echo2[slab], float(scaleFactor), out=scaled[slab]))
+      return scaled
+    return _cached(cache, scaledKey, compute)
+
+  def logRatio():
+    def compute():
+      (numerator, denominator) = (scaledEcho2(), echo1())
+      record.startStage('log-ratio')
+      ratio = numpy.empty(shape, dtype=dtype)
+
+      def computeSlab(slab):
+        divideITK(numerator[slab], denominator[slab], ratio[slab])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+          numpy.log(ratio[slab], out=ratio[slab])
+      eachSlab(computeSlab)
+      return ratio
+    return _cached(cache, logRatioKey, compute)
+
+  def mask():
+    if maskKey is None:
+      return None
+
+    def compute():
+      (arrayEcho1, arrayEcho2) = (echo1(), scaledEcho2())
+      record.startStage('masking')
+      valid = numpy.empty(shape, dtype=numpy.bool_)
+
+      def computeSlab(slab):
+        numpy.greater_equal(arrayEcho1[slab], inputThreshold[0], out=valid[slab])
+        valid[slab] &= numpy.greater_equal(arrayEcho2[slab], inputThreshold[1])
+      eachSlab(computeSlab)
+      return valid
+    return _cached(cache, maskKey, compute)
+
+  def r2Star():
+    (ratio, valid) = (logRatio(), mask())
+    record.startStage('log-ratio')
+    arrayR2Star = numpy.empty(shape, dtype=dtype)
+    fillR2Star = 0.0
+    if minT2s > 0:
+      fillR2Star = 1/minT2s
+
+    eachSlab(lambda slab: numpy.divide(ratio[slab], TE1-TE2, out=arrayR2Star[slab]))
+    record.startStage('thresholding')
+    eachSlab(lambda slab: finalizeMap(arrayR2Star[slab], None if valid is None else valid[slab], fillR2Star,
+                                      outputThreshold, allocateFlags(arrayR2Star[slab].shape)))
+    return arrayR2Star
+
+  arrayR2Star = _cached(cache, r2StarKey, r2Star)
+  record.endStage()
+  if out is not None:
+    out[...] = arrayR2Star
+    return out
+  return arrayR2Star
+
+
+def computeTempFromEchoesCached(cache, arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, out=None, record=None, threads=1, calibrationTable=None, dtype=numpy.float64):
+  """
+  Same as computeTempFromEchoes(), with the R2* map and its intermediates taken from
+  the cache (see computeR2StarCached()); only the calibration is always recomputed
+  """
+  arrayR2Star = computeR2StarCached(cache, arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, None,
+                                    inputThreshold, minT2s, None, record, threads, dtype)
+  return computeTemp(arrayR2Star, paramA, paramB, outputThreshold, out, record, calibrationTable, dtype)
@@ -0,0 +1,107 @@
+import csv
+import json
+
+import numpy
+
+__all__ = ['CalibrationTable', 'loadCalibrationTable']
+
+
+class CalibrationTable(object):
+  """
+  Nonlinear R2* -> temperature calibration curve, evaluated through a dense lookup
+  table with linear interpolation between the entries. The curve is sampled once, at
+  'size' equidistant R2* values over r2StarRange; R2* values outside the range take
+  the temperature at the nearest end. Evaluating the table costs a few passes over
+  the voxels, and the result only depends on the R2* value of the voxel.
+  """
+
+  DEFAULT_SIZE = 4096
+
+  def __init__(self, curve, r2StarRange, size=DEFAULT_SIZE):
+    self.r2StarMin = float(r2StarRange[0])
+    self.r2StarMax = float(r2StarRange[1])
+    if not self.r2StarMax > self.r2StarMin or size < 2:
+      raise ValueError("Invalid calibration table range %s or size %d." % (r2StarRange, size))
+    self.size = int(size)
+    self.table = numpy.asarray(curve(numpy.linspace(self.r2StarMin, self.r2StarMax, self.size)),
+                               dtype=numpy.float64)
+    self.slopes = numpy.zeros(self.size, dtype=numpy.float64)
+    self.slopes[:-1] = numpy.diff(self.table)
+    self.scale = (self.size - 1) / (self.r2StarMax - self.r2StarMin)
+    self.typedTables = {numpy.dtype(numpy.float64): (self.table, self.slopes)}
+
+  def tables(self, dtype):
+    """
+    (table, slopes) in the given type; converted once per type
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype not in self.typedTables:
+      self.typedTables[dtype] = (self.table.astype(dtype), self.slopes.astype(dtype))
+    return self.typedTables[dtype]
+
+  @classmethod
+  def fromPoints(cls, r2Stars, temperatures, size=DEFAULT_SIZE):
+    """
+    Piecewise linear curve through the (R2*, temperature) points
+    """
+    order = numpy.argsort(r2Stars)
+    r2Stars = numpy.asarray(r2Stars, dtype=numpy.float64)[order]
+    temperatures = numpy.asarray(temperatures, dtype=numpy.float64)[order]
+    return cls(lambda x: numpy.interp(x, r2Stars, temperatures), (r2Stars[0], r2Stars[-1]), size)
+
+  @classmethod
+  def fromPolynomial(cls, coefficients, r2StarRange, size=DEFAULT_SIZE):
+    """
+    Polynomial curve (coefficients from the highest degree down, as numpy.polyval())
+    """
+    return cls(lambda x: numpy.polyval(coefficients, x), r2StarRange, size)
+
+  def evaluate(self, arrayR2Star, out=None):
+    """
+    Temperature map of the R2* map; out may be arrayR2Star itself. NaN stays NaN. The
+    map is interpolated in the type of out (Float64 by default).
+    """
+    if out is None:
+      out = numpy.empty(arrayR2Star.shape, dtype=numpy.float64)
+    (table, slopes) = self.tables(out.dtype)
+    position = numpy.multiply(arrayR2Star, self.scale, dtype=out.dtype)
+    if self.r2StarMin != 0.0:
+      numpy.subtract(position, self.r2StarMin * self.scale, out=position)
+    numpy.clip(position, 0.0, self.size - 1, out=position)
+
+    ## The index is within the table after clipping (or undefined for NaN, which the
+    ## NaN fraction propagates), so take() can skip the bounds check
+    with numpy.errstate(invalid='ignore'):
+      index = position.astype(numpy.intp)
+    numpy.subtract(position, index, out=position)
+    numpy.take(slopes, index, out=out, mode='clip')
+    numpy.multiply(position, out, out=position)
+    numpy.take(table, index, out=out, mode='clip')
+    numpy.add(out, position, out=out)
+    return out
+
+
+def loadCalibrationTable(path, size=CalibrationTable.DEFAULT_SIZE):
+  """
+  Load a calibration curve. A JSON file defines either points,
+  {"points": [[r2s, temp], ...]}, or a polynomial, {"polynomial": [c_n, ..., c_0],
+  "range": [r2sMin, r2sMax]}. Any other file is read as CSV with the columns R2* and
+  temperature; lines that are not numeric (e.g. a header) are skipped.
+  """
+  if path.lower().endswith('.json'):
+    with open(path) as f:
+      definition = json.load(f)
+    if 'polynomial' in definition:
+      return CalibrationTable.fromPolynomial(definition['polynomial'], definition['range'], size)
+    points = definition['points']
+  else:
+    points = []
+    with open(path) as f:
+      for row in csv.reader(f):
+        try:
+          points.append((float(row[0]), float(row[1])))
+        except (ValueError, IndexError):
+          continue
+  if len(points) < 2:
+    raise ValueError("The calibration file '%s' needs at least two points." % path)
+  return CalibrationTable.fromPoints([p[0] for p in points], [p[1] for p in points], size)
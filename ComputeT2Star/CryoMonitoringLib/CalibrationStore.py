@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+
+__all__ = ['makeProtocol', 'protocolKey', 'CalibrationStore']
+
+
+def makeProtocol(TE1, TE2, matrix, scannerID=''):
+  """
+  Imaging protocol of a CalibrationStore entry: the echo times (s), the matrix size
+  (i, j, k) and the ID of the scanner ('' if unknown)
+  """
+  return {'TE1': float(TE1), 'TE2': float(TE2), 'matrix': [int(n) for n in matrix],
+          'scannerID': str(scannerID or '')}
+
+
+def protocolKey(protocol):
+  """
+  Key of the protocol in the store; the echo times are compared to 9 significant digits
+  """
+  return 'TE1=%.9g TE2=%.9g matrix=%s scanner=%s' % (protocol['TE1'], protocol['TE2'],
+                                                     'x'.join([str(n) for n in protocol['matrix']]),
+                                                     protocol['scannerID'])
+
+
+def _jsonStatistics(statistics):
+  ## ROI statistics ({label: {'mean', 'sigma', 'count'}} per image) as JSON types
+  if statistics is None:
+    return None
+  return [dict([(str(label), {'mean': float(values['mean']), 'sigma': float(values['sigma']),
+                              'count': int(values['count'])})
+                for (label, values) in imageStatistics.items()])
+          for imageStatistics in statistics]
+
+
+class CalibrationStore(object):
+  """
+  Scale factors and noise levels estimated for imaging protocols (see makeProtocol()),
+  kept in a JSON file so that a later session with the same scanner and protocol can
+  start without a calibration pass. Each entry holds the scale factor with the
+  calibration R2* it was estimated for, the noise levels of both echoes per noise
+  method ("Mean" or "SD"), and the ROI statistics they were estimated from. The file
+  is read when it is first needed and rewritten (atomically, merged with its current
+  contents) on every update. A file that cannot be parsed raises ValueError.
+  """
+
+  VERSION = 1
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    """
+    (Re)read the file; a missing file is an empty store
+    """
+    entries = {}
+    if os.path.exists(self.path):
+      with open(self.path) as f:
+        contents = json.load(f)
+      if not isinstance(contents, dict) or not isinstance(contents.get('protocols', {}), dict):
+        raise ValueError("'%s' is not a calibration store." % self.path)
+      entries = contents.get('protocols', {})
+    self.entries = entries
+    return entries
+
+  def save(self):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    temporaryPath = self.path + '.tmp'
+    with open(temporaryPath, 'w') as f:
+      json.dump({'version': self.VERSION, 'protocols': self.entries}, f, indent=2, sort_keys=True)
+    if hasattr(os, 'replace'):
+      os.replace(temporaryPath, self.path)
+    else:
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      os.rename(temporaryPath, self.path)
+
+  def lookup(self, protocol):
+    """
+    Entry of the protocol (a dictionary), or None
+    """
+    with self.lock:
+      if self.entries is None:
+        self.load()
+      return self.entries.get(protocolKey(protocol))
+
+  def update(self, protocol, names, value):
+    """
+    Set an item of the entry of the protocol and write the file; names is the path of
+    the item in the entry (e.g. ('noiseLevel', 'SD'))
+    """
+    with self.lock:
+      ## Merged with the current file, which another session may have updated
+      self.load()
+      item = self.entries.setdefault(protocolKey(protocol), {'protocol': protocol})
+      for name in names[:-1]:
+        item = item.setdefault(name, {})
+      item[names[-1]] = value
+      self.save()
+
+  def remove(self, protocol):
+    with self.lock:
+      self.load()
+      if self.entries.pop(protocolKey(protocol), None) is not None:
+        self.save()
+
+  def scaleFactor(self, protocol, scaleCalibrationR2s):
+    """
+    Stored scale factor of the protocol, or None if there is none for this calibration R2*
+    """
+    entry = self.lookup(protocol)
+    if entry is None or 'scaleFactor' not in entry:
+      return None
+    stored = entry['scaleFactor']
+    if '%.9g' % stored['scaleCalibrationR2s'] != '%.9g' % scaleCalibrationR2s:
+      return None
+    return stored['value']
+
+  def noiseLevel(self, protocol, method):
+    """
+    Stored noise levels [echo 1, echo 2] of the protocol for the method, or None
+    """
+    entry = self.lookup(protocol)
+    if entry is None or method not in entry.get('noiseLevel', {}):
+      return None
+    return list(entry['noiseLevel'][method]['value'])
+
+  def storeScaleFactor(self, protocol, scaleFactor, scaleCalibrationR2s, statistics=None):
+    """
+    Store the scale factor estimated for the protocol, with the ROI statistics of both
+    echoes it was estimated from (as returned by labelStatistics()), if given
+    """
+    self.update(protocol, ('scaleFactor',), {'value': float(scaleFactor),
+                                            'scaleCalibrationR2s': float(scaleCalibrationR2s),
+                                            'statistics': _jsonStatistics(statistics),
+                                            'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+  def storeNoiseLevel(self, protocol, noiseLevel, method, statistics=None):
+    """
+    Store the noise levels of both echoes estimated for the protocol with the method,
+    with the ROI statistics of both echoes, if given
+    """
+    self.update(protocol, ('noiseLevel', method), {'value': [float(noiseLevel[0]), float(noiseLevel[1])],
+                                                   'statistics': _jsonStatistics(statistics),
+                                                   'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
@@ -0,0 +1,199 @@
+import atexit
+import threading
+import numpy
+from multiprocessing.pool import ThreadPool
+
+from .T2Star import computeMaps
+from .Temperature import computeTemp, computeTempFromBaseline
+
+__all__ = ['BASELINE_BYTES_PER_VOXEL', 'mapsBytesPerVoxel', 'slabs', 'threadPool', 'closeThreadPools',
+           'forEachSlab',
+           'computeMapsChunked', 'computeTempFromEchoes', 'computeTempFromEchoesChunked',
+           'computeTempFromBaselineChunked']
+
+## Intermediates of computeTempFromBaseline(): two boolean flags and the mask
+BASELINE_BYTES_PER_VOXEL = 2 + 1
+
+_threadPools = {}
+_threadPoolsLock = threading.Lock()
+
+
+def mapsBytesPerVoxel(dtype=numpy.float64):
+  """
+  Upper bound of the intermediate buffers allocated by computeMaps() per voxel for the
+  buffers of the type dtype: two echo buffers, a T2* map, two boolean flags and the mask
+  """
+  return 3 * numpy.dtype(dtype).itemsize + 2 + 1
+
+
+def slabs(shape, bytesPerVoxel, memoryBudget, minSlabs=1):
+  """
+  Split a (k, j, i) volume into slabs of whole slices such that the intermediates of
+  one slab (bytesPerVoxel per voxel) fit into memoryBudget bytes, and that there are at
+  least minSlabs slabs (if the volume has enough slices). Returns the slices along k.
+  A slab has at least one slice, even if the budget is smaller than that.
+  """
+  sliceBytes = bytesPerVoxel * int(numpy.prod(shape[1:]))
+  nSlices = -(-shape[0] // max(minSlabs, 1))
+  if memoryBudget and sliceBytes > 0:
+    nSlices = min(nSlices, int(memoryBudget // sliceBytes))
+  nSlices = max(nSlices, 1)
+  return [slice(start, min(start + nSlices, shape[0])) for start in range(0, shape[0], nSlices)]
+
+
+def threadPool(threads):
+  """
+  Thread pool with the given number of threads; the pool is created once and reused
+  until closeThreadPools() is called
+  """
+  with _threadPoolsLock:
+    if threads not in _threadPools:
+      _threadPools[threads] = ThreadPool(threads)
+    return _threadPools[threads]
+
+
+def closeThreadPools():
+  """
+  Close the thread pools created by threadPool(). The work already submitted to them is
+  completed and their threads then exit; later calls of threadPool() create new pools.
+  Called at exit and by the module widgets on cleanup (e.g. when a module is reloaded).
+  """
+  with _threadPoolsLock:
+    pools = list(_threadPools.values())
+    _threadPools.clear()
+  for pool in pools:
+    pool.close()
+
+
+atexit.register(closeThreadPools)
+
+
+def forEachSlab(function, shape, bytesPerVoxel, memoryBudget, threads=1):
+  """
+  Call function(slab) for the slabs of the volume. With threads > 1, the slabs are
+  processed on a thread pool (the NumPy kernels release the GIL) and the memory budget
+  is shared between the threads.
+  """
+  if threads > 1:
+    if memoryBudget:
+      memoryBudget = memoryBudget // threads
+    threadPool(threads).map(function, slabs(shape, bytesPerVoxel, memoryBudget, threads))
+  else:
+    for slab in slabs(shape, bytesPerVoxel, memoryBudget):
+      function(slab)
+
+
+class _ParallelSlabRecord(object):
+  """
+  Record passed to the slabs running in parallel. The stages cannot be timed per slab,
+  so they are not forwarded, but the cancellation of a BackgroundTask (its cancelled
+  flag) is still checked at every stage of every slab, so that the slabs still queued
+  on the pool stop at their first stage. Only reads the flag, so it is thread-safe.
+  """
+
+  def __init__(self, record):
+    self.record = record
+
+  def startStage(self, stage):
+    if getattr(self.record, 'cancelled', False):
+      ## Raises TaskCancelled
+      self.record.startStage(stage)
+
+  def endStage(self):
+    pass
+
+  def finish(self):
+    pass
+
+
+def _slabRecord(record, threads):
+  """
+  The stages cannot be timed per slab when the slabs run in parallel; the record then
+  gets one 'parallel computation' stage instead, and the slabs only check whether the
+  computation is cancelled (see _ParallelSlabRecord)
+  """
+  if record is None:
+    return None
+  if threads > 1:
+    record.startStage('parallel computation')
+    return _ParallelSlabRecord(record)
+  return record
+
+
+def computeMapsChunked(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, memoryBudget, computeT2Star=True, computeR2Star=True, outT2Star=None, outR2Star=None, record=None, threads=1, dtype=numpy.float64, outMask=None):
+  """
+  Same as computeMaps(), but the volume is streamed through slabs of slices and each
+  slab is written straight into the output arrays, so that the intermediates never
+  exceed memoryBudget bytes (the input and output arrays are not counted). With
+  threads > 1, the slabs are processed in parallel. Every voxel is computed
+  independently, so the result is bit-identical to computeMaps().
+  """
+  shape = arrayTE1.shape
+  if computeT2Star and outT2Star is None:
+    outT2Star = numpy.empty(shape, dtype=dtype)
+  if computeR2Star and outR2Star is None:
+    outR2Star = numpy.empty(shape, dtype=dtype)
+  if not computeT2Star:
+    outT2Star = None
+  if not computeR2Star:
+    outR2Star = None
+  slabRecord = _slabRecord(record, threads)
+
+  def computeSlab(slab):
+    computeMaps(arrayTE1[slab], arrayTE2[slab], TE1, TE2, scaleFactor, noiseLevel, outputThreshold,
+                inputThreshold, minT2s, computeT2Star, computeR2Star,
+                None if outT2Star is None else outT2Star[slab],
+                None if outR2Star is None else outR2Star[slab], slabRecord, dtype,
+                None if outMask is None else outMask[slab])
+
+  forEachSlab(computeSlab, shape, mapsBytesPerVoxel(dtype), memoryBudget, threads)
+  if record is not None:
+    record.endStage()
+  return (outT2Star, outR2Star)
+
+
+def computeTempFromEchoes(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, out=None, record=None, calibrationTable=None, dtype=numpy.float64):
+  """
+  Temperature map from the two echo arrays (R2* map without output threshold,
+  followed by computeTemp()), as computed by the ComputeTemp module
+  """
+  (arrayT2Star, arrayR2Star) = computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, None,
+                                           inputThreshold, minT2s, False, True, record=record, dtype=dtype)
+  return computeTemp(arrayR2Star, paramA, paramB, outputThreshold, out, record, calibrationTable, dtype)
+
+
+def computeTempFromEchoesChunked(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, memoryBudget, out=None, record=None, threads=1, calibrationTable=None, dtype=numpy.float64):
+  """
+  Same as computeTempFromEchoes(), streamed through slabs as in computeMapsChunked()
+  (the full-size R2* map is never allocated)
+  """
+  if out is None:
+    out = numpy.empty(arrayTE1.shape, dtype=dtype)
+  slabRecord = _slabRecord(record, threads)
+
+  def computeSlab(slab):
+    computeTempFromEchoes(arrayTE1[slab], arrayTE2[slab], TE1, TE2, scaleFactor, noiseLevel, inputThreshold,
+                          minT2s, paramA, paramB, outputThreshold, out[slab], slabRecord, calibrationTable, dtype)
+
+  forEachSlab(computeSlab, arrayTE1.shape, mapsBytesPerVoxel(dtype), memoryBudget, threads)
+  if record is not None:
+    record.endStage()
+  return out
+
+
+def computeTempFromBaselineChunked(baseline, arrayReference, outputThreshold, fillValue, memoryBudget, out=None, record=None, threads=1, outMask=None):
+  """
+  Same as computeTempFromBaseline(), streamed through slabs as in computeMapsChunked()
+  """
+  if out is None:
+    out = numpy.empty(arrayReference.shape, dtype=baseline.offset.dtype)
+  slabRecord = _slabRecord(record, threads)
+
+  def computeSlab(slab):
+    computeTempFromBaseline(baseline.slab(slab), arrayReference[slab], outputThreshold, fillValue, out[slab],
+                            slabRecord, None if outMask is None else outMask[slab])
+
+  forEachSlab(computeSlab, arrayReference.shape, BASELINE_BYTES_PER_VOXEL, memoryBudget, threads)
+  if record is not None:
+    record.endStage()
+  return out
@@ -0,0 +1,123 @@
+import os
+import csv
+import json
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+__all__ = ['RunRecord', 'NullRunRecord', 'createRunRecord']
+
+
+class RunRecord(object):
+  """
+  Wall time and allocated bytes of each stage of one run (e.g. pull, noise correction,
+  masking, log-ratio, calibration, thresholding and push). A stage starts with
+  startStage() and ends when the next stage starts or finish() is called; a stage that
+  is entered more than once accumulates its time. The allocated bytes are the peak
+  memory traced by tracemalloc during the stage above the level at its start (None if
+  tracemalloc is not available). tracemalloc sees Python and NumPy allocations, but not
+  the buffers allocated inside ITK or VTK.
+  """
+
+  def __init__(self, name, traceMemory=True):
+    self.name = name
+    self.timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    self.stageNames = []
+    self.stageTimes = {}
+    self.stageAllocatedBytes = {}
+    self.currentStage = None
+    self.stageStartTime = None
+    self.stageStartMemory = None
+    self.startedTracing = False
+    if traceMemory and tracemalloc and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self.startedTracing = True
+
+  def startStage(self, stage):
+    self.endStage()
+    if stage not in self.stageTimes:
+      self.stageNames.append(stage)
+      self.stageTimes[stage] = 0.0
+      self.stageAllocatedBytes[stage] = None
+    self.currentStage = stage
+    if tracemalloc and tracemalloc.is_tracing():
+      if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+      self.stageStartMemory = tracemalloc.get_traced_memory()[0]
+    self.stageStartTime = time.time()
+
+  def endStage(self):
+    if self.currentStage == None:
+      return
+    elapsed = time.time() - self.stageStartTime
+    stage = self.currentStage
+    self.stageTimes[stage] += elapsed
+    if self.stageStartMemory != None and tracemalloc.is_tracing():
+      (current, peak) = tracemalloc.get_traced_memory()
+      allocated = max(peak - self.stageStartMemory, 0)
+      self.stageAllocatedBytes[stage] = max(allocated, self.stageAllocatedBytes[stage] or 0)
+    self.currentStage = None
+    self.stageStartMemory = None
+
+  def finish(self):
+    self.endStage()
+    if self.startedTracing:
+      tracemalloc.stop()
+      self.startedTracing = False
+
+  def totalTime(self):
+    return sum(self.stageTimes.values())
+
+  def toDict(self):
+    return {
+      'name': self.name,
+      'timestamp': self.timestamp,
+      'totalTime': self.totalTime(),
+      'stages': [{'stage': stage, 'time': self.stageTimes[stage], 'allocatedBytes': self.stageAllocatedBytes[stage]}
+                 for stage in self.stageNames],
+      }
+
+  def writeJSON(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.toDict(), f, indent=2)
+
+  def writeCSV(self, path):
+    """
+    Append one row per stage to the CSV file (with a header if the file is new)
+    """
+    newFile = not os.path.exists(path)
+    with open(path, 'a') as f:
+      writer = csv.writer(f)
+      if newFile:
+        writer.writerow(['name', 'timestamp', 'stage', 'time', 'allocatedBytes'])
+      for stage in self.stageNames:
+        writer.writerow([self.name, self.timestamp, stage, self.stageTimes[stage], self.stageAllocatedBytes[stage]])
+
+
+class NullRunRecord(object):
+  """
+  Stand-in for RunRecord when instrumentation is disabled
+  """
+
+  def startStage(self, stage):
+    pass
+
+  def endStage(self):
+    pass
+
+  def finish(self):
+    pass
+
+NULL_RUN_RECORD = NullRunRecord()
+
+
+def createRunRecord(name, enabled):
+  """
+  A new RunRecord if instrumentation is enabled, otherwise a record that ignores the stages
+  """
+  if enabled:
+    return RunRecord(name)
+  return NULL_RUN_RECORD
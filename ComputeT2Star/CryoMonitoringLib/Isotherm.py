@@ -0,0 +1,140 @@
+import numpy
+
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['DEFAULT_ISOTHERMS', 'CONTOUR_BLOCK_SIZE', 'isothermLabels', 'contourBlocks', 'IsothermTracker']
+
+## Isotherms (deg C) of the iceball monitored during cryoablation
+DEFAULT_ISOTHERMS = (0.0, -20.0, -40.0)
+
+## Size (in marching-cubes cells per axis) of the blocks in which the isotherm surfaces
+## are contoured and updated
+CONTOUR_BLOCK_SIZE = 32
+
+
+def isothermLabels(arrayTemp, isotherms=DEFAULT_ISOTHERMS, out=None):
+  """
+  Multi-label isotherm segmentation of a temperature map: label k for the voxels
+  below the k-th highest isotherm (but not below the next one), 0 elsewhere. The
+  isotherms are nested, so the region enclosed by the k-th isotherm is (label >= k).
+  Voxels at exactly the isotherm (e.g. the 0.0 fill value of invalid voxels) and NaNs
+  are not counted as below.
+  """
+  if out is None:
+    out = numpy.empty(arrayTemp.shape, dtype=numpy.uint8)
+  flag = numpy.empty(arrayTemp.shape, dtype=numpy.bool_)
+  out[...] = 0
+  for isotherm in isotherms:
+    numpy.less(arrayTemp, isotherm, out=flag)
+    numpy.add(out, flag, out=out)
+  return out
+
+
+def contourBlocks(shape, blockSize=CONTOUR_BLOCK_SIZE, slices=None):
+  """
+  Blocks in which the surface of a (k, j, i) label volume is contoured, as a dict
+  {block index: voxel ranges ((k0, k1), (j0, j1), (i0, i1))}. The volume is padded with
+  one voxel of background on each side, so that the surface is closed at its edges; the
+  ranges (half-open) may therefore start at -1 and end at n + 1. Neighbouring blocks
+  share one layer of voxels, so that their marching-cubes cells tile the padded volume.
+  If slices (e.g. the box returned by IsothermTracker.update()) is given, only the blocks
+  that read voxels of the box are returned.
+  """
+  axisBlocks = []
+  for (axis, n) in enumerate(shape):
+    ## Block b holds the cells between the voxels bB-1 ... (b+1)B-1 (n + 1 cells in all)
+    (first, last) = (0, n // blockSize)
+    if slices is not None:
+      (first, last) = (slices[axis].start // blockSize, min(slices[axis].stop // blockSize, last))
+    axisBlocks.append([(b, (b * blockSize - 1, min((b + 1) * blockSize, n + 1))) for b in range(first, last + 1)])
+  blocks = {}
+  for (bk, kRange) in axisBlocks[0]:
+    for (bj, jRange) in axisBlocks[1]:
+      for (bi, iRange) in axisBlocks[2]:
+        blocks[(bk, bj, bi)] = (kRange, jRange, iRange)
+  return blocks
+
+
+def _changedBox(changedVoxels):
+  """
+  Bounding box (slices) of the True voxels of a (k, j, i) array, or None. Only the slice
+  range along k is found from the whole array; the range along j and i is found from
+  that slab.
+  """
+  kIndices = numpy.flatnonzero(changedVoxels.any(axis=(1, 2)))
+  if len(kIndices) == 0:
+    return None
+  slab = changedVoxels[kIndices[0]:kIndices[-1] + 1]
+  jIndices = numpy.flatnonzero(slab.any(axis=(0, 2)))
+  iIndices = numpy.flatnonzero(slab.any(axis=(0, 1)))
+  return (slice(int(kIndices[0]), int(kIndices[-1]) + 1), slice(int(jIndices[0]), int(jIndices[-1]) + 1),
+          slice(int(iIndices[0]), int(iIndices[-1]) + 1))
+
+
+class IsothermTracker(object):
+  """
+  Isotherm segmentation and enclosed volumes of a series of temperature maps. Each
+  frame is labelled and compared with the previous one over the whole volume (one
+  vectorized pass per isotherm and one for the comparison); the label counts, the
+  label map and the surface models are then only updated in the bounding box of the
+  voxels whose label changed, which is usually a small part of the volume during a
+  freeze. The surface models are patched in the blocks of that box (see contourBlocks()).
+  """
+
+  def __init__(self, isotherms=DEFAULT_ISOTHERMS):
+    self.isotherms = tuple(sorted([float(isotherm) for isotherm in isotherms], reverse=True))
+    self.labels = None
+    self.counts = numpy.zeros(len(self.isotherms) + 1, dtype=numpy.int64)
+
+  def labelsOf(self, arrayTemp, out=None):
+    """
+    Isotherm labels of the temperature map (see isothermLabels()); does not change the tracker
+    """
+    return isothermLabels(arrayTemp, self.isotherms, out)
+
+  def update(self, labels, record=None):
+    """
+    Take over the labels of a new frame (see labelsOf()). Returns (slices, changed): the
+    bounding box of the changed voxels (None if nothing changed) and the indices of the
+    isotherms whose enclosed region changed. The labels are compared with the previous
+    frame in full; only the updates after that are limited to the bounding box.
+    """
+    if record is None:
+      record = NULL_RUN_RECORD
+    record.startStage('isotherms')
+    nLabels = len(self.isotherms) + 1
+
+    if self.labels is None or self.labels.shape != labels.shape:
+      self.labels = labels.copy()
+      self.counts = numpy.bincount(self.labels.ravel(), minlength=nLabels).astype(numpy.int64)
+      record.endStage()
+      return (tuple([slice(0, n) for n in labels.shape]), list(range(len(self.isotherms))))
+
+    slices = _changedBox(numpy.not_equal(labels, self.labels))
+    if slices is None:
+      record.endStage()
+      return (None, [])
+
+    oldLabels = self.labels[slices]
+    newLabels = labels[slices]
+    self.counts -= numpy.bincount(oldLabels.ravel(), minlength=nLabels)
+    self.counts += numpy.bincount(newLabels.ravel(), minlength=nLabels)
+
+    ## The region of isotherm k changed where a voxel crossed label k (the voxels of the
+    ## box whose label did not change have lower == upper and do not count)
+    lower = numpy.minimum(oldLabels, newLabels)
+    upper = numpy.maximum(oldLabels, newLabels)
+    changed = [index for index in range(len(self.isotherms))
+               if numpy.any(numpy.logical_and(lower <= index, upper > index))]
+
+    oldLabels[...] = newLabels
+    record.endStage()
+    return (slices, changed)
+
+  def volumes(self, voxelVolume=1.0):
+    """
+    Volumes enclosed by the isotherms, as a list of (isotherm, volume) pairs in the
+    order of self.isotherms; voxelVolume is the volume of one voxel
+    """
+    enclosed = numpy.cumsum(self.counts[::-1])[::-1][1:]
+    return [(isotherm, float(count) * voxelVolume) for (isotherm, count) in zip(self.isotherms, enclosed)]
@@ -0,0 +1,65 @@
+import numpy
+
+__all__ = ['DIVIDE_ZERO_TOLERANCE', 'PRECISIONS', 'precisionType', 'allocateFlags', 'divideITK', 'finalizeMap']
+
+## ITK's Divide filter treats a denominator within this margin as zero
+## and returns the maximum value of the pixel type instead.
+DIVIDE_ZERO_TOLERANCE = 0.1 * numpy.finfo(numpy.float64).eps
+
+## Pixel types of the computation and the output maps. Float32 halves the memory
+## traffic; python -m CryoMonitoringLib.Precision reports its deviation from Float64.
+PRECISIONS = {"Float64": numpy.float64, "Float32": numpy.float32}
+
+
+def precisionType(precision):
+  """
+  NumPy type of a precision name ("Float64" or "Float32")
+  """
+  if precision not in PRECISIONS:
+    raise ValueError("Unknown precision '%s'. Choose one of %s." % (precision, sorted(PRECISIONS.keys())))
+  return PRECISIONS[precision]
+
+
+def allocateFlags(shape):
+  """
+  Allocate the pair of boolean scratch buffers used by divideITK() and finalizeMap()
+  """
+  return (numpy.empty(shape, dtype=numpy.bool_), numpy.empty(shape, dtype=numpy.bool_))
+
+
+def divideITK(numerator, denominator, out, flags=None):
+  """
+  Element-wise division with the same convention as sitk.Divide: the result is the
+  maximum value of the output type (e.g. Float64) wherever the denominator is (almost) zero.
+  """
+  if flags is None:
+    flags = allocateFlags(out.shape)
+  (flag, flag2) = flags
+  numpy.less_equal(denominator, DIVIDE_ZERO_TOLERANCE, out=flag)
+  numpy.greater_equal(denominator, -DIVIDE_ZERO_TOLERANCE, out=flag2)
+  numpy.logical_and(flag, flag2, out=flag)
+  with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+    numpy.divide(numerator, denominator, out=out)
+  numpy.copyto(out, numpy.finfo(out.dtype).max, where=flag)
+  return out
+
+
+def finalizeMap(array, mask, fillValue, outputThreshold, flags=None):
+  """
+  Fill the pixels excluded by the mask and apply the output threshold in place.
+  As with sitk.Threshold, pixels outside the threshold range (including NaN) are set to 0.
+  """
+  if flags is None:
+    flags = allocateFlags(array.shape)
+  (flag, flag2) = flags
+  if mask is not None:
+    numpy.logical_not(mask, out=flag)
+    numpy.copyto(array, fillValue, where=flag)
+  if outputThreshold != None:
+    with numpy.errstate(invalid='ignore'):
+      numpy.greater_equal(array, outputThreshold[0], out=flag)
+      numpy.less_equal(array, outputThreshold[1], out=flag2)
+    numpy.logical_and(flag, flag2, out=flag)
+    numpy.logical_not(flag, out=flag)
+    numpy.copyto(array, 0.0, where=flag)
+  return array
@@ -0,0 +1,78 @@
+#
+# Live monitoring of incoming volumes (requires Slicer; not imported by the
+# CryoMonitoringLib package itself).
+#
+
+import time
+import logging
+import slicer
+
+__all__ = ['LiveMonitor']
+
+
+class LiveMonitor(object):
+  """
+  Observe a set of volume nodes (e.g. the two echoes of a dual-echo acquisition) and
+  call frameCallback() once every node has received new image data since the last
+  frame. The end-to-end latency of each frame, measured from the arrival of the first
+  volume of the frame until frameCallback() returns, is passed to latencyCallback(latency).
+  If asynchronous is True, frameCallback(frameDone) only starts the processing (e.g. in
+  a BackgroundRunner) and calls frameDone() once the results are in the scene; the
+  latency is measured until then, and frames that never complete are not counted.
+  """
+
+  def __init__(self, volumeNodes, frameCallback, latencyCallback=None, asynchronous=False):
+    self.volumeNodes = list(volumeNodes)
+    self.frameCallback = frameCallback
+    self.latencyCallback = latencyCallback
+    self.asynchronous = asynchronous
+    self.observerTags = []
+    self.pendingNodeIDs = set()
+    self.frameStartTime = None
+    self.latencies = []
+
+  def isActive(self):
+    return len(self.observerTags) > 0
+
+  def start(self):
+    self.stop()
+    self.resetFrame()
+    self.latencies = []
+    for node in self.volumeNodes:
+      tag = node.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onImageDataModified)
+      self.observerTags.append((node, tag))
+
+  def stop(self):
+    for (node, tag) in self.observerTags:
+      node.RemoveObserver(tag)
+    self.observerTags = []
+
+  def resetFrame(self):
+    self.pendingNodeIDs = set([node.GetID() for node in self.volumeNodes])
+    self.frameStartTime = None
+
+  def onImageDataModified(self, caller, event):
+    if self.frameStartTime == None:
+      self.frameStartTime = time.time()
+    self.pendingNodeIDs.discard(caller.GetID())
+    if len(self.pendingNodeIDs) > 0:
+      return
+
+    startTime = self.frameStartTime
+    self.resetFrame()
+    try:
+      if self.asynchronous:
+        self.frameCallback(lambda: self.frameDone(startTime))
+        return
+      self.frameCallback()
+    except Exception as e:
+      logging.error('Live monitoring: processing failed: %s' % str(e))
+      return
+    self.frameDone(startTime)
+
+  def frameDone(self, startTime):
+    latency = time.time() - startTime
+    self.latencies.append(latency)
+    logging.info('Live monitoring: frame %d processed (latency %.3f s)' % (len(self.latencies), latency))
+    if self.latencyCallback:
+      self.latencyCallback(latency)
@@ -0,0 +1,173 @@
+import math
+import numpy
+
+from .Statistics import ROIStatistics
+
+__all__ = ['calcNoise', 'noiseFromStatistics', 'backgroundNoiseStatistics', 'estimateBackgroundNoise']
+
+
+def calcNoise(array1, array2, roiArray, method="Mean", label=1):
+  """
+  Estimate the noise level from the pixels in the ROI.
+  If array2 is given, the noise is estimated from the difference between the two
+  images (two-image approach); otherwise from array1 alone (single-image approach).
+  The 'method' argument must be either "Mean" or "SD".
+  """
+  roiStatistics = ROIStatistics(roiArray)
+  values = roiStatistics.values(array1)
+  if array2 is not None:
+    values -= roiStatistics.values(array2)
+
+  return noiseFromStatistics(roiStatistics.statisticsFromValues(values)[label], method)
+
+
+def noiseFromStatistics(statistics, method="Mean"):
+  """
+  Noise level from the ROI statistics ({'mean', 'sigma', 'count'}) of a background region
+  """
+  if method == "Mean":
+    return statistics['mean'] / math.sqrt(math.pi/2.0)
+  else: # method == "SD"
+    return statistics['sigma']
+
+
+## Number of histogram bins, minimum number of bins below the background peak (the
+## histogram is refined over the low intensities if the peak falls in fewer bins), and
+## cutoff of the background voxels in multiples of the peak intensity. The background
+## of a magnitude image is Rayleigh distributed with its mode at the noise sigma; less
+## than 0.04% of the background lies above 4 sigma.
+BACKGROUND_HISTOGRAM_BINS = 1024
+BACKGROUND_MIN_PEAK_BINS = 32
+BACKGROUND_CUTOFF = 4.0
+
+## Voxels per bincount() call (bounds the temporary index array), and number of voxels
+## sampled to find the histogram range of a float image
+BACKGROUND_BLOCK_SIZE = 1 << 20
+BACKGROUND_SAMPLES = 1 << 16
+
+
+def _backgroundPeak(counts, width):
+  """
+  (peak bin, background cutoff intensity) of a histogram with bins of the given width
+  """
+  peak = int(numpy.argmax(numpy.convolve(counts, numpy.ones(5), 'same')))
+  return (peak, (peak + 1) * BACKGROUND_CUTOFF * width)
+
+
+def _integerCounts(array):
+  """
+  Count of each intensity 0, 1, ... of an image of up to 16 bits, in one pass (one
+  bincount() per block of voxels over the whole value range). Negative values are not
+  counted.
+  """
+  flat = array.reshape(-1)
+  nValues = 1 << (8 * flat.dtype.itemsize)
+  flat = flat.view(flat.dtype.str.replace('i', 'u'))
+  counts = numpy.zeros(nValues, dtype=numpy.int64)
+  for start in range(0, flat.size, BACKGROUND_BLOCK_SIZE):
+    counts += numpy.bincount(flat[start:start + BACKGROUND_BLOCK_SIZE], minlength=nValues)
+  if numpy.issubdtype(array.dtype, numpy.signedinteger):
+    counts = counts[:nValues // 2]
+  return counts
+
+
+def _integerBackground(counts, bins):
+  """
+  Background cutoff of the intensity counts of an integer image: the peak is found in
+  bins aligned to whole numbers, refined over the low intensities in memory
+  """
+  upper = int(numpy.flatnonzero(counts)[-1])
+  for refinement in range(3):
+    width = max(int(math.ceil((upper + 1.0) / bins)), 1)
+    binned = numpy.add.reduceat(counts[:upper + 1], numpy.arange(0, upper + 1, width))
+    (peak, cutoff) = _backgroundPeak(binned, width)
+    if peak >= BACKGROUND_MIN_PEAK_BINS or width == 1:
+      break
+    upper = min(int(cutoff), upper)
+  return cutoff
+
+
+def _intensityHistogram(array, upper, bins):
+  """
+  Histogram of the intensities in [0, upper]; returns (counts, bin centers, bin width).
+  For integer images the bins are aligned to whole numbers.
+  """
+  if numpy.issubdtype(array.dtype, numpy.integer):
+    width = max(int(math.ceil((upper + 1.0) / bins)), 1)
+    bins = int(math.ceil((upper + 1.0) / width))
+    lower = -0.5
+  else:
+    width = upper / bins
+    lower = 0.0
+  (counts, edges) = numpy.histogram(array, bins, (lower, lower + bins * width))
+  return (counts, edges[:-1] + 0.5 * width, width)
+
+
+def _sampledBackground(array, bins):
+  """
+  Histogram of the background range of an image (float or wider than 16 bits), and its
+  cutoff. The range is found from a sample of the voxels, so the volume itself is read
+  by one histogram only. Returns None if the sample has no positive intensity.
+  """
+  flat = array.reshape(-1)
+  sample = flat[::max(flat.size // BACKGROUND_SAMPLES, 1)]
+  upper = float(numpy.max(sample)) if sample.size else 0.0
+  if not upper > 0.0:
+    return None
+  for refinement in range(3):
+    (counts, centers, width) = _intensityHistogram(sample, upper, bins)
+    (peak, cutoff) = _backgroundPeak(counts, width)
+    if peak >= BACKGROUND_MIN_PEAK_BINS:
+      break
+    upper = min(cutoff, upper)
+
+  ## The histogram of the volume spans twice the sampled cutoff, which puts the peak near
+  ## bins / 8; the background voxels above the range (if any) are dropped
+  upper = 2.0 * cutoff
+  (counts, centers, width) = _intensityHistogram(flat, upper, bins)
+  (peak, cutoff) = _backgroundPeak(counts, width)
+  return (counts, centers, min(cutoff, upper))
+
+
+def backgroundNoiseStatistics(array, bins=BACKGROUND_HISTOGRAM_BINS):
+  """
+  Statistics ({'mean', 'sigma', 'count'}) of the background air of a magnitude image,
+  found from the intensity histogram instead of an ROI. The background is taken as the
+  most frequent intensity (the peak of the histogram, as for a field of view around
+  the body) and the voxels below BACKGROUND_CUTOFF times the peak intensity. The volume
+  is read once: integer images of up to 16 bits are counted by intensity with
+  bincount(), and other images get a single histogram over a range found from a sample
+  of the voxels.
+  """
+  if numpy.issubdtype(array.dtype, numpy.integer) and array.dtype.itemsize <= 2:
+    counts = _integerCounts(array)
+    if not counts[1:].any():
+      return {'mean': 0.0, 'sigma': 0.0, 'count': 0}
+    cutoff = _integerBackground(counts, bins)
+    counts = counts[:int(math.ceil(cutoff))]
+    centers = numpy.arange(len(counts), dtype=numpy.float64)
+  else:
+    histogram = _sampledBackground(array, bins)
+    if histogram is None:
+      return {'mean': 0.0, 'sigma': 0.0, 'count': 0}
+    (counts, centers, cutoff) = histogram
+    background = centers < cutoff
+    counts = counts[background]
+    centers = centers[background]
+
+  counts = counts.astype(numpy.float64)
+  count = counts.sum()
+  mean = numpy.dot(counts, centers) / count
+  sigma = 0.0
+  if count > 1:
+    sigma = math.sqrt(max(numpy.dot(counts, (centers - mean)**2) / (count - 1), 0.0))
+  return {'mean': mean, 'sigma': sigma, 'count': int(count)}
+
+
+def estimateBackgroundNoise(array, method="Mean", bins=BACKGROUND_HISTOGRAM_BINS):
+  """
+  Noise level of a magnitude image from its background air, without an ROI (see
+  backgroundNoiseStatistics()). The 'method' argument must be either "Mean" or "SD",
+  as for calcNoise().
+  """
+  return noiseFromStatistics(backgroundNoiseStatistics(array, bins), method)
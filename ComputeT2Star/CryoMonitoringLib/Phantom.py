@@ -0,0 +1,59 @@
+import numpy
+
+__all__ = ['makeDualEchoPhantom']
+
+
+def makeDualEchoPhantom(shape, TE1=0.00007, TE2=0.002, S0=1000.0, noiseSigma=10.0, scaleFactor=0.7899,
+                        paramA=-0.089465444, paramB=31.06195482, scaleCalibrationR2s=129.565, seed=0):
+  """
+  Synthetic dual-echo volumes ((k, j, i) shape) for testing and benchmarking.
+  The object is an ellipsoid of tissue at body temperature surrounded by air, with a
+  spherical iceball in the center where the temperature falls to -40 degC. The R2* field
+  follows from the temperature through Temp = A * R2* + B. A slab of tissue at the
+  bottom of the object has R2* = scaleCalibrationR2s for the scale factor estimation.
+  Both echoes have Rician noise with the given sigma, and echo 2 is divided by
+  scaleFactor, so that the scale factor estimation should recover it.
+
+  Returns a dictionary with 'echo1', 'echo2' (Float32), the true 'r2Star' and 'temp'
+  maps (Float64), and the label maps 'noiseROI' (air) and 'scaleROI' (calibration slab).
+  """
+  rng = numpy.random.RandomState(seed)
+  (nk, nj, ni) = shape
+  k = numpy.linspace(-1.0, 1.0, nk, dtype=numpy.float32).reshape(nk, 1, 1)
+  j = numpy.linspace(-1.0, 1.0, nj, dtype=numpy.float32).reshape(1, nj, 1)
+  i = numpy.linspace(-1.0, 1.0, ni, dtype=numpy.float32).reshape(1, 1, ni)
+
+  objectMask = (k*k/0.81 + j*j/0.64 + i*i/0.64) <= 1.0
+  radius = numpy.sqrt(k*k + j*j + i*i)
+
+  ## Temperature: -40 degC in the center, rising to body temperature at radius 0.4
+  bodyTemp = 37.0
+  temp = numpy.clip(-40.0 + (bodyTemp + 40.0) * (radius / 0.4), -40.0, bodyTemp).astype(numpy.float64)
+  r2Star = (temp - paramB) / paramA
+
+  scaleROI = numpy.zeros(shape, dtype=numpy.uint8)
+  scaleROI[(k < -0.6) & (k > -0.8) & (numpy.abs(j) < 0.3) & (numpy.abs(i) < 0.3) & objectMask] = 1
+  r2Star[scaleROI == 1] = scaleCalibrationR2s
+  temp[scaleROI == 1] = paramA * scaleCalibrationR2s + paramB
+
+  r2Star[~objectMask] = 0.0
+  temp[~objectMask] = 0.0
+
+  noiseROI = numpy.zeros(shape, dtype=numpy.uint8)
+  noiseROI[(numpy.abs(k) > 0.95) & (numpy.abs(j) < 0.5) & (numpy.abs(i) < 0.5) & ~objectMask] = 1
+
+  echoes = []
+  for (TE, scale) in ((TE1, 1.0), (TE2, 1.0/scaleFactor)):
+    signal = numpy.where(objectMask, S0 * scale * numpy.exp(-r2Star * TE), 0.0).astype(numpy.float32)
+    real = signal + rng.normal(0.0, noiseSigma, shape).astype(numpy.float32)
+    imag = rng.normal(0.0, noiseSigma, shape).astype(numpy.float32)
+    echoes.append(numpy.sqrt(real*real + imag*imag))
+
+  return {
+    'echo1': echoes[0],
+    'echo2': echoes[1],
+    'r2Star': r2Star,
+    'temp': temp,
+    'noiseROI': noiseROI,
+    'scaleROI': scaleROI,
+    }
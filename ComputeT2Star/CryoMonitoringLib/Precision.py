@@ -0,0 +1,232 @@
+#
+# Accuracy of the Float32 precision mode.
+#
+# Computes the R2* and temperature maps of reference data in Float64 and in Float32,
+# and reports the maximum deviation of the Float32 maps from the Float64 maps together
+# with the time of both pipelines. The reference data are either echo pairs read from
+# disk or synthetic dual-echo phantoms. The deviation is judged in the voxels where
+# both echoes are above --signal-level times their noise level; in the background, the
+# noise correction sqrt(S^2 - noise^2) cancels out and the maps are noise in either
+# precision (the deviation over all voxels is reported as well). Run with:
+#
+#   python -m CryoMonitoringLib.Precision --sizes 256x256x256 --output accuracy.json
+#   python -m CryoMonitoringLib.Precision --echo1 echo1-001.nrrd --echo2 echo2-001.nrrd
+#
+# The Float32 maps are equivalent if the temperature deviation does not exceed
+# --tolerance (deg C) and at most --max-mismatched-voxels voxels (default 0) hold a fill
+# value in one precision only; otherwise the exit status is 1.
+#
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy
+
+from .T2Star import calcScalingFactor, computeMaps
+from .Noise import calcNoise, estimateBackgroundNoise
+from .Temperature import computeTemp
+from .Calibration import loadCalibrationTable
+from .Phantom import makeDualEchoPhantom
+from .VolumeIO import openVolume
+from .Benchmark import TE1, TE2, PARAM_A, PARAM_B, SCALE_CALIBRATION_R2S, MIN_T2S, parseSize, machineInfo
+
+__all__ = ['compareVoxels', 'comparePrecision', 'isEquivalent', 'main']
+
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_MAX_MISMATCHED_VOXELS = 0
+DEFAULT_SIGNAL_LEVEL = 3.0
+
+
+def compareVoxels(reference, test, special, region=None):
+  """
+  Compare two maps voxel by voxel. 'special' lists (reference, test) pairs of boolean
+  maps of voxels that hold a fill value instead of a computed one (e.g. masked or
+  thresholded voxels). Returns (maximum absolute deviation over the voxels computed in
+  both maps and within the region mask, if given; number of voxels that are special in
+  only one of the maps).
+  """
+  included = numpy.ones(reference.shape, dtype=numpy.bool_)
+  if region is not None:
+    included &= region
+  mismatched = numpy.zeros(reference.shape, dtype=numpy.bool_)
+  for (referenceFlag, testFlag) in special:
+    included &= ~(referenceFlag | testFlag)
+    mismatched |= referenceFlag != testFlag
+  deviation = 0.0
+  if numpy.any(included):
+    deviation = float(numpy.max(numpy.abs(test[included].astype(numpy.float64) - reference[included])))
+  return (deviation, int(numpy.count_nonzero(mismatched)))
+
+
+def noSignalValue(TE1, TE2, dtype):
+  """
+  R2* of the voxels without signal in the first echo: the log-ratio is the log of the
+  largest value of the type (the division convention of divideITK()), so it differs
+  between the precisions by design
+  """
+  logMax = numpy.log(numpy.array([numpy.finfo(dtype).max], dtype=dtype))
+  return numpy.divide(logMax, TE1 - TE2)[0]
+
+
+def comparePrecision(echo1, echo2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, calibrationTable=None, repeat=3, dtype=numpy.float32, signalLevel=DEFAULT_SIGNAL_LEVEL):
+  """
+  Compute the R2* and temperature maps (as the ComputeTemp module) in Float64 and in
+  dtype and compare them. Returns a dictionary with the maximum R2* and temperature
+  deviations over the voxels computed in both precisions where both echoes are above
+  signalLevel times their noise level (and over all voxels), the number of voxels
+  whose mask, fill value or threshold decision differs, the number of voxels without
+  signal, and the best of 'repeat' times of each pipeline.
+  """
+  maps = {}
+  times = {}
+  for precision in (numpy.float64, dtype):
+    runTimes = []
+    for n in range(repeat):
+      startTime = time.time()
+      arrayR2Star = computeMaps(echo1, echo2, TE1, TE2, scaleFactor, noiseLevel, None, inputThreshold, minT2s,
+                                False, True, dtype=precision)[1]
+      arrayTemp = computeTemp(arrayR2Star, paramA, paramB, outputThreshold, None, None, calibrationTable,
+                              precision)
+      runTimes.append(time.time() - startTime)
+    maps[precision] = (arrayR2Star, arrayTemp)
+    times[precision] = min(runTimes)
+
+  (r2Star64, temp64) = maps[numpy.float64]
+  (r2Star32, temp32) = maps[dtype]
+  fillR2Star = 0.0
+  if minT2s > 0:
+    fillR2Star = 1/minT2s
+  noSignal = (r2Star64 == noSignalValue(TE1, TE2, numpy.float64), r2Star32 == noSignalValue(TE1, TE2, dtype))
+  special = [
+    (r2Star64 == fillR2Star, r2Star32 == fillR2Star),
+    (~numpy.isfinite(r2Star64), ~numpy.isfinite(r2Star32)),
+    noSignal,
+    ]
+  signal = None
+  if noiseLevel != None:
+    signal = numpy.greater_equal(echo1, signalLevel * noiseLevel[0])
+    signal &= numpy.greater_equal(echo2, signalLevel * noiseLevel[1])
+  thresholded = [(temp64 == 0.0, temp32 == 0.0)] if outputThreshold != None else []
+  (r2StarDeviation, r2StarMismatches) = compareVoxels(r2Star64, r2Star32, special, signal)
+  (tempDeviation, tempMismatches) = compareVoxels(temp64, temp32, special + thresholded, signal)
+  r2StarDeviationAll = compareVoxels(r2Star64, r2Star32, special)[0]
+  tempDeviationAll = compareVoxels(temp64, temp32, special + thresholded)[0]
+
+  return {
+    'size': list(echo1.shape[::-1]),
+    'voxels': int(echo1.size),
+    'noSignalVoxels': int(numpy.count_nonzero(noSignal[0] & noSignal[1])),
+    'signalVoxels': int(echo1.size if signal is None else numpy.count_nonzero(signal)),
+    'maxR2StarDeviation': r2StarDeviation,
+    'maxTempDeviation': tempDeviation,
+    'maxR2StarDeviationAllVoxels': r2StarDeviationAll,
+    'maxTempDeviationAllVoxels': tempDeviationAll,
+    'mismatchedVoxels': max(r2StarMismatches, tempMismatches),
+    'float64Time': times[numpy.float64],
+    'float32Time': times[dtype],
+    }
+
+
+def isEquivalent(result, tolerance=DEFAULT_TOLERANCE, maxMismatchedVoxels=DEFAULT_MAX_MISMATCHED_VOXELS):
+  """
+  True if the result of comparePrecision() is within the temperature tolerance and at
+  most maxMismatchedVoxels voxels hold a fill value in one precision only
+  """
+  return result['maxTempDeviation'] <= tolerance and result['mismatchedVoxels'] <= maxMismatchedVoxels
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Report the deviation of the Float32 maps from the Float64 maps.')
+  parser.add_argument('--sizes', nargs='+', default=['256x256x256'],
+                      help='phantom sizes (i x j x k), if no echo images are given')
+  parser.add_argument('--echo1', default=None, help='echo 1 image of the reference data')
+  parser.add_argument('--echo2', default=None, help='echo 2 image of the reference data')
+  parser.add_argument('--te1', dest='TE1', type=float, default=TE1, help='TE for echo 1 (s)')
+  parser.add_argument('--te2', dest='TE2', type=float, default=TE2, help='TE for echo 2 (s)')
+  parser.add_argument('--scale-factor', dest='scaleFactor', type=float, default=None,
+                      help='scale factor for the second echo (default: estimated for phantoms, 0.7899 otherwise)')
+  parser.add_argument('--noise', dest='noiseLevel', type=float, nargs=2, default=None,
+                      help='noise levels of echo 1 and 2 (default: estimated from the background)')
+  parser.add_argument('--input-threshold', dest='inputThreshold', type=float, nargs=2, default=[0.0, 0.0],
+                      help='lower input thresholds for echo 1 and 2')
+  parser.add_argument('--min-t2s', dest='minT2s', type=float, default=MIN_T2S, help='minimum T2* for output (s)')
+  parser.add_argument('--param-a', dest='paramA', type=float, default=PARAM_A, help='Temp = A * R2* + B')
+  parser.add_argument('--param-b', dest='paramB', type=float, default=PARAM_B, help='Temp = A * R2* + B')
+  parser.add_argument('--output-threshold', dest='outputThreshold', type=float, nargs=2, default=None,
+                      help='lower and upper output thresholds for the temperature map')
+  parser.add_argument('--calibration', default=None, help='nonlinear calibration curve (CSV or JSON)')
+  parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                      help='maximum acceptable temperature deviation (deg C)')
+  parser.add_argument('--max-mismatched-voxels', dest='maxMismatchedVoxels', type=int,
+                      default=DEFAULT_MAX_MISMATCHED_VOXELS,
+                      help='maximum acceptable number of voxels that hold a fill value in one precision only')
+  parser.add_argument('--signal-level', dest='signalLevel', type=float, default=DEFAULT_SIGNAL_LEVEL,
+                      help='compare the voxels where both echoes are above this multiple of the noise level')
+  parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per precision')
+  parser.add_argument('--output', default=None, help='JSON file for the results (default: standard output)')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  calibrationTable = None
+  if args.calibration:
+    calibrationTable = loadCalibrationTable(args.calibration)
+
+  datasets = []
+  if args.echo1 and args.echo2:
+    echo1 = openVolume(args.echo1)[0]
+    echo2 = openVolume(args.echo2)[0]
+    noiseLevel = args.noiseLevel or [estimateBackgroundNoise(echo1), estimateBackgroundNoise(echo2)]
+    scaleFactor = 0.7899 if args.scaleFactor is None else args.scaleFactor
+    datasets.append((args.echo1, echo1, echo2, noiseLevel, scaleFactor))
+  else:
+    for size in args.sizes:
+      shape = parseSize(size)
+      logging.info('Generating phantom %s' % (shape,))
+      phantom = makeDualEchoPhantom(shape, args.TE1, args.TE2, paramA=args.paramA, paramB=args.paramB,
+                                    scaleCalibrationR2s=SCALE_CALIBRATION_R2S)
+      echo1 = phantom['echo1']
+      echo2 = phantom['echo2']
+      noiseLevel = args.noiseLevel or [calcNoise(echo1, None, phantom['noiseROI']),
+                                       calcNoise(echo2, None, phantom['noiseROI'])]
+      scaleFactor = args.scaleFactor
+      if scaleFactor is None:
+        scaleFactor = calcScalingFactor(echo1, echo2, phantom['scaleROI'], args.TE1, args.TE2,
+                                        SCALE_CALIBRATION_R2S)
+      datasets.append(('phantom %s' % size, echo1, echo2, noiseLevel, scaleFactor))
+
+  report = {
+    'machine': machineInfo(),
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'tolerance': args.tolerance,
+    'maxMismatchedVoxels': args.maxMismatchedVoxels,
+    'results': [],
+    }
+  equivalent = True
+  for (name, echo1, echo2, noiseLevel, scaleFactor) in datasets:
+    result = comparePrecision(echo1, echo2, args.TE1, args.TE2, scaleFactor, noiseLevel, args.inputThreshold,
+                              args.minT2s, args.paramA, args.paramB, args.outputThreshold, calibrationTable,
+                              args.repeat, numpy.float32, args.signalLevel)
+    result['data'] = name
+    logging.info('%-24s R2* %.3g s^-1  temperature %.3g C (all voxels: %.3g C)  mismatched voxels %d  '
+                 'Float64 %.3f s  Float32 %.3f s'
+                 % (name, result['maxR2StarDeviation'], result['maxTempDeviation'],
+                    result['maxTempDeviationAllVoxels'], result['mismatchedVoxels'],
+                    result['float64Time'], result['float32Time']))
+    equivalent = equivalent and isEquivalent(result, args.tolerance, args.maxMismatchedVoxels)
+    report['results'].append(result)
+  report['equivalent'] = equivalent
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    sys.stdout.write(json.dumps(report, indent=2) + '\n')
+  return 0 if equivalent else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,68 @@
+import numpy
+
+__all__ = ['Region']
+
+
+class Region(object):
+  """
+  Region of interest that limits the computation to a part of the volume. The region
+  is a bounding box ((k0, k1), (j0, j1), (i0, i1)) (half-open, in voxels) or the
+  bounding box of the non-zero voxels of a label map. The maps are computed on the
+  box only, so the cost scales with the size of the region rather than the volume.
+  For a label map, the voxels within the box but outside the label are filled as well.
+  """
+
+  def __init__(self, shape, labelArray=None, boundingBox=None):
+    self.shape = tuple(shape)
+    self.outside = None
+
+    if labelArray is not None:
+      inside = numpy.not_equal(labelArray, 0)
+      boundingBox = []
+      for axis in range(3):
+        otherAxes = tuple([a for a in range(3) if a != axis])
+        indices = numpy.flatnonzero(inside.any(axis=otherAxes))
+        if len(indices) == 0:
+          boundingBox.append((0, 0))
+        else:
+          boundingBox.append((int(indices[0]), int(indices[-1]) + 1))
+      self.slices = tuple([slice(lo, hi) for (lo, hi) in boundingBox])
+      self.outside = numpy.logical_not(inside[self.slices])
+    elif boundingBox is not None:
+      self.slices = tuple([slice(max(int(lo), 0), max(min(int(hi), n), 0))
+                           for ((lo, hi), n) in zip(boundingBox, self.shape)])
+    else:
+      self.slices = tuple([slice(0, n) for n in self.shape])
+
+    self.boxShape = tuple([max(s.stop - s.start, 0) for s in self.slices])
+
+  def size(self):
+    """
+    Number of voxels in the bounding box
+    """
+    return int(numpy.prod(self.boxShape))
+
+  def crop(self, array):
+    """
+    View of the bounding box of the (full-size) array
+    """
+    return array[self.slices]
+
+  def fillOutside(self, array, fillValue):
+    """
+    Fill the voxels of the full-size array outside the region. Only the slabs around the
+    bounding box are written, not the whole array.
+    """
+    for axis in range(3):
+      start = self.slices[axis].start
+      stop = self.slices[axis].stop
+      index = [slice(None)] * 3
+      for a in range(axis):
+        index[a] = self.slices[a]
+      index[axis] = slice(0, start)
+      array[tuple(index)] = fillValue
+      index[axis] = slice(max(stop, start), None)
+      array[tuple(index)] = fillValue
+    if self.outside is not None:
+      numpy.copyto(array[self.slices], fillValue, where=self.outside)
+    return array
@@ -0,0 +1,45 @@
+import numpy
+
+from .Chunking import computeTempFromEchoesChunked
+
+__all__ = ['stackFrames', 'computeTempSeries']
+
+
+def stackFrames(arrays, dtype=None):
+  """
+  Stack the (k, j, i) arrays of the frames of a series into one (t, k, j, i) array
+  (of the type of the first frame, unless dtype is given)
+  """
+  arrays = list(arrays)
+  if len(arrays) == 0:
+    raise ValueError("No frames to stack.")
+  shape = arrays[0].shape
+  stack = numpy.empty((len(arrays),) + shape, dtype=dtype or arrays[0].dtype)
+  for (index, array) in enumerate(arrays):
+    if array.shape != shape:
+      raise ValueError("Frame %d has the shape %s; expected %s." % (index, array.shape, shape))
+    stack[index] = array
+  return stack
+
+
+def computeTempSeries(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, memoryBudget=None, out=None, record=None, threads=1, calibrationTable=None, dtype=numpy.float64):
+  """
+  Temperature maps of a whole series of echo pairs in one call; arrayTE1 and arrayTE2
+  are the echo images stacked into (t, k, j, i) arrays (see stackFrames()). Every voxel
+  of every frame is independent, so the series is processed as one volume of t * k
+  slices, streamed through slabs within memoryBudget and on the thread pool as in
+  computeTempFromEchoesChunked(). out, if given, must be C-contiguous.
+  """
+  shape = arrayTE1.shape
+  if arrayTE2.shape != shape:
+    raise ValueError("The echo series have different shapes: %s and %s." % (shape, arrayTE2.shape))
+  if out is None:
+    out = numpy.empty(shape, dtype=dtype)
+  elif not out.flags.c_contiguous:
+    raise ValueError("The output array must be C-contiguous.")
+
+  sliceShape = (-1,) + shape[2:]
+  computeTempFromEchoesChunked(arrayTE1.reshape(sliceShape), arrayTE2.reshape(sliceShape), TE1, TE2, scaleFactor,
+                               noiseLevel, inputThreshold, minT2s, paramA, paramB, outputThreshold, memoryBudget,
+                               out.reshape(sliceShape), record, threads, calibrationTable, dtype)
+  return out
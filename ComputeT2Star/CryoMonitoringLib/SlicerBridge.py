@@ -0,0 +1,245 @@
+#
+# Zero-copy access to the voxel buffers of MRML scalar volume nodes.
+#
+# This module requires Slicer and is therefore not imported by the
+# CryoMonitoringLib package itself; use 'from CryoMonitoringLib import SlicerBridge'.
+#
+
+import os
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from .CalibrationStore import CalibrationStore
+from .Isotherm import CONTOUR_BLOCK_SIZE, contourBlocks
+
+__all__ = ['arrayFromVolume', 'allocateVolumeArray', 'arrayFromVolumeModified', 'updateVolumeFromArray',
+           'volumeModifiedTime', 'boundingBoxFromROINode', 'ContourModel', 'scannerID',
+           'sharedCalibrationStore']
+
+## DICOM tags of the scanner ID: manufacturer, model name and device serial number
+SCANNER_ID_TAGS = ['0008,0070', '0008,1090', '0018,1000']
+
+_sharedCalibrationStore = None
+
+
+def arrayFromVolume(volumeNode):
+  """
+  Return a (k, j, i) array view of the voxels of a scalar volume node.
+  The array shares memory with the node's image data; nothing is copied.
+  """
+  imageData = volumeNode.GetImageData()
+  scalars = imageData.GetPointData().GetScalars()
+  dims = imageData.GetDimensions()
+  return numpy_support.vtk_to_numpy(scalars).reshape(dims[::-1])
+
+
+def hasVolumeBuffer(volumeNode, shape, vtkType):
+  """
+  True if the volume node has a single-component image buffer of the given size and type
+  """
+  imageData = volumeNode.GetImageData()
+  return (imageData is not None and imageData.GetPointData().GetScalars() is not None
+          and tuple(imageData.GetDimensions()[::-1]) == tuple(shape)
+          and imageData.GetScalarType() == vtkType
+          and imageData.GetNumberOfScalarComponents() == 1)
+
+
+def allocateVolumeArray(volumeNode, shape, dtype=numpy.float64, referenceVolumeNode=None):
+  """
+  Return a writable (k, j, i) array view of the image buffer of the volume node.
+  A new buffer is only allocated if the node does not have one with matching size
+  and type yet, so the node keeps its ID and display settings. If referenceVolumeNode
+  is given, its geometry (IJK to RAS) is copied to the node.
+  Call arrayFromVolumeModified() after writing into the array.
+  """
+  vtkType = numpy_support.get_vtk_array_type(numpy.dtype(dtype))
+
+  if not hasVolumeBuffer(volumeNode, shape, vtkType):
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(tuple(shape[::-1]))
+    imageData.AllocateScalars(vtkType, 1)
+    volumeNode.SetAndObserveImageData(imageData)
+
+  if referenceVolumeNode:
+    ijkToRAS = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+    volumeNode.SetIJKToRASMatrix(ijkToRAS)
+
+  if volumeNode.GetDisplayNode() is None:
+    volumeNode.CreateDefaultDisplayNodes()
+
+  return arrayFromVolume(volumeNode)
+
+
+def arrayFromVolumeModified(volumeNode):
+  """
+  Notify the observers of the volume node that its voxels were modified in place.
+  """
+  imageData = volumeNode.GetImageData()
+  wasModified = volumeNode.StartModify()
+  imageData.GetPointData().GetScalars().Modified()
+  imageData.Modified()
+  volumeNode.Modified()
+  volumeNode.EndModify(wasModified)
+
+
+def updateVolumeFromArray(volumeNode, array, referenceVolumeNode=None, slices=None):
+  """
+  Copy the array into the existing image buffer of the volume node (see allocateVolumeArray()).
+  If slices is given, only that part of the array is copied, unless the node does not
+  have a buffer of matching size and type yet.
+  """
+  vtkType = numpy_support.get_vtk_array_type(array.dtype)
+  if slices is None or not hasVolumeBuffer(volumeNode, array.shape, vtkType):
+    slices = Ellipsis
+  allocateVolumeArray(volumeNode, array.shape, array.dtype, referenceVolumeNode)[slices] = array[slices]
+  arrayFromVolumeModified(volumeNode)
+
+
+def volumeModifiedTime(volumeNode):
+  """
+  Modification time of the volume node including its voxels; it changes whenever the
+  node or its image data is modified and can be used as a cache key.
+  """
+  mtime = volumeNode.GetMTime()
+  imageData = volumeNode.GetImageData()
+  if imageData:
+    mtime = max(mtime, imageData.GetMTime())
+  return mtime
+
+
+def boundingBoxFromROINode(roiNode, volumeNode):
+  """
+  Bounding box ((k0, k1), (j0, j1), (i0, i1)) in the voxels of the volume node that
+  covers a box-shaped ROI node (annotation or markups ROI, defined in RAS).
+  """
+  center = [0.0, 0.0, 0.0]
+  radius = [0.0, 0.0, 0.0]
+  roiNode.GetXYZ(center)
+  roiNode.GetRadiusXYZ(radius)
+
+  rasToIJK = vtk.vtkMatrix4x4()
+  volumeNode.GetRASToIJKMatrix(rasToIJK)
+  corners = []
+  for dx in (-1, 1):
+    for dy in (-1, 1):
+      for dz in (-1, 1):
+        ras = [center[0] + dx*radius[0], center[1] + dy*radius[1], center[2] + dz*radius[2], 1.0]
+        corners.append(rasToIJK.MultiplyPoint(ras)[:3])
+  corners = numpy.array(corners)
+
+  dims = volumeNode.GetImageData().GetDimensions()
+  ## Voxels whose centers lie within the box
+  lower = numpy.clip(numpy.ceil(corners.min(axis=0)), 0, dims).astype(int)
+  upper = numpy.clip(numpy.floor(corners.max(axis=0)) + 1, 0, dims).astype(int)
+  return tuple([(lower[axis], upper[axis]) for axis in (2, 1, 0)])
+
+
+class ContourModel(object):
+  """
+  Surface model of (labelArray >= level) of a label map on the voxel grid of the
+  reference volume. The surface is kept as one piece per block of the volume (see
+  contourBlocks()); update() only re-contours the blocks that read the changed box of
+  the labels and reassembles the model from the pieces.
+  """
+
+  def __init__(self, modelNode, level, blockSize=CONTOUR_BLOCK_SIZE):
+    self.modelNode = modelNode
+    self.level = level
+    self.blockSize = blockSize
+    self.pieces = {}
+    self.shape = None
+    self.matrix = None
+    self.transform = None
+
+  def update(self, labelArray, referenceVolumeNode, slices=None):
+    """
+    Re-contour the blocks that read the voxels of the box slices (default: all blocks)
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+    matrix = tuple([ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)])
+    if labelArray.shape != self.shape or matrix != self.matrix:
+      self.pieces = {}
+      self.shape = labelArray.shape
+      self.matrix = matrix
+      self.transform = vtk.vtkTransform()
+      self.transform.SetMatrix(ijkToRAS)
+      slices = None
+
+    for (block, ranges) in contourBlocks(labelArray.shape, self.blockSize, slices).items():
+      piece = self.contourBlock(labelArray, ranges)
+      if piece is None:
+        self.pieces.pop(block, None)
+      else:
+        self.pieces[block] = piece
+
+    polyData = vtk.vtkPolyData()
+    if self.pieces:
+      append = vtk.vtkAppendPolyData()
+      for block in sorted(self.pieces.keys()):
+        append.AddInputData(self.pieces[block])
+      append.Update()
+      polyData = append.GetOutput()
+    self.modelNode.SetAndObservePolyData(polyData)
+    if self.modelNode.GetDisplayNode() is None:
+      self.modelNode.CreateDefaultDisplayNodes()
+
+  def contourBlock(self, labelArray, ranges):
+    """
+    Surface (in RAS) of one block, or None if the block has no voxels inside
+    """
+    ## The voxels of the padding stay 0
+    crop = numpy.zeros([stop - start for (start, stop) in ranges], dtype=numpy.uint8)
+    source = tuple([slice(max(start, 0), min(stop, n)) for ((start, stop), n) in zip(ranges, labelArray.shape)])
+    target = tuple([slice(s.start - start, s.stop - start) for (s, (start, stop)) in zip(source, ranges)])
+    numpy.greater_equal(labelArray[source], self.level, out=crop[target])
+    if not crop.any():
+      return None
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(crop.shape[::-1])
+    imageData.SetOrigin(ranges[2][0], ranges[1][0], ranges[0][0])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(crop.ravel(), deep=True))
+
+    contour = vtk.vtkMarchingCubes()
+    contour.SetInputData(imageData)
+    contour.SetValue(0, 0.5)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(contour.GetOutputPort())
+    transformFilter.SetTransform(self.transform)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+
+def scannerID(volumeNode):
+  """
+  ID of the scanner that acquired the volume ('manufacturer/model/serial number' from
+  the DICOM header of its first instance), or '' if the volume was not loaded from the
+  DICOM database (e.g. images received through OpenIGTLink)
+  """
+  import slicer
+  instanceUIDs = volumeNode.GetAttribute('DICOM.instanceUIDs')
+  database = getattr(slicer, 'dicomDatabase', None)
+  if not instanceUIDs or not database:
+    return ''
+  fileName = database.fileForInstance(instanceUIDs.split()[0])
+  if not fileName:
+    return ''
+  return '/'.join([database.fileValue(fileName, tag).strip() for tag in SCANNER_ID_TAGS])
+
+
+def sharedCalibrationStore():
+  """
+  CalibrationStore shared by the modules, in 'CryoMonitoring/CalibrationStore.json'
+  next to the Slicer user settings
+  """
+  global _sharedCalibrationStore
+  if _sharedCalibrationStore is None:
+    import slicer
+    settingsDirectory = os.path.dirname(slicer.app.userSettings().fileName())
+    _sharedCalibrationStore = CalibrationStore(os.path.join(settingsDirectory, 'CryoMonitoring',
+                                                            'CalibrationStore.json'))
+  return _sharedCalibrationStore
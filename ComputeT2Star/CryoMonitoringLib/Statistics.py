@@ -0,0 +1,57 @@
+import numpy
+
+__all__ = ['ROIStatistics', 'labelStatistics']
+
+
+class ROIStatistics(object):
+  """
+  Per-label mean, sigma and count of images over the voxels of a label map.
+  The ROI voxels are located once when the object is created; each image is then
+  read only at those voxels, and the statistics of all labels are gathered in a
+  single pass over them. The results follow sitk.LabelStatisticsImageFilter
+  (sigma is the sample standard deviation).
+  """
+
+  def __init__(self, labelArray):
+    flatLabel = labelArray.ravel()
+    self.indices = numpy.flatnonzero(flatLabel)
+    (self.labels, self.inverse, self.counts) = numpy.unique(flatLabel[self.indices],
+                                                            return_inverse=True, return_counts=True)
+    self.inverse = self.inverse.ravel()
+
+  def values(self, array):
+    """
+    Pixel values of the array within the ROI (as Float64)
+    """
+    return numpy.asarray(array.ravel()[self.indices], dtype=numpy.float64)
+
+  def statistics(self, array):
+    """
+    Statistics of the array as {label: {'mean': ..., 'sigma': ..., 'count': ...}}
+    """
+    return self.statisticsFromValues(self.values(array))
+
+  def statisticsFromValues(self, values):
+    nLabels = len(self.labels)
+    sums = numpy.bincount(self.inverse, weights=values, minlength=nLabels)
+    sumSquares = numpy.bincount(self.inverse, weights=values*values, minlength=nLabels)
+
+    result = {}
+    for (i, label) in enumerate(self.labels):
+      count = int(self.counts[i])
+      mean = sums[i] / count
+      sigma = 0.0
+      if count > 1:
+        variance = (sumSquares[i] - sums[i]*mean) / (count - 1)
+        sigma = numpy.sqrt(max(variance, 0.0))
+      result[int(label)] = {'mean': mean, 'sigma': sigma, 'count': count}
+    return result
+
+
+def labelStatistics(arrays, labelArray):
+  """
+  Statistics of several images over the same label map (see ROIStatistics).
+  Returns a list with one {label: {'mean', 'sigma', 'count'}} dictionary per image.
+  """
+  roiStatistics = ROIStatistics(labelArray)
+  return [roiStatistics.statistics(array) for array in arrays]
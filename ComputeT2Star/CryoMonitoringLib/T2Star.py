@@ -0,0 +1,255 @@
+import numpy
+
+from .Kernels import allocateFlags, divideITK, finalizeMap
+from .Statistics import labelStatistics
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['correctNoise', 'calcScalingFactor', 'scalingFactorFromStatistics', 'computeMaps',
+           'computeMapsMultiEcho', 'echoThresholds']
+
+
+def correctNoise(array, noiseLevel, out=None, dtype=numpy.float64):
+  """
+  Noise correction for magnitude images: sqrt(max(S^2 - noise^2, 0)).
+  If noiseLevel is None, only negative values are removed.
+  """
+  if out is None:
+    out = numpy.empty(array.shape, dtype=dtype)
+  if out is not array:
+    out[...] = array
+  if noiseLevel != None:
+    numpy.square(out, out=out)
+    numpy.subtract(out, float(noiseLevel)**2, out=out)
+    numpy.fmax(out, 0.0, out=out)
+    numpy.sqrt(out, out=out)
+  else:
+    numpy.fmax(out, 0.0, out=out)
+  return out
+
+
+def calcScalingFactor(array1, array2, roiArray, TE1, TE2, scaleCalibrationR2s, label=1):
+  """
+  Scaling factor that calibrates the second echo to the first, assuming that the
+  R2* within the ROI is scaleCalibrationR2s.
+  """
+  (statistics1, statistics2) = labelStatistics([array1, array2], roiArray)
+  return scalingFactorFromStatistics(statistics1[label], statistics2[label], TE1, TE2, scaleCalibrationR2s)
+
+
+def scalingFactorFromStatistics(statistics1, statistics2, TE1, TE2, scaleCalibrationR2s):
+  """
+  Scaling factor from the ROI statistics ({'mean', 'sigma', 'count'}) of the two echoes
+  """
+  return statistics1['mean'] / (statistics2['mean'] * numpy.exp(scaleCalibrationR2s*(TE2-TE1)))
+
+
+def computeMaps(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s, computeT2Star=True, computeR2Star=True, outT2Star=None, outR2Star=None, record=None, dtype=numpy.float64, outMask=None):
+  """
+  Compute T2* and R2* maps from two echo arrays in a single vectorized pass.
+  Noise correction, scaling, input-threshold masking, the log-ratio and the output
+  clamp write into preallocated buffers, so the only full-size arrays are the two
+  echo buffers and the outputs, all of the type dtype (Float64, or Float32 at half the
+  memory traffic). The result matches the SimpleITK path of ComputeT2StarLogic.run()
+  (up to last-bit rounding differences between the logarithm implementations).
+  The maps are written into outT2Star/outR2Star if given (e.g. the image buffers of
+  the output volumes). Returns (T2* array, R2* array); a map that is not requested is None.
+  If a RunRecord is given, the time and memory of each stage are recorded in it. The
+  mask of the voxels above the input thresholds (the others take the fill value) is
+  written into the boolean array outMask, if given.
+  """
+  if record is None:
+    record = NULL_RUN_RECORD
+
+  shape = arrayTE1.shape
+  flags = allocateFlags(shape)
+  mask = None
+  arrayT2Star = None
+  arrayR2Star = None
+
+  # Noise correction; negative values are removed in both cases
+  record.startStage('noise correction')
+  noise1 = None
+  noise2 = None
+  if noiseLevel != None:
+    (noise1, noise2) = noiseLevel
+  echo1 = correctNoise(arrayTE1, noise1, dtype=dtype)
+  echo2 = correctNoise(arrayTE2, noise2, dtype=dtype)
+
+  ## Apply scaling factor to the second echo
+  record.startStage('scaling')
+  numpy.multiply(echo2, float(scaleFactor), out=echo2)
+
+  ## Mask to exclude pixels below the input thresholds
+  record.startStage('masking')
+  if inputThreshold != None:
+    mask = numpy.greater_equal(echo1, inputThreshold[0])
+    numpy.greater_equal(echo2, inputThreshold[1], out=flags[0])
+    numpy.logical_and(mask, flags[0], out=mask)
+  if outMask is not None:
+    outMask[...] = True if mask is None else mask
+
+  ## Log-ratio log(echo2/echo1), computed in the echo 2 buffer
+  record.startStage('log-ratio')
+  logRatio = divideITK(echo2, echo1, echo2, flags)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    numpy.log(logRatio, out=logRatio)
+
+  if computeT2Star:
+    arrayT2Star = outT2Star
+    if arrayT2Star is None:
+      arrayT2Star = numpy.empty(shape, dtype=dtype)
+    record.startStage('log-ratio')
+    divideITK(TE1-TE2, logRatio, arrayT2Star, flags)
+    record.startStage('thresholding')
+    finalizeMap(arrayT2Star, mask, minT2s, outputThreshold, flags)
+
+  if computeR2Star:
+    arrayR2Star = outR2Star
+    if arrayR2Star is None:
+      arrayR2Star = echo1
+    record.startStage('log-ratio')
+    numpy.divide(logRatio, TE1-TE2, out=arrayR2Star)
+    fillR2Star = 0.0
+    if minT2s > 0:
+      fillR2Star = 1/minT2s
+    record.startStage('thresholding')
+    finalizeMap(arrayR2Star, mask, fillR2Star, outputThreshold, flags)
+
+  record.endStage()
+
+  return (arrayT2Star, arrayR2Star)
+
+
+def computeMapsMultiEcho(arrays, TEs, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors=None, computeT2Star=True, computeR2Star=True, outT2Star=None, outR2Star=None, record=None, dtype=numpy.float64, outMask=None):
+  """
+  Compute T2* and R2* maps from N >= 2 echo arrays by fitting log(S) = log(S0) - R2* * TE
+  per voxel with weighted linear least squares. The weights S^2 compensate for the noise
+  amplification of the logarithm at low signal. The fit is evaluated in closed form over
+  the stacked echo array. Voxels with signal in fewer than two echoes (e.g. after noise
+  correction) have no fit; they take the log-ratio of the first and last echo, with the
+  division convention of computeMaps(). With two echoes, the maps are those of computeMaps().
+  noiseLevels, inputThreshold and scaleFactors have one entry per echo (or are None).
+  The masking, fill values, output threshold, dtype and outMask are the same as in computeMaps().
+  Returns (T2* array, R2* array); a map that is not requested is None.
+  """
+  if record is None:
+    record = NULL_RUN_RECORD
+
+  nEchoes = len(arrays)
+  if nEchoes < 2 or len(TEs) != nEchoes:
+    raise ValueError('At least two echo arrays and one echo time per array are required')
+
+  shape = arrays[0].shape
+  flags = allocateFlags(shape)
+  mask = None
+  arrayT2Star = None
+  arrayR2Star = None
+
+  ## Noise correction; negative values are removed in both cases
+  record.startStage('noise correction')
+  echoes = numpy.empty((nEchoes,) + shape, dtype=dtype)
+  for n in range(nEchoes):
+    noiseLevel = None
+    if noiseLevels != None:
+      noiseLevel = noiseLevels[n]
+    correctNoise(arrays[n], noiseLevel, echoes[n])
+
+  if scaleFactors != None:
+    record.startStage('scaling')
+    for n in range(nEchoes):
+      numpy.multiply(echoes[n], float(scaleFactors[n]), out=echoes[n])
+
+  ## Mask to exclude pixels below the input threshold in any echo
+  record.startStage('masking')
+  if inputThreshold != None:
+    mask = numpy.ones(shape, dtype=numpy.bool_)
+    for n in range(nEchoes):
+      numpy.greater_equal(echoes[n], inputThreshold[n], out=flags[0])
+      numpy.logical_and(mask, flags[0], out=mask)
+  if outMask is not None:
+    outMask[...] = True if mask is None else mask
+
+  record.startStage('log-linear fit')
+  ## Echo times relative to their mean, to avoid cancellation in the normal equations
+  t = numpy.asarray(TEs, dtype=dtype)
+  t = t - t.mean()
+
+  ## First and last echo of the voxels without a fit, for the log-ratio
+  signal = numpy.greater(echoes, 0.0)
+  noFit = numpy.flatnonzero(numpy.count_nonzero(signal, axis=0) < 2)
+  noFitFirst = echoes[0].ravel()[noFit]
+  noFitLast = echoes[-1].ravel()[noFit]
+
+  ## Weights S^2 and log(S) in the echo buffer. Echoes without signal have no weight,
+  ## and their log is left at 0 so that they do not contribute to the sums.
+  weights = numpy.square(echoes)
+  numpy.log(echoes, out=echoes, where=signal)
+  del signal
+
+  sumW = weights.sum(axis=0)
+  sumWT = numpy.tensordot(t, weights, axes=1)
+  sumWTT = numpy.tensordot(t*t, weights, axes=1)
+  numpy.multiply(echoes, weights, out=echoes)
+  del weights
+  sumWY = echoes.sum(axis=0)
+  sumWTY = numpy.tensordot(t, echoes, axes=1)
+  del echoes
+
+  ## R2* = -slope = (sumWT*sumWY - sumW*sumWTY) / (sumW*sumWTT - sumWT^2)
+  numerator = sumWY
+  numpy.multiply(sumWY, sumWT, out=numerator)
+  numpy.multiply(sumWTY, sumW, out=sumWTY)
+  numpy.subtract(numerator, sumWTY, out=numerator)
+  denominator = sumW
+  numpy.multiply(sumW, sumWTT, out=denominator)
+  numpy.square(sumWT, out=sumWT)
+  numpy.subtract(denominator, sumWT, out=denominator)
+
+  r2Star = outR2Star
+  if r2Star is None:
+    r2Star = sumWTT
+  divideITK(numerator, denominator, r2Star, flags)
+
+  ## Log-ratio of the voxels without a fit, as in computeMaps()
+  noFitLogRatio = divideITK(noFitLast, noFitFirst, noFitLast)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    numpy.log(noFitLogRatio, out=noFitLogRatio)
+  r2Star.flat[noFit] = noFitLogRatio / (TEs[0] - TEs[-1])
+
+  if computeT2Star:
+    arrayT2Star = outT2Star
+    if arrayT2Star is None:
+      arrayT2Star = numpy.empty(shape, dtype=dtype)
+    divideITK(1.0, r2Star, arrayT2Star, flags)
+    arrayT2Star.flat[noFit] = divideITK(TEs[0] - TEs[-1], noFitLogRatio, noFitFirst)
+    record.startStage('thresholding')
+    finalizeMap(arrayT2Star, mask, minT2s, outputThreshold, flags)
+
+  if computeR2Star:
+    arrayR2Star = r2Star
+    fillR2Star = 0.0
+    if minT2s > 0:
+      fillR2Star = 1/minT2s
+    record.startStage('thresholding')
+    finalizeMap(arrayR2Star, mask, fillR2Star, outputThreshold, flags)
+
+  record.endStage()
+
+  return (arrayT2Star, arrayR2Star)
+
+
+def echoThresholds(TEs, threshold1, threshold2):
+  """
+  Lower input thresholds of N >= 2 echoes for computeMapsMultiEcho(), from the thresholds
+  of the first two echoes. The thresholds of the later echoes follow the exponential
+  decay of the signal between the first two echoes, extrapolated to their TEs; if either
+  threshold is 0, the later echoes take the threshold of echo 2.
+  """
+  thresholds = [float(threshold1), float(threshold2)]
+  for TE in TEs[2:]:
+    if threshold1 > 0 and threshold2 > 0 and TEs[1] != TEs[0]:
+      decay = float(TE - TEs[0]) / (TEs[1] - TEs[0])
+      thresholds.append(threshold1 * (float(threshold2) / threshold1) ** decay)
+    else:
+      thresholds.append(float(threshold2))
+  return thresholds
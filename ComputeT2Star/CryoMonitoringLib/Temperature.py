@@ -0,0 +1,138 @@
+import numpy
+
+from .Kernels import allocateFlags, finalizeMap
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['computeTemp', 'PreparedBaseline', 'computeTempRelativeR2s', 'computeTempFromBaseline']
+
+
+def computeTemp(arrayR2Star, paramA, paramB, outputThreshold, out=None, record=None, calibrationTable=None, dtype=numpy.float64):
+  """
+  Temperature map from an R2* map using the linear model Temp = A * R2* + B, or the
+  nonlinear calibration curve of a CalibrationTable (A and B are then ignored). The
+  map is of the type of out, if given, or dtype.
+  """
+  if record is None:
+    record = NULL_RUN_RECORD
+  if out is None:
+    out = numpy.empty(arrayR2Star.shape, dtype=dtype)
+  record.startStage('calibration')
+  if calibrationTable is not None:
+    calibrationTable.evaluate(arrayR2Star, out)
+  else:
+    numpy.multiply(arrayR2Star, float(paramA), out=out)
+    numpy.add(out, float(paramB), out=out)
+  record.startStage('thresholding')
+  finalizeMap(out, None, 0.0, outputThreshold)
+  record.endStage()
+  return out
+
+
+def validR2StarMask(arrayR2Star, inputThreshold, out=None, flag=None):
+  """
+  Pixels where the R2* value is within [0, inputThreshold[1])
+  """
+  if out is None:
+    out = numpy.empty(arrayR2Star.shape, dtype=numpy.bool_)
+  if flag is None:
+    flag = numpy.empty(arrayR2Star.shape, dtype=numpy.bool_)
+  numpy.greater_equal(arrayR2Star, 0.0, out=out)
+  numpy.less_equal(arrayR2Star, inputThreshold[1] - 10e-10, out=flag)
+  numpy.logical_and(out, flag, out=out)
+  return out
+
+
+class PreparedBaseline(object):
+  """
+  Baseline R2* map prepared for repeated temperature computations against changing
+  reference frames. Holds the baseline validity mask and the term B - A * R2*_baseline,
+  so that each frame only costs Temp = A * R2*_reference + (B - A * R2*_baseline) and
+  the masking. With a CalibrationTable, the temperature is the calibration curve of the
+  R2* change, Temp = f(R2*_reference - R2*_baseline), and A and B are ignored. The
+  prepared term and the temperature maps are of the type dtype.
+  """
+
+  def __init__(self, arrayBaseline, paramA, paramB, inputThreshold, calibrationTable=None, dtype=numpy.float64):
+    self.paramA = paramA
+    self.paramB = paramB
+    self.calibrationTable = calibrationTable
+    self.inputThreshold = None
+    if inputThreshold != None:
+      self.inputThreshold = tuple(inputThreshold)
+    self.shape = arrayBaseline.shape
+
+    if calibrationTable is not None:
+      self.offset = numpy.negative(arrayBaseline, dtype=dtype)
+    else:
+      self.offset = numpy.multiply(arrayBaseline, -float(paramA), dtype=dtype)
+      numpy.add(self.offset, float(paramB), out=self.offset)
+
+    self.mask = None
+    if inputThreshold != None:
+      self.mask = validR2StarMask(arrayBaseline, inputThreshold)
+
+  def slab(self, slices):
+    """
+    View of the prepared baseline restricted to a slab (or box) of the volume
+    """
+    baseline = PreparedBaseline.__new__(PreparedBaseline)
+    baseline.paramA = self.paramA
+    baseline.paramB = self.paramB
+    baseline.calibrationTable = self.calibrationTable
+    baseline.inputThreshold = self.inputThreshold
+    baseline.offset = self.offset[slices]
+    baseline.mask = None
+    if self.mask is not None:
+      baseline.mask = self.mask[slices]
+    baseline.shape = baseline.offset.shape
+    return baseline
+
+  def matches(self, paramA, paramB, inputThreshold, calibrationTable=None, dtype=numpy.float64):
+    if inputThreshold != None:
+      inputThreshold = tuple(inputThreshold)
+    return (self.paramA == paramA and self.paramB == paramB and self.inputThreshold == inputThreshold
+            and self.calibrationTable is calibrationTable and self.offset.dtype == dtype)
+
+
+def computeTempRelativeR2s(arrayBaseline, arrayReference, paramA, paramB, outputThreshold, inputThreshold, fillValue=-40.0, out=None, calibrationTable=None, dtype=numpy.float64):
+  """
+  Temperature map from the R2* change between the baseline and the reference:
+  Temp = A * (R2*_reference - R2*_baseline) + B (or the curve of the calibrationTable).
+  Pixels where either R2* map is outside [0, inputThreshold[1]) are set to fillValue.
+  """
+  baseline = PreparedBaseline(arrayBaseline, paramA, paramB, inputThreshold, calibrationTable, dtype)
+  return computeTempFromBaseline(baseline, arrayReference, outputThreshold, fillValue, out)
+
+
+def computeTempFromBaseline(baseline, arrayReference, outputThreshold, fillValue=-40.0, out=None, record=None, outMask=None):
+  """
+  Same as computeTempRelativeR2s() for a PreparedBaseline (the map is of its type).
+  The mask of the valid pixels is written into the boolean array outMask, if given.
+  """
+  if record is None:
+    record = NULL_RUN_RECORD
+  shape = arrayReference.shape
+  if out is None:
+    out = numpy.empty(shape, dtype=baseline.offset.dtype)
+  flags = allocateFlags(shape)
+
+  record.startStage('calibration')
+  if baseline.calibrationTable is not None:
+    numpy.add(arrayReference, baseline.offset, out=out, dtype=out.dtype)
+    baseline.calibrationTable.evaluate(out, out)
+  else:
+    numpy.multiply(arrayReference, float(baseline.paramA), out=out, dtype=out.dtype)
+    numpy.add(out, baseline.offset, out=out)
+
+  record.startStage('masking')
+  mask = None
+  if baseline.mask is not None:
+    mask = validR2StarMask(arrayReference, baseline.inputThreshold, None, flags[0])
+    numpy.logical_and(mask, baseline.mask, out=mask)
+  if outMask is not None:
+    outMask[...] = True if mask is None else mask
+
+  record.startStage('thresholding')
+  finalizeMap(out, mask, fillValue, outputThreshold, flags)
+  record.endStage()
+  return out
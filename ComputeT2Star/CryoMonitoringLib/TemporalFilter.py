@@ -0,0 +1,92 @@
+import numpy
+
+from .Instrumentation import NULL_RUN_RECORD
+
+__all__ = ['TemporalFilter']
+
+
+class TemporalFilter(object):
+  """
+  Per-voxel temporal filter of a series of maps (e.g. the temperature maps of live
+  monitoring), either an exponential moving average ('EMA', weight alpha of the new
+  frame) or a scalar Kalman filter per voxel ('Kalman', random-walk model with the
+  given process and measurement variances).
+
+  The filtered map is the state of the filter and is updated in place from each frame,
+  so an update costs O(voxels), never re-reads older frames and allocates nothing once
+  the state exists. The state is kept in the type of the frames (at least Float32).
+  Each frame may come with a mask of its valid voxels: the state of the other voxels
+  (e.g. those that take a fill value) is held, and a voxel starts from the frame value
+  the first time it is valid.
+  """
+
+  METHODS = ("EMA", "Kalman")
+
+  def __init__(self, method="EMA", alpha=0.5, processVariance=1.0, measurementVariance=4.0):
+    if method not in self.METHODS:
+      raise ValueError("Unknown temporal filter '%s'. Choose one of %s." % (method, self.METHODS))
+    self.method = method
+    self.alpha = alpha
+    self.processVariance = processVariance
+    self.measurementVariance = measurementVariance
+    self.reset()
+
+  def reset(self):
+    """
+    Discard the state; the next frame starts a new series
+    """
+    self.state = None
+    self.variance = None
+    self.gain = None
+    self.scratch = None
+    self.initialized = None
+    self.complete = False
+    self.count = 0
+
+  def update(self, frame, record=None, mask=None):
+    """
+    Filter a new frame and return the filtered map. The returned array is the state of
+    the filter and is overwritten by the next frame. If a mask is given, only the voxels
+    where it is True are filtered. A frame of another shape starts a new series.
+    """
+    if record is None:
+      record = NULL_RUN_RECORD
+    record.startStage('temporal filter')
+
+    dtype = numpy.promote_types(frame.dtype, numpy.float32)
+    if self.state is None or self.state.shape != frame.shape or self.state.dtype != dtype:
+      self.reset()
+      self.state = numpy.empty(frame.shape, dtype=dtype)
+      self.scratch = numpy.empty(frame.shape, dtype=dtype)
+      self.initialized = numpy.zeros(frame.shape, dtype=numpy.bool_)
+      if self.method == "Kalman":
+        self.variance = numpy.empty(frame.shape, dtype=dtype)
+        self.gain = numpy.empty(frame.shape, dtype=dtype)
+
+    valid = True if mask is None else mask
+    ## The fill values of the voxels that are not valid may be infinite
+    with numpy.errstate(invalid='ignore', over='ignore'):
+      if self.count > 0:
+        gain = self.alpha
+        if self.method == "Kalman":
+          ## Predict P = P + Q, then gain K = P / (P + R) and P = (1 - K) * P = K * R
+          gain = numpy.add(self.variance, self.processVariance, out=self.gain)
+          numpy.divide(gain, numpy.add(gain, self.measurementVariance, out=self.scratch), out=gain)
+          numpy.multiply(gain, self.measurementVariance, out=self.variance, where=valid)
+        ## state = state + gain * (frame - state)
+        innovation = numpy.subtract(frame, self.state, out=self.scratch)
+        numpy.multiply(innovation, gain, out=innovation)
+        numpy.add(self.state, innovation, out=self.state, where=valid)
+
+      ## The voxels without a state show the frame, and keep it as their state once valid
+      if not self.complete:
+        uninitialized = numpy.logical_not(self.initialized)
+        numpy.copyto(self.state, frame, where=uninitialized)
+        if self.method == "Kalman":
+          numpy.copyto(self.variance, self.measurementVariance, where=uninitialized)
+        numpy.logical_or(self.initialized, valid, out=self.initialized)
+        self.complete = bool(self.initialized.all())
+
+    self.count += 1
+    record.endStage()
+    return self.state
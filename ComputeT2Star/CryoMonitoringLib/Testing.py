@@ -0,0 +1,1154 @@
+#
+# Tests of the computation library that run without Slicer.
+#
+# Each feature is tested on small synthetic dual-echo phantoms (see Phantom.py)
+# against a reference computation, e.g. the single-call version of a pipeline or the
+# equivalent SimpleITK filters. The tests that need SimpleITK are skipped if it is
+# not installed. Run with:
+#
+#   python -m CryoMonitoringLib.Testing
+#
+# The self-tests of the Slicer modules run the same tests (see run()).
+#
+
+import os
+import sys
+import csv
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+import numpy
+
+try:
+  import SimpleITK as sitk
+except ImportError:
+  sitk = None
+
+try:
+  import vtk
+except ImportError:
+  vtk = None
+
+from .Instrumentation import RunRecord, NullRunRecord, createRunRecord
+from . import Instrumentation
+from .Statistics import ROIStatistics, labelStatistics
+from .T2Star import calcScalingFactor, computeMaps, computeMapsMultiEcho
+from .Noise import calcNoise, backgroundNoiseStatistics, estimateBackgroundNoise
+from .Temperature import computeTemp, PreparedBaseline, computeTempFromBaseline
+from .VolumeIO import readVolume, writeVolume, mapVolume, openVolume
+from . import Batch
+from .Region import Region
+from .Chunking import (mapsBytesPerVoxel, slabs, threadPool, closeThreadPools, computeMapsChunked,
+                       computeTempFromEchoes, computeTempFromEchoesChunked, computeTempFromBaselineChunked)
+from .Isotherm import IsothermTracker, contourBlocks
+from .TemporalFilter import TemporalFilter
+from .Thresholding import UnthresholdedMap
+from .Series import stackFrames, computeTempSeries
+from .Calibration import CalibrationTable, loadCalibrationTable
+from .Precision import compareVoxels, isEquivalent, main as precisionMain
+from .Cache import contentKey, IntermediateCache, computeR2StarCached, computeTempFromEchoesCached
+from .CalibrationStore import makeProtocol, CalibrationStore
+from .Phantom import makeDualEchoPhantom
+
+__all__ = ['makePhantom', 'PhantomTest', 'SimpleITKEngineTest', 'StatisticsTest', 'BatchTest', 'RunRecordTest', 'MultiEchoTest', 'RegionTest', 'ChunkingTest', 'ParallelChunkingTest', 'IsothermTest', 'TemporalFilterTest', 'SeriesTest', 'CalibrationTableTest', 'NoiseTest', 'PrecisionTest', 'CacheTest', 'UnthresholdedMapTest', 'CalibrationStoreTest', 'VolumeIOTest', 'run', 'main']
+
+TE1 = 0.00007
+TE2 = 0.002
+PARAM_A = -0.089465444
+PARAM_B = 31.06195482
+SCALE_CALIBRATION_R2S = 129.565
+MIN_T2S = 0.00125
+SHAPE = (24, 32, 28)
+
+
+def makePhantom(shape=SHAPE, seed=0):
+  """
+  Dual-echo phantom with the scale factor and noise levels estimated from its ROIs
+  """
+  phantom = makeDualEchoPhantom(shape, TE1, TE2, paramA=PARAM_A, paramB=PARAM_B,
+                                scaleCalibrationR2s=SCALE_CALIBRATION_R2S, seed=seed)
+  phantom['noiseLevel'] = [calcNoise(phantom['echo1'], None, phantom['noiseROI']),
+                           calcNoise(phantom['echo2'], None, phantom['noiseROI'])]
+  phantom['scaleFactor'] = calcScalingFactor(phantom['echo1'], phantom['echo2'], phantom['scaleROI'], TE1, TE2,
+                                             SCALE_CALIBRATION_R2S)
+  return phantom
+
+
+def mapsParameters(phantom, outputThreshold=None, inputThreshold=(20.0, 20.0)):
+  """
+  computeMaps() arguments for the phantom
+  """
+  return (phantom['echo1'], phantom['echo2'], TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'],
+          outputThreshold, inputThreshold, MIN_T2S)
+
+
+def computeMapsSimpleITK(arrayTE1, arrayTE2, TE1, TE2, scaleFactor, noiseLevel, outputThreshold, inputThreshold, minT2s):
+  """
+  (T2*, R2*) maps computed by the SimpleITK engine of ComputeT2StarLogic.run()
+  """
+  imageTE1 = sitk.Cast(sitk.GetImageFromArray(arrayTE1), sitk.sitkFloat64)
+  imageTE2 = sitk.Cast(sitk.GetImageFromArray(arrayTE2), sitk.sitkFloat64)
+  if noiseLevel != None:
+    (imageTE1, imageTE2) = [sitk.Sqrt(sitk.Threshold(sitk.Subtract(sitk.Pow(image, 2), noise*noise),
+                                                     0.0, float('Inf'), 0.0))
+                            for (image, noise) in ((imageTE1, noiseLevel[0]), (imageTE2, noiseLevel[1]))]
+  else:
+    imageTE1 = sitk.Threshold(imageTE1, 0.0, float('Inf'), 0.0)
+    imageTE2 = sitk.Threshold(imageTE2, 0.0, float('Inf'), 0.0)
+  imageTE2 = sitk.Multiply(imageTE2, scaleFactor)
+
+  logRatio = sitk.Log(sitk.Divide(imageTE2, imageTE1))
+  images = [sitk.Divide(TE1-TE2, logRatio), sitk.Divide(logRatio, TE1-TE2)]
+  if inputThreshold != None:
+    mask = sitk.And(sitk.BinaryThreshold(imageTE1, inputThreshold[0], float('Inf'), 1, 0),
+                    sitk.BinaryThreshold(imageTE2, inputThreshold[1], float('Inf'), 1, 0))
+    imaskFloat = sitk.Cast(sitk.Not(mask), sitk.sitkFloat64)
+    fills = [imaskFloat * minT2s, imaskFloat * (1/minT2s) if minT2s > 0 else 0.0]
+    images = [sitk.Add(sitk.Mask(image, mask), fill) for (image, fill) in zip(images, fills)]
+  if outputThreshold != None:
+    images = [sitk.Threshold(image, outputThreshold[0], outputThreshold[1], 0.0) for image in images]
+  return tuple([sitk.GetArrayFromImage(image) for image in images])
+
+
+class PhantomTest(unittest.TestCase):
+  """
+  The phantom of the benchmarks reproduces its scale factor and temperature field
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.phantom = makePhantom()
+
+  def test_ScaleFactor(self):
+    self.assertAlmostEqual(self.phantom['scaleFactor'], 0.7899, delta=0.02)
+
+  def test_TemperatureAccuracy(self):
+    phantom = self.phantom
+    r2Star = computeMaps(phantom['echo1'], phantom['echo2'], TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'],
+                         None, (100.0, 100.0), MIN_T2S, False, True)[1]
+    temp = computeTemp(r2Star, PARAM_A, PARAM_B, None)
+    ## Within the object, away from the noise floor of the iceball
+    inside = numpy.logical_and(phantom['r2Star'] > 0.0, phantom['temp'] > -10.0)
+    self.assertTrue(numpy.median(numpy.abs(temp[inside] - phantom['temp'][inside])) < 2.0)
+
+
+@unittest.skipIf(sitk is None, 'SimpleITK is not installed')
+class SimpleITKEngineTest(unittest.TestCase):
+  """
+  The NumPy engine reproduces the SimpleITK engine of ComputeT2StarLogic.run()
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.phantom = makePhantom()
+
+  def test_ComputeMaps(self):
+    for (outputThreshold, inputThreshold) in ((None, (20.0, 20.0)), ((-100.0, 1000.0), (20.0, 20.0)),
+                                              ((0.0, 0.05), None)):
+      parameters = mapsParameters(self.phantom, outputThreshold, inputThreshold)
+      maps = computeMaps(*parameters)
+      references = computeMapsSimpleITK(*parameters)
+      for (array, reference) in zip(maps, references):
+        finite = numpy.isfinite(reference)
+        numpy.testing.assert_array_equal(numpy.isfinite(array), finite)
+        numpy.testing.assert_allclose(array[finite], reference[finite], rtol=1e-12, atol=1e-15)
+
+  def test_ComputeMapsWithoutNoiseCorrection(self):
+    parameters = list(mapsParameters(self.phantom))
+    parameters[5] = None
+    for (array, reference) in zip(computeMaps(*parameters), computeMapsSimpleITK(*parameters)):
+      finite = numpy.isfinite(reference)
+      numpy.testing.assert_array_equal(numpy.isfinite(array), finite)
+      numpy.testing.assert_allclose(array[finite], reference[finite], rtol=1e-12, atol=1e-15)
+
+
+@unittest.skipIf(sitk is None, 'SimpleITK is not installed')
+class StatisticsTest(unittest.TestCase):
+  """
+  ROI statistics against sitk.LabelStatisticsImageFilter
+  """
+
+  def test_LabelStatistics(self):
+    phantom = makePhantom()
+    ## Several labels, including one with a single voxel
+    labelArray = (phantom['noiseROI'] + 2 * phantom['scaleROI']).astype(numpy.int16)
+    labelArray[0, 0, 0] = 7
+    (statistics1, statistics2) = labelStatistics([phantom['echo1'], phantom['echo2']], labelArray)
+    labelImage = sitk.GetImageFromArray(labelArray)
+    for (array, statistics) in ((phantom['echo1'], statistics1), (phantom['echo2'], statistics2)):
+      labelFilter = sitk.LabelStatisticsImageFilter()
+      labelFilter.Execute(sitk.GetImageFromArray(array), labelImage)
+      self.assertEqual(sorted(statistics.keys()), sorted([label for label in labelFilter.GetLabels() if label != 0]))
+      for (label, values) in statistics.items():
+        self.assertEqual(values['count'], labelFilter.GetCount(label))
+        self.assertAlmostEqual(values['mean'], labelFilter.GetMean(label), delta=1e-9 * abs(values['mean']))
+        self.assertAlmostEqual(values['sigma'], labelFilter.GetSigma(label), delta=1e-9 * abs(values['mean']))
+
+  def test_NoROIVoxels(self):
+    roiStatistics = ROIStatistics(numpy.zeros(SHAPE, dtype=numpy.int8))
+    self.assertEqual(roiStatistics.statistics(numpy.ones(SHAPE)), {})
+
+
+@unittest.skipIf(sitk is None, 'SimpleITK is not installed')
+class BatchTest(unittest.TestCase):
+  """
+  The batch CLI against the maps computed frame by frame
+  """
+
+  def setUp(self):
+    logging.disable(logging.ERROR)
+    self.directory = tempfile.mkdtemp()
+    self.dataDir = os.path.join(self.directory, 'data')
+    os.makedirs(self.dataDir)
+    self.phantoms = [makePhantom(seed=seed) for seed in range(3)]
+    for (frame, phantom) in enumerate(self.phantoms):
+      writeVolume(os.path.join(self.dataDir, 'echo1-%d.nrrd' % frame), phantom['echo1'])
+      writeVolume(os.path.join(self.dataDir, 'echo2-%d.nrrd' % frame), phantom['echo2'])
+    self.scaleROIPath = os.path.join(self.directory, 'scale.nrrd')
+    writeVolume(self.scaleROIPath, self.phantoms[0]['scaleROI'])
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    logging.disable(logging.NOTSET)
+
+  def reference(self, phantom, noiseLevel):
+    scaleFactor = calcScalingFactor(phantom['echo1'], phantom['echo2'], phantom['scaleROI'], TE1, TE2,
+                                    SCALE_CALIBRATION_R2S)
+    r2Star = computeMaps(phantom['echo1'], phantom['echo2'], TE1, TE2, scaleFactor, noiseLevel, None, (20.0, 20.0),
+                         MIN_T2S, False, True)[1]
+    return (r2Star, computeTemp(r2Star, PARAM_A, PARAM_B, (-40.0, 40.0)))
+
+  def runBatch(self, outputDir, options):
+    argv = [self.dataDir, outputDir, '--scale-roi', self.scaleROIPath, '--noise', '5.0', '6.0',
+            '--input-threshold', '20', '20', '--output-threshold', '-40', '40',
+            '--te1', repr(TE1), '--te2', repr(TE2), '--scale-calibration-r2s', repr(SCALE_CALIBRATION_R2S),
+            '--min-t2s', repr(MIN_T2S), '--param-a', repr(PARAM_A), '--param-b', repr(PARAM_B)]
+    self.assertEqual(Batch.main(argv + options), 0)
+
+  def test_Batch(self):
+    for options in (['-j', '1', '--write-r2star'], ['-j', '2', '--write-r2star', '--no-mmap'],
+                    ['-j', '1', '--memory-budget', '0.01']):
+      outputDir = os.path.join(self.directory, 'output')
+      self.runBatch(outputDir, options)
+      for (frame, phantom) in enumerate(self.phantoms):
+        (r2Star, temp) = self.reference(phantom, [5.0, 6.0])
+        numpy.testing.assert_allclose(readVolume(os.path.join(outputDir, 'temp-%d.nrrd' % frame))[0], temp,
+                                      rtol=1e-12, atol=1e-12)
+        r2StarPath = os.path.join(outputDir, 'r2s-%d.nrrd' % frame)
+        self.assertEqual(os.path.exists(r2StarPath), '--write-r2star' in options)
+        if '--write-r2star' in options:
+          numpy.testing.assert_array_equal(readVolume(r2StarPath)[0], r2Star)
+      shutil.rmtree(outputDir)
+
+  def test_ImageList(self):
+    imageList = os.path.join(self.directory, 'frames.csv')
+    with open(imageList, 'w') as f:
+      f.write('# frame\n2\n\n0\n')
+    self.assertEqual(Batch.loadImageList(imageList), ['2', '0'])
+    self.assertEqual(Batch.findFrames(self.dataDir, 'echo1-', 'echo2-'), ['0', '1', '2'])
+
+  def test_ROISizeMismatch(self):
+    writeVolume(self.scaleROIPath, self.phantoms[0]['scaleROI'][1:])
+    self.assertEqual(Batch.main([self.dataDir, os.path.join(self.directory, 'output'),
+                                 '--scale-roi', self.scaleROIPath]), 1)
+
+
+class _Clock(object):
+  """
+  Stand-in for the time module that advances by one second per call of time()
+  """
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self):
+    self.now += 1.0
+    return self.now
+
+  def strftime(self, format):
+    return '2000-01-01T00:00:00'
+
+
+class RunRecordTest(unittest.TestCase):
+  """
+  Stage times and allocated bytes of the run records, and their JSON and CSV output
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.clock = Instrumentation.time
+    Instrumentation.time = _Clock()
+
+  def tearDown(self):
+    Instrumentation.time = self.clock
+    shutil.rmtree(self.directory)
+
+  def test_Stages(self):
+    tracing = Instrumentation.tracemalloc is not None and Instrumentation.tracemalloc.is_tracing()
+    record = RunRecord('Test')
+    record.startStage('pull')
+    record.startStage('log-ratio')
+    buffer = numpy.ones(1000000)
+    record.startStage('pull')
+    record.finish()
+    ## Each call of time() advances the clock by 1 s; re-entering a stage accumulates its time
+    self.assertEqual(record.stageNames, ['pull', 'log-ratio'])
+    self.assertEqual(record.stageTimes, {'pull': 2.0, 'log-ratio': 1.0})
+    self.assertEqual(record.totalTime(), 3.0)
+    if Instrumentation.tracemalloc is not None:
+      self.assertTrue(record.stageAllocatedBytes['log-ratio'] >= buffer.nbytes)
+      self.assertEqual(Instrumentation.tracemalloc.is_tracing(), tracing)
+    ## No stage is running after finish()
+    record.endStage()
+    self.assertEqual(record.totalTime(), 3.0)
+
+  def test_Output(self):
+    record = RunRecord('Test', traceMemory=False)
+    record.startStage('pull')
+    record.startStage('push')
+    record.finish()
+    jsonPath = os.path.join(self.directory, 'record.json')
+    record.writeJSON(jsonPath)
+    with open(jsonPath) as f:
+      self.assertEqual(json.load(f), {'name': 'Test', 'timestamp': '2000-01-01T00:00:00', 'totalTime': 2.0,
+                                      'stages': [{'stage': 'pull', 'time': 1.0, 'allocatedBytes': None},
+                                                 {'stage': 'push', 'time': 1.0, 'allocatedBytes': None}]})
+    ## The CSV file gets one header and one row per stage and run
+    csvPath = os.path.join(self.directory, 'record.csv')
+    record.writeCSV(csvPath)
+    record.writeCSV(csvPath)
+    with open(csvPath) as f:
+      rows = list(csv.reader(f))
+    self.assertEqual(rows[0], ['name', 'timestamp', 'stage', 'time', 'allocatedBytes'])
+    self.assertEqual([row[2] for row in rows[1:]], ['pull', 'push', 'pull', 'push'])
+
+  def test_Disabled(self):
+    record = createRunRecord('Test', False)
+    self.assertTrue(isinstance(record, NullRunRecord))
+    record.startStage('pull')
+    record.finish()
+    record = createRunRecord('Test', True)
+    self.assertTrue(isinstance(record, RunRecord))
+    record.finish()
+
+
+class MultiEchoTest(unittest.TestCase):
+  """
+  The multi-echo fit against the two-echo log-ratio and exact exponential decays
+  """
+
+  def test_TwoEchoes(self):
+    phantom = makePhantom((16, 32, 32))
+    (echo1, echo2) = (phantom['echo1'], phantom['echo2'])
+    reference = computeMaps(echo1, echo2, TE1, TE2, phantom['scaleFactor'], [5.0, 5.0], None, [0.0, 0.0], MIN_T2S)
+    maps = computeMapsMultiEcho([echo1, echo2], [TE1, TE2], [5.0, 5.0], None, [0.0, 0.0], MIN_T2S,
+                                [1.0, phantom['scaleFactor']])
+    ## The noise correction leaves voxels with signal in one echo only, or in none
+    self.assertTrue(numpy.any(numpy.logical_and(echo1 < 5.0, echo2 >= 5.0 / phantom['scaleFactor'])))
+    self.assertTrue(numpy.any(numpy.logical_and(echo1 >= 5.0, echo2 < 5.0)))
+    self.assertTrue(numpy.any(numpy.logical_and(echo1 < 5.0, echo2 < 5.0)))
+    for (array, referenceArray) in zip(maps, reference):
+      numpy.testing.assert_allclose(array, referenceArray, rtol=1e-9, atol=0.0)
+
+  def test_ExponentialDecay(self):
+    TEs = [0.0005, 0.0015, 0.004]
+    r2Star = numpy.linspace(10.0, 400.0, 60).reshape((3, 4, 5))
+    arrays = [1000.0 * numpy.exp(-r2Star * TE) for TE in TEs]
+    (t2StarMap, r2StarMap) = computeMapsMultiEcho(arrays, TEs, None, None, None, 0.0)
+    numpy.testing.assert_allclose(r2StarMap, r2Star, rtol=1e-9, atol=0.0)
+    numpy.testing.assert_allclose(t2StarMap, 1.0 / r2Star, rtol=1e-9, atol=0.0)
+
+
+class RegionTest(unittest.TestCase):
+  """
+  Cropping and filling of label-map and bounding-box regions
+  """
+
+  def checkRegion(self, region, inside):
+    array = numpy.arange(numpy.prod(SHAPE), dtype=numpy.float64).reshape(SHAPE)
+    numpy.testing.assert_array_equal(region.fillOutside(array.copy(), -1.0), numpy.where(inside, array, -1.0))
+    cropped = region.crop(array)
+    self.assertEqual(cropped.shape, region.boxShape)
+    self.assertEqual(region.size(), cropped.size)
+    ## The box is the smallest one that holds the region
+    self.assertEqual(inside[region.slices].sum(), inside.sum())
+    for axis in range(3):
+      if cropped.size > 0:
+        self.assertTrue(numpy.take(inside[region.slices], 0, axis).any())
+        self.assertTrue(numpy.take(inside[region.slices], -1, axis).any())
+
+  def test_LabelMap(self):
+    phantom = makePhantom()
+    for labelArray in (phantom['scaleROI'], phantom['noiseROI'], numpy.zeros(SHAPE, dtype=numpy.int8)):
+      self.checkRegion(Region(SHAPE, labelArray=labelArray), labelArray != 0)
+
+  def test_BoundingBox(self):
+    inside = numpy.zeros(SHAPE, dtype=numpy.bool_)
+    inside[3:10, 0:32, 5:28] = True
+    ## The box is clipped to the volume
+    region = Region(SHAPE, boundingBox=((3, 10), (-4, 40), (5, 100)))
+    self.assertEqual(region.boxShape, (7, 32, 23))
+    self.checkRegion(region, inside)
+    region = Region(SHAPE, boundingBox=((30, 40), (0, 5), (0, 5)))
+    self.assertEqual(region.size(), 0)
+    self.checkRegion(region, numpy.zeros(SHAPE, dtype=numpy.bool_))
+    self.checkRegion(Region(SHAPE), numpy.ones(SHAPE, dtype=numpy.bool_))
+
+  def test_ComputeMaps(self):
+    ## The maps of the box are those of the whole volume within the box
+    phantom = makePhantom()
+    region = Region(SHAPE, labelArray=phantom['scaleROI'])
+    parameters = mapsParameters(phantom)
+    reference = computeMaps(*parameters)
+    maps = computeMaps(region.crop(phantom['echo1']), region.crop(phantom['echo2']), *parameters[2:])
+    for (array, referenceArray) in zip(maps, reference):
+      numpy.testing.assert_array_equal(array, region.crop(referenceArray))
+
+
+class ChunkingTest(unittest.TestCase):
+  """
+  The slab-wise pipelines against their single-call versions
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.phantom = makePhantom()
+    cls.sliceBytes = mapsBytesPerVoxel() * SHAPE[1] * SHAPE[2]
+
+  def test_Slabs(self):
+    for memoryBudget in (None, 0, 1, self.sliceBytes, 5 * self.sliceBytes - 1, 1000 * self.sliceBytes):
+      for minSlabs in (1, 4, 100):
+        slices = slabs(SHAPE, mapsBytesPerVoxel(), memoryBudget, minSlabs)
+        ## The slabs cover the volume in order
+        self.assertEqual([index for slab in slices for index in range(slab.start, slab.stop)], list(range(SHAPE[0])))
+        nSlices = max([slab.stop - slab.start for slab in slices])
+        self.assertTrue(len(slices) >= min(minSlabs, SHAPE[0]))
+        if memoryBudget:
+          self.assertTrue(nSlices == 1 or nSlices * self.sliceBytes <= memoryBudget)
+
+  def test_ComputeMapsChunked(self):
+    for outputThreshold in (None, (-100.0, 1000.0)):
+      parameters = mapsParameters(self.phantom, outputThreshold)
+      reference = computeMaps(*parameters)
+      for memoryBudget in (None, 0, 1, self.sliceBytes, 5 * self.sliceBytes, 1000 * self.sliceBytes):
+        maps = computeMapsChunked(*(parameters + (memoryBudget,)))
+        for (array, referenceArray) in zip(maps, reference):
+          numpy.testing.assert_array_equal(array, referenceArray)
+
+  def test_ComputeTempFromEchoesChunked(self):
+    phantom = self.phantom
+    parameters = (phantom['echo1'], phantom['echo2'], TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'],
+                  (20.0, 20.0), MIN_T2S, PARAM_A, PARAM_B, (-40.0, 40.0))
+    reference = computeTempFromEchoes(*parameters)
+    for memoryBudget in (None, 1, 3 * self.sliceBytes):
+      numpy.testing.assert_array_equal(computeTempFromEchoesChunked(*(parameters + (memoryBudget,))), reference)
+
+
+class ParallelChunkingTest(unittest.TestCase):
+  """
+  The slabs processed on a thread pool against the single-call pipelines
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.phantom = makePhantom()
+    cls.sliceBytes = mapsBytesPerVoxel() * SHAPE[1] * SHAPE[2]
+
+  def test_ComputeMapsChunked(self):
+    parameters = mapsParameters(self.phantom, (-100.0, 1000.0))
+    reference = computeMaps(*parameters)
+    for memoryBudget in (None, 1, 5 * self.sliceBytes, 1000 * self.sliceBytes):
+      for threads in (2, 3, 64):
+        record = RunRecord('Test', traceMemory=False)
+        maps = computeMapsChunked(*(parameters + (memoryBudget,)), record=record, threads=threads)
+        record.finish()
+        self.assertEqual(record.stageNames, ['parallel computation'])
+        for (array, referenceArray) in zip(maps, reference):
+          numpy.testing.assert_array_equal(array, referenceArray)
+
+  def test_ComputeTempFromBaselineChunked(self):
+    phantom = self.phantom
+    (t2Star, baseline) = computeMaps(phantom['echo1'], phantom['echo2'], TE1, TE2, phantom['scaleFactor'],
+                                     phantom['noiseLevel'], None, (20.0, 20.0), MIN_T2S, False, True)
+    reference = numpy.clip(baseline + numpy.linspace(0.0, 50.0, baseline.size).reshape(baseline.shape), 0.0, None)
+    prepared = PreparedBaseline(baseline, PARAM_A, PARAM_B, (0.0, 500.0))
+    expected = computeTempFromBaseline(prepared, reference, (-40.0, 40.0))
+    sliceBytes = SHAPE[1] * SHAPE[2] * 3
+    for (memoryBudget, threads) in ((None, 1), (2 * sliceBytes, 1), (None, 2), (5 * sliceBytes, 3)):
+      numpy.testing.assert_array_equal(computeTempFromBaselineChunked(prepared, reference, (-40.0, 40.0), -40.0,
+                                                                      memoryBudget, threads=threads), expected)
+
+  def test_CloseThreadPools(self):
+    pool = threadPool(2)
+    self.assertTrue(threadPool(2) is pool)
+    closeThreadPools()
+    self.assertFalse(threadPool(2) is pool)
+    parameters = mapsParameters(self.phantom)
+    numpy.testing.assert_array_equal(computeMapsChunked(*(parameters + (None,)), threads=2)[1],
+                                     computeMaps(*parameters)[1])
+
+
+class _ModelNode(object):
+  """
+  Stand-in for the model and reference volume nodes of SlicerBridge.ContourModel
+  """
+
+  def __init__(self):
+    self.polyData = None
+    self.displayNode = None
+
+  def SetAndObservePolyData(self, polyData):
+    self.polyData = polyData
+
+  def GetDisplayNode(self):
+    return self.displayNode
+
+  def CreateDefaultDisplayNodes(self):
+    self.displayNode = True
+
+  def GetIJKToRASMatrix(self, matrix):
+    matrix.Identity()
+    matrix.SetElement(0, 0, -0.5)
+    matrix.SetElement(2, 3, 12.0)
+
+
+class IsothermTest(unittest.TestCase):
+  """
+  The incremental isotherm counts, volumes and surface models against a full recount
+  and a full contour of every frame
+  """
+
+  def frames(self, shape, nFrames=6):
+    ## An iceball that grows from the center, with noise
+    random = numpy.random.RandomState(3)
+    (k, j, i) = numpy.meshgrid(*[numpy.arange(n) - n / 2.0 for n in shape], indexing='ij')
+    distance = numpy.sqrt(k * k + j * j + i * i)
+    for frame in range(nFrames):
+      yield 37.0 - 120.0 * numpy.exp(-distance / (1.0 + 1.5 * frame)) + random.normal(0.0, 2.0, shape)
+
+  def test_Counts(self):
+    tracker = IsothermTracker((-40.0, 0.0, -20.0))
+    previous = None
+    for temp in self.frames(SHAPE):
+      labels = tracker.labelsOf(temp)
+      (slices, changed) = tracker.update(labels)
+      counts = numpy.bincount(labels.ravel(), minlength=4)
+      numpy.testing.assert_array_equal(tracker.counts, counts)
+      numpy.testing.assert_array_equal(tracker.labels, labels)
+      enclosed = [float(numpy.count_nonzero(temp < isotherm)) * 0.5 for isotherm in (0.0, -20.0, -40.0)]
+      self.assertEqual(tracker.volumes(0.5), list(zip((0.0, -20.0, -40.0), enclosed)))
+      if previous is not None:
+        ## The box holds all changed voxels, and the changed isotherms are those whose region changed
+        changedVoxels = labels != previous
+        self.assertEqual(numpy.count_nonzero(changedVoxels[slices]), numpy.count_nonzero(changedVoxels))
+        self.assertEqual(changed, [index for index in range(3)
+                                   if numpy.any((labels > index) != (previous > index))])
+      previous = labels
+
+  def test_ContourBlocks(self):
+    shape = (9, 14, 20)
+    ## The blocks tile the cells of the padded volume
+    cells = numpy.zeros([n + 1 for n in shape], dtype=numpy.int64)
+    blocks = contourBlocks(shape, 4)
+    for ranges in blocks.values():
+      cells[tuple([slice(start + 1, stop) for (start, stop) in ranges])] += 1
+    self.assertTrue(numpy.all(cells == 1))
+    ## The blocks of a box are those that read its voxels
+    for box in (((0, 1), (0, 1), (0, 1)), ((3, 4), (7, 12), (19, 20)), ((0, 9), (13, 14), (4, 8))):
+      slices = tuple([slice(start, stop) for (start, stop) in box])
+      expected = [block for (block, ranges) in blocks.items()
+                  if all([start < boxStop and stop > boxStart
+                          for ((start, stop), (boxStart, boxStop)) in zip(ranges, box)])]
+      self.assertEqual(sorted(contourBlocks(shape, 4, slices).keys()), sorted(expected))
+
+  @unittest.skipIf(vtk is None, 'VTK is not installed')
+  def test_ContourModel(self):
+    from . import SlicerBridge
+    tracker = IsothermTracker()
+    reference = _ModelNode()
+    incremental = [SlicerBridge.ContourModel(_ModelNode(), level, 8) for level in (1, 2, 3)]
+    for temp in self.frames(SHAPE):
+      (slices, changed) = tracker.update(tracker.labelsOf(temp))
+      for index in changed:
+        incremental[index].update(tracker.labels, reference, slices)
+      for (index, contourModel) in enumerate(incremental):
+        full = SlicerBridge.ContourModel(_ModelNode(), index + 1, 8)
+        full.update(tracker.labels, reference)
+        self.assertEqual(sorted(contourModel.pieces.keys()), sorted(full.pieces.keys()))
+        (polyData, fullPolyData) = (contourModel.modelNode.polyData, full.modelNode.polyData)
+        self.assertEqual(polyData.GetNumberOfPolys(), fullPolyData.GetNumberOfPolys())
+        numpy.testing.assert_allclose(polyData.GetBounds(), fullPolyData.GetBounds())
+        ## The pieces add up to the contour of the whole volume in one block
+        whole = SlicerBridge.ContourModel(_ModelNode(), index + 1, max(SHAPE) + 1)
+        whole.update(tracker.labels, reference)
+        self.assertEqual(polyData.GetNumberOfPolys(), whole.modelNode.polyData.GetNumberOfPolys())
+
+
+class TemporalFilterTest(unittest.TestCase):
+  """
+  The EMA and Kalman filters against their recurrence run voxel by voxel, with masks
+  """
+
+  def frames(self, shape, nFrames=8):
+    random = numpy.random.RandomState(5)
+    for frame in range(nFrames):
+      temp = (20.0 - 5.0 * frame + random.normal(0.0, 3.0, shape)).astype(numpy.float32)
+      mask = random.uniform(size=shape) > 0.3
+      ## The invalid voxels take a fill value, which must not enter the state
+      temp[~mask] = -40.0
+      yield (temp, mask)
+
+  def reference(self, method, frames, alpha=0.5, processVariance=1.0, measurementVariance=4.0):
+    ## Per voxel: start from the first valid value, update on the valid frames only
+    outputs = []
+    state = {}
+    for (temp, mask) in frames:
+      output = numpy.empty(temp.shape, dtype=numpy.float64)
+      for index in numpy.ndindex(temp.shape):
+        x = float(temp[index])
+        if mask[index]:
+          if index not in state:
+            state[index] = (x, measurementVariance)
+          else:
+            (value, variance) = state[index]
+            gain = alpha
+            if method == "Kalman":
+              variance = variance + processVariance
+              gain = variance / (variance + measurementVariance)
+              variance = gain * measurementVariance
+            state[index] = (value + gain * (x - value), variance)
+        output[index] = state[index][0] if index in state else x
+      outputs.append(output)
+    return outputs
+
+  def check(self, temporalFilter, method, shape=(3, 4, 5), **parameters):
+    frames = list(self.frames(shape))
+    for ((temp, mask), expected) in zip(frames, self.reference(method, frames, **parameters)):
+      filtered = temporalFilter.update(temp, mask=mask)
+      self.assertEqual(filtered.dtype, numpy.float32)
+      numpy.testing.assert_allclose(filtered, expected, rtol=1e-5, atol=1e-4)
+
+  def test_EMA(self):
+    self.check(TemporalFilter("EMA", alpha=0.3), "EMA", alpha=0.3)
+
+  def test_Kalman(self):
+    self.check(TemporalFilter("Kalman", processVariance=0.5, measurementVariance=2.0), "Kalman",
+               processVariance=0.5, measurementVariance=2.0)
+
+  def test_NoMask(self):
+    temporalFilter = TemporalFilter("EMA", alpha=0.25)
+    expected = None
+    for (temp, mask) in self.frames((2, 3, 4)):
+      filtered = temporalFilter.update(temp)
+      expected = temp.astype(numpy.float64) if expected is None else expected + 0.25 * (temp - expected)
+      numpy.testing.assert_allclose(filtered, expected, rtol=1e-5, atol=1e-4)
+
+  def test_Restart(self):
+    ## A frame of another shape starts a new series
+    temporalFilter = TemporalFilter("Kalman")
+    for (temp, mask) in self.frames((2, 3, 4), 3):
+      temporalFilter.update(temp, mask=mask)
+    self.check(temporalFilter, "Kalman")
+
+  def test_Region(self):
+    ## The voxels outside the region hold their state, and take the region fill value
+    shape = (6, 7, 8)
+    labelArray = numpy.zeros(shape, dtype=numpy.int16)
+    labelArray[1:5, 2:6, 1:7] = 1
+    labelArray[1, 2, 1] = 0
+    region = Region(shape, labelArray)
+    temporalFilter = TemporalFilter("EMA", alpha=0.5)
+    frames = [(temp, region.outside == False) for (temp, mask) in self.frames(region.boxShape, 4)]
+    out = numpy.empty(shape, dtype=numpy.float32)
+    for ((temp, inside), expected) in zip(frames, self.reference("EMA", frames)):
+      kept = UnthresholdedMap(temp.copy(), None, region).filter(temporalFilter)
+      kept.apply(out, [-20.0, 40.0], 0.0, -100.0)
+      expected = numpy.where((expected >= -20.0) & (expected <= 40.0), expected, 0.0)
+      numpy.testing.assert_allclose(region.crop(out)[inside], expected[inside], rtol=1e-5, atol=1e-4)
+      self.assertTrue(numpy.all(region.crop(out)[~inside] == -100.0))
+      self.assertEqual(numpy.count_nonzero(out == -100.0), out.size - numpy.count_nonzero(inside))
+
+
+class SeriesTest(unittest.TestCase):
+  """
+  The temperature maps of a series in one call against the maps of each frame
+  """
+
+  def test_ComputeTempSeries(self):
+    phantoms = [makePhantom(seed=seed) for seed in range(4)]
+    parameters = (TE1, TE2, phantoms[0]['scaleFactor'], phantoms[0]['noiseLevel'], (20.0, 20.0), MIN_T2S,
+                  PARAM_A, PARAM_B, (-40.0, 40.0))
+    references = [computeTempFromEchoes(phantom['echo1'], phantom['echo2'], *parameters) for phantom in phantoms]
+    echo1 = stackFrames([phantom['echo1'] for phantom in phantoms])
+    echo2 = stackFrames([phantom['echo2'] for phantom in phantoms])
+    self.assertEqual(echo1.shape, (len(phantoms),) + SHAPE)
+    sliceBytes = mapsBytesPerVoxel() * SHAPE[1] * SHAPE[2]
+    for (memoryBudget, threads) in ((None, 1), (3 * sliceBytes, 1), (7 * sliceBytes, 3)):
+      temps = computeTempSeries(echo1, echo2, *parameters, memoryBudget=memoryBudget, threads=threads)
+      for (temp, reference) in zip(temps, references):
+        numpy.testing.assert_array_equal(temp, reference)
+
+  def test_Errors(self):
+    phantom = makePhantom()
+    self.assertRaises(ValueError, stackFrames, [])
+    self.assertRaises(ValueError, stackFrames, [phantom['echo1'], phantom['echo1'][1:]])
+    echoes = stackFrames([phantom['echo1']] * 2)
+    out = numpy.empty((2,) + SHAPE + (2,))[..., 0]
+    self.assertRaises(ValueError, computeTempSeries, echoes, echoes, TE1, TE2, 1.0, None, None, MIN_T2S,
+                      PARAM_A, PARAM_B, None, out=out)
+    self.assertRaises(ValueError, computeTempSeries, echoes, echoes[:1], TE1, TE2, 1.0, None, None, MIN_T2S,
+                      PARAM_A, PARAM_B, None)
+
+
+class CalibrationTableTest(unittest.TestCase):
+  """
+  The lookup table of the nonlinear calibration against numpy.interp() on its grid
+  """
+
+  R2STARS = [0.0, 50.0, 120.0, 300.0, 800.0]
+  TEMPERATURES = [37.0, 30.0, 10.0, -20.0, -60.0]
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_Evaluate(self):
+    table = CalibrationTable.fromPoints(self.R2STARS, self.TEMPERATURES, size=161)
+    grid = numpy.linspace(0.0, 800.0, 161)
+    values = numpy.concatenate([numpy.linspace(-100.0, 900.0, 10001), grid, [numpy.nan]])
+    expected = numpy.interp(values, grid, table.table)
+    expected[-1] = numpy.nan
+    numpy.testing.assert_allclose(table.evaluate(values), expected, rtol=0.0, atol=1e-9)
+    ## The table is exact at the points, which lie on the grid
+    numpy.testing.assert_allclose(table.evaluate(numpy.array(self.R2STARS)), self.TEMPERATURES, rtol=0.0, atol=1e-9)
+    ## In place and in Float32
+    inPlace = values.copy()
+    table.evaluate(inPlace, out=inPlace)
+    numpy.testing.assert_allclose(inPlace, expected, rtol=0.0, atol=1e-9)
+    out32 = numpy.empty(values.shape, dtype=numpy.float32)
+    numpy.testing.assert_allclose(table.evaluate(values, out=out32), expected, rtol=0.0, atol=1e-3)
+
+  def test_Polynomial(self):
+    coefficients = [-0.0001, -0.05, 37.0]
+    table = CalibrationTable.fromPolynomial(coefficients, (0.0, 500.0))
+    values = numpy.linspace(0.0, 500.0, 777)
+    grid = numpy.linspace(0.0, 500.0, table.size)
+    numpy.testing.assert_allclose(table.evaluate(values), numpy.interp(values, grid, numpy.polyval(coefficients, grid)),
+                                  rtol=0.0, atol=1e-9)
+    self.assertRaises(ValueError, CalibrationTable.fromPolynomial, coefficients, (500.0, 0.0))
+
+  def test_ComputeTemp(self):
+    ## The calibration replaces the linear model, and the map only depends on R2*
+    table = CalibrationTable.fromPoints(self.R2STARS, self.TEMPERATURES)
+    phantom = makePhantom()
+    r2Star = computeMaps(*mapsParameters(phantom))[1]
+    temp = computeTemp(r2Star, PARAM_A, PARAM_B, None, calibrationTable=table)
+    numpy.testing.assert_array_equal(temp, table.evaluate(r2Star))
+    numpy.testing.assert_array_equal(computeTemp(r2Star, PARAM_A, PARAM_B, None, calibrationTable=table), temp)
+    numpy.testing.assert_array_equal(computeTemp(r2Star[:3], PARAM_A, PARAM_B, None, calibrationTable=table), temp[:3])
+
+  def test_Load(self):
+    points = list(zip(self.R2STARS, self.TEMPERATURES))
+    reference = CalibrationTable.fromPoints(self.R2STARS, self.TEMPERATURES)
+    path = os.path.join(self.directory, 'points.json')
+    with open(path, 'w') as f:
+      json.dump({'points': points}, f)
+    numpy.testing.assert_array_equal(loadCalibrationTable(path).table, reference.table)
+    path = os.path.join(self.directory, 'points.csv')
+    with open(path, 'w') as f:
+      f.write('R2s,Temperature\n')
+      csv.writer(f).writerows(points[::-1])
+    numpy.testing.assert_array_equal(loadCalibrationTable(path).table, reference.table)
+    path = os.path.join(self.directory, 'polynomial.json')
+    with open(path, 'w') as f:
+      json.dump({'polynomial': [-0.05, 37.0], 'range': [0.0, 500.0]}, f)
+    numpy.testing.assert_allclose(loadCalibrationTable(path, 11).table, numpy.linspace(37.0, 12.0, 11))
+    path = os.path.join(self.directory, 'short.csv')
+    with open(path, 'w') as f:
+      f.write('R2s,Temperature\n0.0,37.0\n')
+    self.assertRaises(ValueError, loadCalibrationTable, path)
+
+
+class NoiseTest(unittest.TestCase):
+  """
+  The noise level estimated from the background histogram against the ROI estimate
+  """
+
+  def test_BackgroundNoise(self):
+    phantom = makePhantom((48, 64, 64))
+    for echo in (phantom['echo1'], phantom['echo2']):
+      reference = calcNoise(echo, None, phantom['noiseROI'])
+      ## Float images (sampled range) and 16-bit integer images (bincount)
+      for array in (echo, numpy.round(echo).astype(numpy.int16), numpy.round(echo).astype(numpy.uint16)):
+        self.assertAlmostEqual(estimateBackgroundNoise(array) / reference, 1.0, delta=0.01)
+        self.assertAlmostEqual(estimateBackgroundNoise(array, "SD") / calcNoise(echo, None, phantom['noiseROI'], "SD"),
+                               1.0, delta=0.05)
+    ## Wider integers take the histogram of floats, in bins aligned to whole numbers
+    echo = numpy.round(phantom['echo1'])
+    self.assertAlmostEqual(estimateBackgroundNoise(echo.astype(numpy.int32)),
+                           estimateBackgroundNoise(echo.astype(numpy.int16)), delta=0.02)
+
+  def test_Integer(self):
+    ## Exact statistics of the voxels below the cutoff; negative values are not counted
+    array = numpy.concatenate([numpy.repeat(numpy.arange(1, 12), 10), [-5, 500, 900]])
+    for dtype in (numpy.uint8, numpy.int16, numpy.dtype('>i2'), numpy.uint16):
+      if dtype == numpy.uint8:
+        values = array[(array >= 0) & (array < 256)]
+      else:
+        values = array
+      statistics = backgroundNoiseStatistics(values.astype(dtype).reshape(1, 1, -1))
+      background = values[(values >= 0) & (values < 100)]
+      self.assertEqual(statistics['count'], len(background))
+      self.assertAlmostEqual(statistics['mean'], numpy.mean(background))
+      self.assertAlmostEqual(statistics['sigma'], numpy.std(background, ddof=1))
+
+  def test_Empty(self):
+    for array in (numpy.zeros(SHAPE), numpy.zeros(SHAPE, dtype=numpy.int16), -numpy.ones(SHAPE, dtype=numpy.int16)):
+      self.assertEqual(backgroundNoiseStatistics(array), {'mean': 0.0, 'sigma': 0.0, 'count': 0})
+
+
+class PrecisionTest(unittest.TestCase):
+  """
+  The Float32 maps against the Float64 maps, and the equivalence check of the
+  precision harness
+  """
+
+  def setUp(self):
+    logging.disable(logging.ERROR)
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    logging.disable(logging.NOTSET)
+
+  def test_ComputeMapsFloat32(self):
+    parameters = mapsParameters(makePhantom())
+    reference = computeMaps(*parameters)
+    maps = computeMapsChunked(*(parameters + (None,)), threads=2, dtype=numpy.float32)
+    maps32 = computeMaps(*parameters, dtype=numpy.float32)
+    for (array, array32, referenceArray) in zip(maps, maps32, reference):
+      self.assertEqual(array.dtype, numpy.float32)
+      numpy.testing.assert_array_equal(array, array32)
+      finite = numpy.isfinite(referenceArray)
+      numpy.testing.assert_allclose(array[finite], referenceArray[finite], rtol=1e-4, atol=1e-6)
+
+  def test_CompareVoxels(self):
+    reference = numpy.array([1.0, 2.0, 0.0, 4.0, 5.0])
+    test = numpy.array([1.5, 2.0, 3.0, 0.0, 100.0], dtype=numpy.float32)
+    ## Voxels 2 and 3 are thresholded in one map only; voxel 4 is masked in both
+    special = [(reference == 0.0, test == 0.0), (numpy.arange(5) == 4, numpy.arange(5) == 4)]
+    self.assertEqual(compareVoxels(reference, test, special), (0.5, 2))
+    self.assertEqual(compareVoxels(reference, test, special, numpy.arange(5) > 0), (0.0, 2))
+    ## The mismatched voxels fail the check at any deviation
+    self.assertTrue(isEquivalent({'maxTempDeviation': 0.05, 'mismatchedVoxels': 0}))
+    self.assertFalse(isEquivalent({'maxTempDeviation': 0.0, 'mismatchedVoxels': 2}))
+    self.assertTrue(isEquivalent({'maxTempDeviation': 0.0, 'mismatchedVoxels': 2}, maxMismatchedVoxels=2))
+    self.assertFalse(isEquivalent({'maxTempDeviation': 0.2, 'mismatchedVoxels': 0}))
+
+  def test_Main(self):
+    path = os.path.join(self.directory, 'precision.json')
+    arguments = ['--sizes', '28x32x24', '--repeat', '1', '--output', path]
+    self.assertEqual(precisionMain(arguments), 0)
+    with open(path) as f:
+      report = json.load(f)
+    self.assertTrue(report['equivalent'])
+    (result,) = report['results']
+    self.assertEqual(result['mismatchedVoxels'], 0)
+    self.assertTrue(0.0 < result['maxTempDeviation'] <= 0.1)
+    self.assertEqual(precisionMain(arguments + ['--tolerance', '0']), 1)
+
+
+class CacheTest(unittest.TestCase):
+  """
+  The LRU order and byte budget of the intermediate cache, and the cached R2* map
+  against computeMaps()
+  """
+
+  def test_LRU(self):
+    cache = IntermediateCache(3 * 800)
+    for key in 'abc':
+      cache.put(key, numpy.zeros(100))
+    self.assertEqual(cache.statistics()['bytes'], 3 * 800)
+    ## 'a' becomes the most recently used, so 'b' is evicted first
+    self.assertTrue(cache.get('a') is not None)
+    cache.put('d', numpy.zeros(100))
+    self.assertEqual([key in cache for key in 'abcd'], [True, False, True, True])
+    ## A tuple of arrays counts all of its bytes, and evicts the least recently used 'c'
+    cache.put('e', (numpy.zeros(50), numpy.zeros(50, dtype=numpy.float32), numpy.zeros(25)))
+    self.assertEqual([key in cache for key in 'acde'], [True, False, True, True])
+    self.assertEqual(cache.statistics()['bytes'], 2 * 800 + 400 + 200 + 200)
+    self.assertEqual(len(cache), 3)
+    self.assertTrue(cache.get('b') is None)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    ## Cached arrays are read-only
+    self.assertRaises(ValueError, cache.get('a').fill, 1.0)
+
+  def test_Budget(self):
+    cache = IntermediateCache(1000)
+    cache.put('small', numpy.zeros(100))
+    ## A value larger than the whole budget is not cached, and does not evict anything
+    value = numpy.zeros(200)
+    self.assertTrue(cache.put('large', value) is value)
+    self.assertFalse('large' in cache)
+    self.assertTrue('small' in cache)
+    ## Replacing a key frees the old value
+    cache.put('small', numpy.zeros(50))
+    self.assertEqual(cache.statistics()['bytes'], 400)
+    cache.put('other', numpy.zeros(50))
+    cache.setByteBudget(500)
+    self.assertEqual((len(cache), 'other' in cache, cache.statistics()['bytes']), (1, True, 400))
+    cache.clear()
+    self.assertEqual((len(cache), cache.statistics()['bytes']), (0, 0))
+
+  def test_ContentKey(self):
+    array = numpy.arange(60.0).reshape(3, 4, 5)
+    self.assertEqual(contentKey(array), contentKey(array.copy()))
+    self.assertEqual(contentKey(array[:, 1:3]), contentKey(numpy.ascontiguousarray(array[:, 1:3])))
+    self.assertNotEqual(contentKey(array), contentKey(array.astype(numpy.float32)))
+    changed = array.copy()
+    changed[2, 3, 4] += 1.0
+    self.assertNotEqual(contentKey(array), contentKey(changed))
+
+  def test_ComputeR2StarCached(self):
+    phantom = makePhantom()
+    cache = IntermediateCache(64 * 1024 * 1024)
+    for outputThreshold in (None, (-100.0, 1000.0), None):
+      for inputThreshold in ((20.0, 20.0), (40.0, 10.0), None):
+        for threads in (1, 3):
+          parameters = mapsParameters(phantom, outputThreshold, inputThreshold)
+          reference = computeMaps(*parameters, computeT2Star=False)[1]
+          numpy.testing.assert_array_equal(computeR2StarCached(cache, *parameters, threads=threads), reference)
+    self.assertTrue(cache.hits > 0)
+    ## The temperature map only recomputes the calibration
+    parameters = (phantom['echo1'], phantom['echo2'], TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'],
+                  (20.0, 20.0), MIN_T2S, PARAM_A, PARAM_B, (-40.0, 40.0))
+    numpy.testing.assert_array_equal(computeTempFromEchoesCached(cache, *parameters),
+                                     computeTempFromEchoes(*parameters))
+
+
+class UnthresholdedMapTest(unittest.TestCase):
+  """
+  The maps re-thresholded from a kept map against the maps recomputed with the new
+  output threshold and fill values
+  """
+
+  def regions(self):
+    labelArray = numpy.zeros(SHAPE, dtype=numpy.uint8)
+    labelArray[3:20, 5:29, 2:24] = 1
+    labelArray[3:8, 5:10, 2:6] = 0
+    return (None, Region(SHAPE, boundingBox=((2, 20), (4, 30), (3, 25))), Region(SHAPE, labelArray))
+
+  def test_Rethreshold(self):
+    phantom = makePhantom()
+    for region in self.regions():
+      crop = (lambda array: array) if region is None else region.crop
+      (echo1, echo2) = (crop(phantom['echo1']), crop(phantom['echo2']))
+      mask = numpy.empty(echo1.shape, dtype=numpy.bool_)
+      maps = computeMaps(echo1, echo2, TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'], None, (20.0, 20.0),
+                         MIN_T2S, outMask=mask)
+      kept = [UnthresholdedMap(array, mask, region) for array in maps]
+      for (outputThreshold, minT2s, regionFillValue) in ((None, MIN_T2S, 0.0), ((0.0, 300.0), 0.002, -1.0),
+                                                         ((0.001, 0.05), 0.0, 7.0)):
+        expected = computeMaps(echo1, echo2, TE1, TE2, phantom['scaleFactor'], phantom['noiseLevel'],
+                               outputThreshold, (20.0, 20.0), minT2s)
+        fillValues = (minT2s, 1/minT2s if minT2s > 0 else 0.0)
+        for (unthresholded, expectedMap, fillValue) in zip(kept, expected, fillValues):
+          out = numpy.full(SHAPE, numpy.nan)
+          self.assertTrue(unthresholded.matches(out))
+          self.assertTrue(unthresholded.apply(out, outputThreshold, fillValue, regionFillValue) is out)
+          reference = numpy.full(SHAPE, numpy.nan)
+          crop(reference)[...] = expectedMap
+          if region is not None:
+            region.fillOutside(reference, regionFillValue)
+          numpy.testing.assert_array_equal(out, reference)
+
+  def test_RelativeTemp(self):
+    ## The mask of the pixels where both R2* maps are valid takes the fill value
+    phantom = makePhantom()
+    baseline = computeMaps(*mapsParameters(phantom), computeT2Star=False)[1]
+    reference = numpy.clip(baseline + numpy.linspace(0.0, 50.0, baseline.size).reshape(SHAPE), 0.0, None)
+    prepared = PreparedBaseline(baseline, PARAM_A, PARAM_B, (0.0, 500.0))
+    mask = numpy.empty(SHAPE, dtype=numpy.bool_)
+    unthresholded = UnthresholdedMap(computeTempFromBaseline(prepared, reference, None, -40.0, outMask=mask), mask)
+    for (outputThreshold, fillValue) in (((-40.0, 40.0), -40.0), (None, 100.0), ((0.0, 10.0), 0.0)):
+      out = numpy.empty(SHAPE)
+      unthresholded.apply(out, outputThreshold, fillValue)
+      numpy.testing.assert_array_equal(out, computeTempFromBaseline(prepared, reference, outputThreshold, fillValue))
+
+  def test_Matches(self):
+    region = self.regions()[1]
+    unthresholded = UnthresholdedMap(numpy.zeros(region.boxShape), None, region)
+    self.assertTrue(unthresholded.matches(numpy.zeros(SHAPE)))
+    self.assertFalse(unthresholded.matches(numpy.zeros(region.boxShape)))
+    self.assertFalse(unthresholded.matches(numpy.zeros(SHAPE, dtype=numpy.float32)))
+    self.assertFalse(unthresholded.matches(None))
+    self.assertTrue(UnthresholdedMap(numpy.zeros(SHAPE)).matches(numpy.zeros(SHAPE)))
+
+
+class CalibrationStoreTest(unittest.TestCase):
+  """
+  The scale factors and noise levels kept per protocol in the calibration store
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'store', 'calibration.json')
+    self.protocol = makeProtocol(TE1, TE2, (28, 32, 24), 'scanner-1')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_RoundTrip(self):
+    store = CalibrationStore(self.path)
+    self.assertEqual((store.scaleFactor(self.protocol, SCALE_CALIBRATION_R2S), store.noiseLevel(self.protocol, "SD")),
+                     (None, None))
+    statistics = labelStatistics([numpy.arange(24.0).reshape(2, 3, 4)] * 2, numpy.ones((2, 3, 4), dtype=numpy.int8))
+    store.storeScaleFactor(self.protocol, 0.79, SCALE_CALIBRATION_R2S, statistics)
+    store.storeNoiseLevel(self.protocol, [10.5, numpy.float32(11.0)], "SD")
+    ## A new session reads the file
+    store = CalibrationStore(self.path)
+    self.assertEqual(store.scaleFactor(self.protocol, SCALE_CALIBRATION_R2S), 0.79)
+    self.assertEqual(store.noiseLevel(self.protocol, "SD"), [10.5, 11.0])
+    self.assertEqual(store.noiseLevel(self.protocol, "Mean"), None)
+    self.assertEqual(store.lookup(self.protocol)['scaleFactor']['statistics'][0]['1']['count'], 24)
+    ## Another protocol (scanner, echo time or matrix) has its own entry
+    for protocol in (makeProtocol(TE1, TE2, (28, 32, 24)), makeProtocol(TE1, 0.003, (28, 32, 24), 'scanner-1'),
+                     makeProtocol(TE1, TE2, (28, 32, 25), 'scanner-1')):
+      self.assertEqual(store.lookup(protocol), None)
+    self.assertEqual(store.lookup(makeProtocol(TE1 * (1.0 + 1e-12), TE2, (28, 32, 24), 'scanner-1'))['protocol'],
+                     self.protocol)
+    store.remove(self.protocol)
+    self.assertEqual(CalibrationStore(self.path).lookup(self.protocol), None)
+
+  def test_Merge(self):
+    ## Two sessions write the same file; neither loses the entries of the other
+    (first, second) = (CalibrationStore(self.path), CalibrationStore(self.path))
+    other = makeProtocol(TE1, TE2, (64, 64, 16), 'scanner-2')
+    self.assertEqual(first.lookup(self.protocol), None)
+    self.assertEqual(second.lookup(other), None)
+    first.storeScaleFactor(self.protocol, 0.8, SCALE_CALIBRATION_R2S)
+    second.storeNoiseLevel(other, [5.0, 6.0], "Mean")
+    second.storeNoiseLevel(self.protocol, [7.0, 8.0], "SD")
+    first.storeNoiseLevel(self.protocol, [9.0, 10.0], "Mean")
+    store = CalibrationStore(self.path)
+    self.assertEqual(store.scaleFactor(self.protocol, SCALE_CALIBRATION_R2S), 0.8)
+    self.assertEqual(store.noiseLevel(self.protocol, "SD"), [7.0, 8.0])
+    self.assertEqual(store.noiseLevel(self.protocol, "Mean"), [9.0, 10.0])
+    self.assertEqual(store.noiseLevel(other, "Mean"), [5.0, 6.0])
+    self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+  def test_ScaleCalibrationR2s(self):
+    ## A scale factor estimated for another calibration R2* is not used
+    store = CalibrationStore(self.path)
+    store.storeScaleFactor(self.protocol, 0.8, SCALE_CALIBRATION_R2S)
+    self.assertEqual(store.scaleFactor(self.protocol, SCALE_CALIBRATION_R2S * (1.0 + 1e-12)), 0.8)
+    self.assertEqual(store.scaleFactor(self.protocol, 100.0), None)
+    store.storeScaleFactor(self.protocol, 0.7, 100.0)
+    self.assertEqual(store.scaleFactor(self.protocol, 100.0), 0.7)
+    self.assertEqual(store.scaleFactor(self.protocol, SCALE_CALIBRATION_R2S), None)
+
+  def test_Corrupt(self):
+    os.makedirs(os.path.dirname(self.path))
+    for contents in ('{"protocols": ', '[1, 2]', '{"protocols": [1]}'):
+      with open(self.path, 'w') as f:
+        f.write(contents)
+      store = CalibrationStore(self.path)
+      self.assertRaises(ValueError, store.lookup, self.protocol)
+      self.assertRaises(ValueError, store.storeNoiseLevel, self.protocol, [1.0, 1.0], "SD")
+      ## The file is not overwritten
+      with open(self.path) as f:
+        self.assertEqual(f.read(), contents)
+
+
+@unittest.skipIf(sitk is None, 'SimpleITK is not installed')
+class VolumeIOTest(unittest.TestCase):
+  """
+  Memory-mapped NRRD files against the SimpleITK reader
+  """
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def checkMapVolume(self, path):
+    (reference, referenceGeometry) = readVolume(path)
+    (mapped, mappedGeometry) = mapVolume(path)
+    self.assertEqual(mapped.shape, reference.shape)
+    numpy.testing.assert_array_equal(mapped, reference)
+    for key in ('spacing', 'origin', 'direction'):
+      numpy.testing.assert_allclose(mappedGeometry[key], referenceGeometry[key], rtol=0.0, atol=1e-9)
+    self.assertFalse(mapped.flags.writeable)
+    return mapped
+
+  def writeAndCheck(self, fileName, array):
+    path = os.path.join(self.directory, fileName)
+    geometry = {'spacing': (0.5, 0.75, 2.0), 'origin': (-10.0, 20.0, 5.5),
+                'direction': (0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0)}
+    writeVolume(path, array, geometry)
+    numpy.testing.assert_array_equal(self.checkMapVolume(path), array)
+
+  def test_MapAttached(self):
+    phantom = makePhantom()
+    self.writeAndCheck('echo1.nrrd', phantom['echo1'])
+    self.writeAndCheck('noise.nrrd', phantom['noiseROI'])
+    self.writeAndCheck('temp.nrrd', phantom['temp'])
+
+  def test_MapDetached(self):
+    phantom = makePhantom()
+    self.writeAndCheck('echo2.nhdr', phantom['echo2'])
+    self.writeAndCheck('counts.nhdr', (phantom['echo1'] * 10).astype(numpy.int16))
+
+  def test_MapHeaderFields(self):
+    ## Big-endian data at the end of a detached file, in RAS space, with comments and key/value pairs
+    array = numpy.arange(2 * 3 * 4, dtype=numpy.int16).reshape(2, 3, 4) - 7
+    with open(os.path.join(self.directory, 'data.raw'), 'wb') as f:
+      f.write(b'junk' + array.astype('>i2').tobytes())
+    path = os.path.join(self.directory, 'header.nhdr')
+    with open(path, 'w') as f:
+      f.write('NRRD0004\n# comment\ntype: short\ndimension: 3\nspace: right-anterior-superior\n'
+              'sizes: 4 3 2\nspace directions: (0,1.5,0) (-1,0,0) (0,0,2)\nkinds: domain domain domain\n'
+              'endian: big\nencoding: raw\nbyte skip: -1\nspace origin: (1,2,3)\nnote:=value\n'
+              'data file: data.raw\n')
+    mapped = self.checkMapVolume(path)
+    numpy.testing.assert_array_equal(mapped, array)
+    geometry = mapVolume(path)[1]
+    self.assertEqual(geometry['origin'], (-1.0, -2.0, 3.0))
+    self.assertEqual(geometry['spacing'], (1.5, 1.0, 2.0))
+
+  def test_CompressedNotMapped(self):
+    path = os.path.join(self.directory, 'compressed.nrrd')
+    echo = makePhantom()['echo1']
+    writeVolume(path, echo, None, True)
+    self.assertRaises(ValueError, mapVolume, path)
+    ## openVolume() reads the file instead
+    (array, geometry) = openVolume(path)
+    numpy.testing.assert_array_equal(array, echo)
+    self.assertTrue(array.flags.writeable)
+
+
+def run(testCases=None, verbosity=1):
+  """
+  Run the tests of the given TestCase classes (default: all tests of this module) and
+  return the unittest.TestResult
+  """
+  loader = unittest.TestLoader()
+  if testCases is None:
+    suite = loader.loadTestsFromModule(sys.modules[__name__])
+  else:
+    suite = unittest.TestSuite([loader.loadTestsFromTestCase(testCase) for testCase in testCases])
+  return unittest.TextTestRunner(stream=sys.stderr, verbosity=verbosity).run(suite)
+
+
+def main(argv=None):
+  return 0 if run(verbosity=2).wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,56 @@
+import numpy
+
+from .Kernels import allocateFlags, finalizeMap
+
+__all__ = ['UnthresholdedMap']
+
+
+class UnthresholdedMap(object):
+  """
+  A map kept before the final clamp stage of its pipeline, so that the output threshold
+  and the fill values can be changed without recomputing the map. The clamp stage is
+  the same in all modules: the voxels outside the validity mask take fillValue, the
+  voxels outside the output threshold range are set to 0 (finalizeMap()), and the
+  voxels outside the region take regionFillValue (Region.fillOutside()). The array and
+  the mask cover the bounding box of the region, if given, or the whole volume.
+  """
+
+  def __init__(self, array, mask=None, region=None):
+    self.array = array
+    self.mask = mask
+    self.region = region
+    self.shape = array.shape if region is None else region.shape
+    self.flags = None
+
+  def matches(self, out):
+    """
+    True if out is a full-size map of the same type
+    """
+    return out is not None and out.shape == self.shape and out.dtype == self.array.dtype
+
+  def apply(self, out, outputThreshold, fillValue=0.0, regionFillValue=0.0):
+    """
+    Clamp the map into the full-size array out; returns out. The result is the same as
+    that of the pipeline run with these parameters.
+    """
+    if self.flags is None:
+      self.flags = allocateFlags(self.array.shape)
+    box = out if self.region is None else self.region.crop(out)
+    numpy.copyto(box, self.array)
+    finalizeMap(box, self.mask, fillValue, outputThreshold, self.flags)
+    if self.region is not None:
+      self.region.fillOutside(out, regionFillValue)
+    return out
+
+  def filter(self, temporalFilter, record=None):
+    """
+    The map filtered over time with a TemporalFilter, before the clamp stage. The
+    voxels outside the mask and the region do not enter the filter, which holds their
+    state, so that the fill values are never blended into the filtered map. Returns an
+    UnthresholdedMap of the filter state (overwritten by the next frame).
+    """
+    mask = self.mask
+    if self.region is not None and self.region.outside is not None:
+      inside = numpy.logical_not(self.region.outside)
+      mask = inside if mask is None else numpy.logical_and(mask, inside, out=inside)
+    return UnthresholdedMap(temporalFilter.update(self.array, record, mask), self.mask, self.region)
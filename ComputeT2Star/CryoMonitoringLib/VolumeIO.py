@@ -0,0 +1,193 @@
+import os
+import re
+
+import numpy
+
+__all__ = ['readVolume', 'writeVolume', 'readNrrdHeader', 'mapVolume', 'openVolume']
+
+#
+# Volume file I/O for processing outside Slicer. Images are read and written with
+# SimpleITK, which is only imported when these functions are used. Uncompressed NRRD
+# files can be memory-mapped instead (mapVolume()), without SimpleITK.
+#
+
+## NRRD type names (see http://teem.sourceforge.net/nrrd/format.html#type)
+NRRD_TYPES = dict([(name, typeCode) for (names, typeCode) in [
+    (('signed char', 'int8', 'int8_t'), 'i1'),
+    (('uchar', 'unsigned char', 'uint8', 'uint8_t'), 'u1'),
+    (('short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'), 'i2'),
+    (('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'), 'u2'),
+    (('int', 'signed int', 'int32', 'int32_t'), 'i4'),
+    (('uint', 'unsigned int', 'uint32', 'uint32_t'), 'u4'),
+    (('longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t'), 'i8'),
+    (('ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'), 'u8'),
+    (('float',), 'f4'),
+    (('double',), 'f8'),
+    ] for name in names])
+
+## Signs that convert the axes of a NRRD space to LPS (the space of ITK)
+NRRD_SPACES = {
+  'left-posterior-superior': (1.0, 1.0, 1.0), 'lps': (1.0, 1.0, 1.0),
+  'right-anterior-superior': (-1.0, -1.0, 1.0), 'ras': (-1.0, -1.0, 1.0),
+  'left-anterior-superior': (1.0, -1.0, 1.0), 'las': (1.0, -1.0, 1.0),
+  }
+
+
+def readVolume(path):
+  """
+  Read a scalar volume. Returns (array in (k, j, i) order, geometry), where geometry is
+  a dictionary with 'spacing', 'origin' and 'direction' (as in SimpleITK/ITK, LPS).
+  """
+  import SimpleITK as sitk
+  image = sitk.ReadImage(path)
+  geometry = {
+    'spacing': image.GetSpacing(),
+    'origin': image.GetOrigin(),
+    'direction': image.GetDirection(),
+    }
+  return (sitk.GetArrayFromImage(image), geometry)
+
+
+def writeVolume(path, array, geometry=None, useCompression=False):
+  """
+  Write an array in (k, j, i) order as a volume with the given geometry (see readVolume()).
+  """
+  import SimpleITK as sitk
+  image = sitk.GetImageFromArray(numpy.ascontiguousarray(array))
+  if geometry:
+    image.SetSpacing(geometry['spacing'])
+    image.SetOrigin(geometry['origin'])
+    image.SetDirection(geometry['direction'])
+  sitk.WriteImage(image, path, useCompression)
+
+
+def readNrrdHeader(path):
+  """
+  Read the header of a NRRD file (attached, or detached as in a .nhdr file). Returns
+  (fields as a dictionary with lower-case keys, byte offset of the data that follows
+  the header in the same file).
+  """
+  fields = {}
+  with open(path, 'rb') as f:
+    magic = f.readline()
+    if not magic.startswith(b'NRRD'):
+      raise ValueError("'%s' is not a NRRD file." % path)
+    while True:
+      line = f.readline()
+      if not line or not line.strip():
+        break
+      line = line.decode('latin-1').rstrip('\r\n')
+      ## Comments and key/value pairs ('key:=value') do not describe the data
+      if line.startswith('#') or ':=' in line:
+        continue
+      (key, separator, value) = line.partition(': ')
+      if not separator:
+        raise ValueError("Invalid NRRD header line '%s' in '%s'." % (line, path))
+      fields[key.strip().lower()] = value.strip()
+    return (fields, f.tell())
+
+
+def _nrrdVectors(value):
+  ## '(x,y,z) (x,y,z) none' -> [[x, y, z], [x, y, z], None]
+  vectors = []
+  for item in re.findall(r'\([^)]*\)|none', value):
+    vectors.append(None if item == 'none' else [float(x) for x in item[1:-1].split(',')])
+  return vectors
+
+
+def _nrrdGeometry(fields, dimension):
+  ## Geometry in LPS as readVolume(), from the space or the per-axis fields of the header
+  signs = numpy.ones(3)
+  if 'space' in fields:
+    space = fields['space'].lower()
+    if space not in NRRD_SPACES:
+      raise ValueError("Unsupported NRRD space '%s'." % fields['space'])
+    signs = numpy.array(NRRD_SPACES[space])
+  if 'space directions' in fields:
+    directions = _nrrdVectors(fields['space directions'])
+    if len(directions) != dimension or None in directions:
+      raise ValueError("Unsupported NRRD space directions '%s'." % fields['space directions'])
+    ## Columns are the directions of the i, j and k axes
+    axes = numpy.array(directions).T * signs[:, numpy.newaxis]
+  else:
+    spacings = [1.0] * dimension
+    if 'spacings' in fields:
+      spacings = [1.0 if value.lower() == 'nan' else float(value) for value in fields['spacings'].split()]
+    axes = numpy.diag(spacings)
+  spacing = numpy.sqrt((axes * axes).sum(axis=0))
+  origin = numpy.zeros(3)
+  if 'space origin' in fields:
+    origin = numpy.array(_nrrdVectors(fields['space origin'])[0]) * signs
+  return {
+    'spacing': tuple([float(x) for x in spacing]),
+    'origin': tuple([float(x) for x in origin]),
+    'direction': tuple([float(x) for x in (axes / spacing).ravel()]),
+    }
+
+
+def mapVolume(path):
+  """
+  Memory-map the voxels of an uncompressed (raw encoding) 3D NRRD file, with the data
+  attached to the header or in a single detached data file (.nhdr). Returns
+  (read-only array in (k, j, i) order, geometry) as readVolume(). Nothing is read until
+  the voxels are accessed, so slabs of the array only read their slices, and processes
+  that map the same file share its pages in the OS page cache. Raises ValueError for
+  other files (see openVolume()).
+  """
+  (fields, dataOffset) = readNrrdHeader(path)
+  for key in ('type', 'dimension', 'sizes', 'encoding'):
+    if key not in fields:
+      raise ValueError("The NRRD header of '%s' has no '%s' field." % (path, key))
+  if fields['encoding'].lower() != 'raw':
+    raise ValueError("The NRRD data of '%s' is not raw (encoding '%s')." % (path, fields['encoding']))
+  dimension = int(fields['dimension'])
+  sizes = [int(size) for size in fields['sizes'].split()]
+  if dimension != 3 or len(sizes) != 3:
+    raise ValueError("'%s' is not a 3D scalar volume." % path)
+  typeName = fields['type'].lower()
+  if typeName not in NRRD_TYPES:
+    raise ValueError("Unsupported NRRD type '%s'." % fields['type'])
+  dtype = numpy.dtype(NRRD_TYPES[typeName])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('>' if fields.get('endian', 'little').lower() == 'big' else '<')
+
+  dataPath = path
+  dataFile = fields.get('data file', fields.get('datafile'))
+  if dataFile is not None:
+    if dataFile.startswith('LIST') or len(dataFile.split()) > 1:
+      raise ValueError("The NRRD data of '%s' is split into several files." % path)
+    dataPath = dataFile
+    if not os.path.isabs(dataPath):
+      dataPath = os.path.join(os.path.dirname(os.path.abspath(path)), dataFile)
+    dataOffset = 0
+
+  ## Lines, then bytes to skip before the data; a byte skip of -1 places the data at the end of the file
+  lineSkip = int(fields.get('line skip', fields.get('lineskip', 0)))
+  if lineSkip > 0:
+    with open(dataPath, 'rb') as f:
+      f.seek(dataOffset)
+      for n in range(lineSkip):
+        f.readline()
+      dataOffset = f.tell()
+  byteSkip = int(fields.get('byte skip', fields.get('byteskip', 0)))
+  shape = tuple(sizes[::-1])
+  if byteSkip == -1:
+    dataOffset = os.path.getsize(dataPath) - int(numpy.prod(shape)) * dtype.itemsize
+  else:
+    dataOffset += byteSkip
+
+  array = numpy.memmap(dataPath, dtype=dtype, mode='r', offset=dataOffset, shape=shape)
+  return (array, _nrrdGeometry(fields, dimension))
+
+
+def openVolume(path):
+  """
+  Read a scalar volume as readVolume(), memory-mapped if it is an uncompressed NRRD
+  file (see mapVolume())
+  """
+  if path.lower().endswith(('.nrrd', '.nhdr')):
+    try:
+      return mapVolume(path)
+    except ValueError:
+      pass
+  return readVolume(path)
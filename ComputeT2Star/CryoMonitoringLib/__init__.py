@@ -0,0 +1,24 @@
+#
+# CryoMonitoringLib
+#
+# Slicer-independent T2*/R2*/temperature computation for the CryoMonitoring modules.
+# All functions take and return NumPy arrays in (k, j, i) order, so that the library
+# can be imported and run without Slicer (e.g. headless on a compute node).
+#
+
+from .Kernels import *
+from .Instrumentation import *
+from .Statistics import *
+from .T2Star import *
+from .Noise import *
+from .Region import *
+from .Thresholding import *
+from .Calibration import *
+from .CalibrationStore import *
+from .Temperature import *
+from .Isotherm import *
+from .TemporalFilter import *
+from .Chunking import *
+from .Series import *
+from .Cache import *
+from .VolumeIO import *
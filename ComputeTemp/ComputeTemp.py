@@ -3,12 +3,14 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import SimpleITK as sitk
-import sitkUtils
 import ComputeT2Star
-import LabelStatistics
+import CryoMonitoringLib
+from CryoMonitoringLib import SlicerBridge
+from CryoMonitoringLib import LiveMonitor
+from CryoMonitoringLib import BackgroundRunner
 import numpy
 import math
+import multiprocessing
 
 #
 # ComputeTemp
@@ -143,6 +145,21 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.scaleEstimationROISelector.setToolTip( "ROI for scaling factor estimation" )
     ioFormLayout.addRow("Scale ROI: ", self.scaleEstimationROISelector)
 
+    #
+    # Monitoring region selector
+    #
+    self.regionSelector = slicer.qMRMLNodeComboBox()
+    self.regionSelector.nodeTypes = ( ("vtkMRMLLabelMapVolumeNode"), ("vtkMRMLAnnotationROINode"), ("vtkMRMLMarkupsROINode"), "" )
+    self.regionSelector.selectNodeUponCreation = False
+    self.regionSelector.addEnabled = False
+    self.regionSelector.removeEnabled = False
+    self.regionSelector.noneEnabled = True
+    self.regionSelector.showHidden = False
+    self.regionSelector.showChildNodeTypes = False
+    self.regionSelector.setMRMLScene( slicer.mrmlScene )
+    self.regionSelector.setToolTip( "Label map or ROI box that limits the computation (e.g. the iceball and its margin). If not set, the whole volume is processed." )
+    ioFormLayout.addRow("Monitoring Region: ", self.regionSelector)
+
     #
     # tempMap volume selector
     #
@@ -224,6 +241,11 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
 
     self.NoiseCorrectionOff.setChecked(True)
 
+    self.autoNoiseFlagCheckBox = qt.QCheckBox()
+    self.autoNoiseFlagCheckBox.checked = 0
+    self.autoNoiseFlagCheckBox.setToolTip("If checked and no noise ROI is selected, estimate the noise levels from the background air in the histogram of each echo (once per series).")
+    parametersFormLayout.addRow("Automatic Noise Estimation", self.autoNoiseFlagCheckBox)
+
     #self.useNoiseCorrectionFlagCheckBox = qt.QCheckBox()
     #self.useNoiseCorrectionFlagCheckBox.checked = 1
     #self.useNoiseCorrectionFlagCheckBox.setToolTip("If checked, correct noise based on the estimated noise level.")
@@ -305,6 +327,15 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.paramBSpinBox.setToolTip("TE for Input Volume 2")
     parametersFormLayout.addRow("Param B: ", self.paramBSpinBox)
 
+    #
+    # Nonlinear calibration curve
+    #
+    self.calibrationPathLineEdit = ctk.ctkPathLineEdit()
+    self.calibrationPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.calibrationPathLineEdit.nameFilters = ["Calibration curve (*.csv *.json)"]
+    self.calibrationPathLineEdit.setToolTip("CSV file (R2*, temperature) or JSON file (points or polynomial) of the R2* to temperature curve. If set, the curve replaces the linear model (Param A/B).")
+    parametersFormLayout.addRow("Calibration Curve: ", self.calibrationPathLineEdit)
+
     #
     #
     self.scaleCalibrationR2sSpinBox = qt.QDoubleSpinBox()
@@ -315,6 +346,18 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.scaleCalibrationR2sSpinBox.setValue(129.565)
     self.scaleCalibrationR2sSpinBox.setToolTip("Scale Calibration")
     parametersFormLayout.addRow("Scale Clibration R2* (s^-1): ", self.scaleCalibrationR2sSpinBox)
+
+    #
+    # Calibration store
+    #
+    self.useCalibrationStoreFlagCheckBox = qt.QCheckBox()
+    self.useCalibrationStoreFlagCheckBox.checked = 1
+    self.useCalibrationStoreFlagCheckBox.setToolTip("If checked, the scale factor and noise levels estimated from the ROIs are stored for the protocol (TE1, TE2, matrix and scanner), and the stored values are used when no ROI is selected.")
+    parametersFormLayout.addRow("Use Calibration Store", self.useCalibrationStoreFlagCheckBox)
+
+    self.scannerIDLineEdit = qt.QLineEdit()
+    self.scannerIDLineEdit.setToolTip("Scanner ID of the protocol in the calibration store. If empty, it is read from the DICOM header of echo 1 (manufacturer/model/serial number).")
+    parametersFormLayout.addRow("Scanner ID: ", self.scannerIDLineEdit)
    
     #
     # Limit value range? 
@@ -348,6 +391,60 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.lowerOutputThresholdSpinBox.setToolTip("Lower threshold for the output")
     parametersFormLayout.addRow("Lower OutputThreshold: ", self.lowerOutputThresholdSpinBox)
 
+    #
+    # Fill value outside the monitoring region
+    #
+    self.regionFillValueSpinBox = qt.QDoubleSpinBox()
+    self.regionFillValueSpinBox.objectName = 'regionFillValueSpinBox'
+    self.regionFillValueSpinBox.setMaximum(1000.0)
+    self.regionFillValueSpinBox.setMinimum(-1000.0)
+    self.regionFillValueSpinBox.setDecimals(2)
+    self.regionFillValueSpinBox.setValue(0.0)
+    self.regionFillValueSpinBox.setToolTip("Temperature for the voxels outside the monitoring region")
+    parametersFormLayout.addRow("Fill Value Outside Region: ", self.regionFillValueSpinBox)
+
+    #
+    # Memory budget
+    #
+    self.memoryBudgetSpinBox = qt.QSpinBox()
+    self.memoryBudgetSpinBox.objectName = 'memoryBudgetSpinBox'
+    self.memoryBudgetSpinBox.setMaximum(1000000)
+    self.memoryBudgetSpinBox.setMinimum(0)
+    self.memoryBudgetSpinBox.setValue(0)
+    self.memoryBudgetSpinBox.setToolTip("Maximum memory for the intermediate images. The volume is processed in slabs of slices that fit into the budget (0: whole volume at once).")
+    parametersFormLayout.addRow("Memory Budget (MB): ", self.memoryBudgetSpinBox)
+
+    #
+    # Cache of the intermediate images
+    #
+    self.cacheBudgetSpinBox = qt.QSpinBox()
+    self.cacheBudgetSpinBox.objectName = 'cacheBudgetSpinBox'
+    self.cacheBudgetSpinBox.setMaximum(1000000)
+    self.cacheBudgetSpinBox.setMinimum(0)
+    self.cacheBudgetSpinBox.setValue(1024)
+    self.cacheBudgetSpinBox.setToolTip("Memory for keeping the noise-corrected echoes, log-ratio, mask and R2* map between runs, so that changing the calibration or thresholds only recomputes the stages that depend on them (0: no cache). Not used with a memory budget.")
+    parametersFormLayout.addRow("Cache Budget (MB): ", self.cacheBudgetSpinBox)
+
+    #
+    # Number of threads
+    #
+    self.threadsSpinBox = qt.QSpinBox()
+    self.threadsSpinBox.objectName = 'threadsSpinBox'
+    self.threadsSpinBox.setMaximum(256)
+    self.threadsSpinBox.setMinimum(1)
+    self.threadsSpinBox.setValue(multiprocessing.cpu_count())
+    self.threadsSpinBox.setToolTip("Number of threads. The volume is split into slabs that are processed in parallel.")
+    parametersFormLayout.addRow("Threads: ", self.threadsSpinBox)
+
+    #
+    # Precision
+    #
+    self.precisionComboBox = qt.QComboBox()
+    self.precisionComboBox.addItem("Float64")
+    self.precisionComboBox.addItem("Float32")
+    self.precisionComboBox.setToolTip("Pixel type of the computation and the output maps. Float32 halves the memory traffic; run 'python -m CryoMonitoringLib.Precision' for its deviation from Float64.")
+    parametersFormLayout.addRow("Precision: ", self.precisionComboBox)
+
     #
     # Apply Button
     #
@@ -356,17 +453,199 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # Cancel Button and status of the background computation
+    #
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Cancel the running computation."
+    self.cancelButton.enabled = False
+    parametersFormLayout.addRow(self.cancelButton)
+
+    self.statusLabel = qt.QLabel("Idle")
+    self.statusLabel.setToolTip("Stage of the computation running in the background")
+    parametersFormLayout.addRow("Status: ", self.statusLabel)
+
+    #
+    # Sequence Area
+    #
+    sequenceCollapsibleButton = ctk.ctkCollapsibleButton()
+    sequenceCollapsibleButton.text = "Sequence"
+    sequenceCollapsibleButton.collapsed = True
+    self.layout.addWidget(sequenceCollapsibleButton)
+    sequenceFormLayout = qt.QFormLayout(sequenceCollapsibleButton)
+
+    self.echo1SequenceSelector = slicer.qMRMLNodeComboBox()
+    self.echo1SequenceSelector.nodeTypes = ( ("vtkMRMLSequenceNode"), "" )
+    self.echo1SequenceSelector.selectNodeUponCreation = False
+    self.echo1SequenceSelector.addEnabled = False
+    self.echo1SequenceSelector.removeEnabled = False
+    self.echo1SequenceSelector.noneEnabled = True
+    self.echo1SequenceSelector.showHidden = False
+    self.echo1SequenceSelector.showChildNodeTypes = False
+    self.echo1SequenceSelector.setMRMLScene( slicer.mrmlScene )
+    self.echo1SequenceSelector.setToolTip( "Pick the sequence of the 1st echo images" )
+    sequenceFormLayout.addRow("Echo 1 Sequence: ", self.echo1SequenceSelector)
+
+    self.echo2SequenceSelector = slicer.qMRMLNodeComboBox()
+    self.echo2SequenceSelector.nodeTypes = ( ("vtkMRMLSequenceNode"), "" )
+    self.echo2SequenceSelector.selectNodeUponCreation = False
+    self.echo2SequenceSelector.addEnabled = False
+    self.echo2SequenceSelector.removeEnabled = False
+    self.echo2SequenceSelector.noneEnabled = True
+    self.echo2SequenceSelector.showHidden = False
+    self.echo2SequenceSelector.showChildNodeTypes = False
+    self.echo2SequenceSelector.setMRMLScene( slicer.mrmlScene )
+    self.echo2SequenceSelector.setToolTip( "Pick the sequence of the 2nd echo images" )
+    sequenceFormLayout.addRow("Echo 2 Sequence: ", self.echo2SequenceSelector)
+
+    self.tempMapSequenceSelector = slicer.qMRMLNodeComboBox()
+    self.tempMapSequenceSelector.nodeTypes = ( ("vtkMRMLSequenceNode"), "" )
+    self.tempMapSequenceSelector.selectNodeUponCreation = True
+    self.tempMapSequenceSelector.addEnabled = True
+    self.tempMapSequenceSelector.removeEnabled = True
+    self.tempMapSequenceSelector.noneEnabled = True
+    self.tempMapSequenceSelector.renameEnabled = True
+    self.tempMapSequenceSelector.showHidden = False
+    self.tempMapSequenceSelector.showChildNodeTypes = False
+    self.tempMapSequenceSelector.setMRMLScene( slicer.mrmlScene )
+    self.tempMapSequenceSelector.setToolTip( "Pick the output sequence of temperature maps" )
+    sequenceFormLayout.addRow("Output (Temp. Map Sequence): ", self.tempMapSequenceSelector)
+
+    self.applySequenceButton = qt.QPushButton("Apply to Sequence")
+    self.applySequenceButton.toolTip = "Compute the temperature maps of all frames, one frame at a time, with the scale factor and noise levels shown above. The region and the temporal filter are applied; the isotherms are not segmented."
+    self.applySequenceButton.enabled = False
+    sequenceFormLayout.addRow(self.applySequenceButton)
+
+    #
+    # Isotherms Area
+    #
+    isothermsCollapsibleButton = ctk.ctkCollapsibleButton()
+    isothermsCollapsibleButton.text = "Isotherms"
+    self.layout.addWidget(isothermsCollapsibleButton)
+    isothermsFormLayout = qt.QFormLayout(isothermsCollapsibleButton)
+
+    self.useIsothermsFlagCheckBox = qt.QCheckBox()
+    self.useIsothermsFlagCheckBox.checked = 0
+    self.useIsothermsFlagCheckBox.setToolTip("If checked, the isotherms are segmented and their volumes are computed after every temperature map.")
+    isothermsFormLayout.addRow("Extract Isotherms: ", self.useIsothermsFlagCheckBox)
+
+    self.isothermsLineEdit = qt.QLineEdit()
+    self.isothermsLineEdit.text = "0, -20, -40"
+    self.isothermsLineEdit.setToolTip("Comma-separated isotherms (deg C)")
+    isothermsFormLayout.addRow("Isotherms (C): ", self.isothermsLineEdit)
+
+    self.isothermLabelSelector = slicer.qMRMLNodeComboBox()
+    self.isothermLabelSelector.nodeTypes = ( ("vtkMRMLLabelMapVolumeNode"), "" )
+    self.isothermLabelSelector.selectNodeUponCreation = True
+    self.isothermLabelSelector.addEnabled = True
+    self.isothermLabelSelector.removeEnabled = True
+    self.isothermLabelSelector.noneEnabled = True
+    self.isothermLabelSelector.renameEnabled = True
+    self.isothermLabelSelector.showHidden = False
+    self.isothermLabelSelector.showChildNodeTypes = False
+    self.isothermLabelSelector.setMRMLScene( slicer.mrmlScene )
+    self.isothermLabelSelector.setToolTip( "Label map for the isotherm segmentation (label k: below the k-th isotherm)" )
+    isothermsFormLayout.addRow("Output (Isotherm Labels): ", self.isothermLabelSelector)
+
+    self.isothermModelsFlagCheckBox = qt.QCheckBox()
+    self.isothermModelsFlagCheckBox.checked = 0
+    self.isothermModelsFlagCheckBox.setToolTip("If checked, a surface model of each isotherm is generated for 3D display.")
+    isothermsFormLayout.addRow("Surface Models: ", self.isothermModelsFlagCheckBox)
+
+    self.isothermVolumesLabel = qt.QLabel("-")
+    self.isothermVolumesLabel.setToolTip("Volumes enclosed by the isotherms in the last temperature map.")
+    isothermsFormLayout.addRow("Volumes: ", self.isothermVolumesLabel)
+
+    #
+    # Live Monitoring Area
+    #
+    monitoringCollapsibleButton = ctk.ctkCollapsibleButton()
+    monitoringCollapsibleButton.text = "Live Monitoring"
+    self.layout.addWidget(monitoringCollapsibleButton)
+    monitoringFormLayout = qt.QFormLayout(monitoringCollapsibleButton)
+
+    #
+    # Check box to start/stop live monitoring
+    #
+    self.liveMonitoringFlagCheckBox = qt.QCheckBox()
+    self.liveMonitoringFlagCheckBox.checked = 0
+    self.liveMonitoringFlagCheckBox.enabled = False
+    self.liveMonitoringFlagCheckBox.setToolTip("If checked, the temperature map is recomputed every time both echo images are updated. The scale factor and noise levels are estimated once when monitoring starts.")
+    monitoringFormLayout.addRow("Live Monitoring: ", self.liveMonitoringFlagCheckBox)
+
+    #
+    # Temporal filter of the temperature maps
+    #
+    self.temporalFilterComboBox = qt.QComboBox()
+    self.temporalFilterComboBox.addItem("Off")
+    self.temporalFilterComboBox.addItem("EMA")
+    self.temporalFilterComboBox.addItem("Kalman")
+    self.temporalFilterComboBox.setToolTip("Per-voxel temporal filter of the temperature maps during live monitoring: exponential moving average (EMA) or Kalman filter.")
+    monitoringFormLayout.addRow("Temporal Filter: ", self.temporalFilterComboBox)
+
+    self.temporalFilterAlphaSpinBox = qt.QDoubleSpinBox()
+    self.temporalFilterAlphaSpinBox.objectName = 'temporalFilterAlphaSpinBox'
+    self.temporalFilterAlphaSpinBox.setMaximum(1.0)
+    self.temporalFilterAlphaSpinBox.setMinimum(0.01)
+    self.temporalFilterAlphaSpinBox.setDecimals(2)
+    self.temporalFilterAlphaSpinBox.setValue(0.5)
+    self.temporalFilterAlphaSpinBox.setToolTip("Weight of the new frame in the exponential moving average")
+    monitoringFormLayout.addRow("EMA Weight: ", self.temporalFilterAlphaSpinBox)
+
+    self.processVarianceSpinBox = qt.QDoubleSpinBox()
+    self.processVarianceSpinBox.objectName = 'processVarianceSpinBox'
+    self.processVarianceSpinBox.setMaximum(10000.0)
+    self.processVarianceSpinBox.setMinimum(0.0)
+    self.processVarianceSpinBox.setDecimals(4)
+    self.processVarianceSpinBox.setValue(1.0)
+    self.processVarianceSpinBox.setToolTip("Expected variance of the temperature change between frames (Kalman filter)")
+    monitoringFormLayout.addRow("Process Variance (C^2): ", self.processVarianceSpinBox)
+
+    self.measurementVarianceSpinBox = qt.QDoubleSpinBox()
+    self.measurementVarianceSpinBox.objectName = 'measurementVarianceSpinBox'
+    self.measurementVarianceSpinBox.setMaximum(10000.0)
+    self.measurementVarianceSpinBox.setMinimum(0.0001)
+    self.measurementVarianceSpinBox.setDecimals(4)
+    self.measurementVarianceSpinBox.setValue(4.0)
+    self.measurementVarianceSpinBox.setToolTip("Variance of the noise of a single temperature map (Kalman filter)")
+    monitoringFormLayout.addRow("Measurement Variance (C^2): ", self.measurementVarianceSpinBox)
+
+    self.latencyLabel = qt.QLabel("-")
+    self.latencyLabel.setToolTip("End-to-end latency of the last frame (from the arrival of the echo images to the update of the temperature map).")
+    monitoringFormLayout.addRow("Frame Latency (s): ", self.latencyLabel)
+
+    self.logic = ComputeTempLogic()
+    self.logic.setKeepUnthresholded(True)
+    self.appliedClamp = None
+    self.runner = BackgroundRunner.BackgroundRunner(self.onProgress)
+    self.liveMonitor = None
+    self.liveCalibration = None
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+    self.applySequenceButton.connect('clicked(bool)', self.onApplySequenceButton)
+    self.echo1SequenceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.echo2SequenceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.tempMapSequenceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.echo1ImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.echo2ImageSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.noiseEstimationROISelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.NoiseCorrectionOff.connect('toggled(bool)', self.onSelect)
     self.NoiseCorrectionMean.connect('toggled(bool)', self.onSelect)
     self.NoiseCorrectionSD.connect('toggled(bool)', self.onSelect)
+    self.autoNoiseFlagCheckBox.connect('toggled(bool)', self.onSelect)
     self.scaleEstimationROISelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.tempMapSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onUseOutputThreshold)
+    self.liveMonitoringFlagCheckBox.connect('toggled(bool)', self.onLiveMonitoring)
+
+    # The output thresholds and region fill value are applied to the last temperature
+    # map as they are changed, without rerunning the computation
+    self.lowerOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.upperOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onOutputClampChanged)
+    self.regionFillValueSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -375,7 +654,9 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.stopLiveMonitoring()
+    self.runner.cancel()
+    CryoMonitoringLib.closeThreadPools()
 
   def onSelect(self):
     if self.scaleEstimationROISelector.currentNode():
@@ -384,7 +665,7 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
       self.scaleFactorSpinBox.enabled = True
 
     if self.NoiseCorrectionOff.checked == False:
-      if self.noiseEstimationROISelector.currentNode() == None:
+      if self.noiseEstimationROISelector.currentNode() == None and not self.autoNoiseFlagCheckBox.checked:
         self.Echo1NoiseSpinBox.enabled = True
         self.Echo2NoiseSpinBox.enabled = True
       else:
@@ -395,6 +676,13 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
       self.Echo2NoiseSpinBox.enabled = False
 
     self.applyButton.enabled = self.echo1ImageSelector.currentNode() and self.echo1ImageSelector.currentNode() and self.tempMapSelector.currentNode()
+    self.liveMonitoringFlagCheckBox.enabled = self.applyButton.enabled or self.liveMonitoringFlagCheckBox.checked
+    self.applySequenceButton.enabled = (self.echo1SequenceSelector.currentNode() and self.echo2SequenceSelector.currentNode()
+                                        and self.tempMapSequenceSelector.currentNode())
+
+    # Selecting other nodes ends the monitoring session
+    if self.liveMonitor and self.liveMonitor.volumeNodes != [self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode()]:
+      self.liveMonitoringFlagCheckBox.checked = False
 
 
   def onUseOutputThreshold(self):
@@ -406,19 +694,124 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
       self.upperOutputThresholdSpinBox.enabled = False;      
 
 
+  def outputClamp(self):
+    """
+    Parameters of the final clamp stage: (output threshold, region fill value)
+    """
+    outputThreshold = None
+    if self.useOutputThresholdFlagCheckBox.checked == True:
+      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+    return (outputThreshold, self.regionFillValueSpinBox.value)
+
+  def onOutputClampChanged(self):
+    """
+    Apply the output threshold and region fill value to the last temperature map
+    without recomputing it; a running computation picks them up when it finishes
+    """
+    clamp = self.outputClamp()
+    if clamp == self.appliedClamp or self.runner.isRunning():
+      return
+    if self.logic.rethreshold(*clamp):
+      self.appliedClamp = clamp
+
   def onApplyButton(self):
-    logic = ComputeTempLogic()
-    logic.setScaleCalibrationR2s(self.scaleCalibrationR2sSpinBox.value,
-                                 self.TE1SpinBox.value, self.TE2SpinBox.value)
+    (scaleFactor, noiseLevel) = self.calibrate(self.logic)
+    self.runLogic(self.logic, scaleFactor, noiseLevel)
 
-    outputThreshold = None
-    inputThreshold = [self.Echo1InputThresholdSpinBox.value, self.Echo2InputThresholdSpinBox.value]
+  def onApplySequenceButton(self):
+    ## The scale factor and noise levels are not estimated from the sequence; the values
+    ## shown (e.g. estimated at the last 'Apply') are used for all frames
+    scaleFactor = self.scaleFactorSpinBox.value
+    noiseLevel = [0.0, 0.0]
+    if self.NoiseCorrectionOff.checked == False:
+      if self.autoNoiseFlagCheckBox.checked and self.noiseEstimationROISelector.currentNode() == None:
+        ## Estimated from the first frame of each echo sequence
+        method = "SD" if self.NoiseCorrectionSD.checked else "Mean"
+        self.Echo1NoiseSpinBox.value = self.logic.EstimateNoise(
+          self.echo1SequenceSelector.currentNode().GetNthDataNode(0), method)
+        self.Echo2NoiseSpinBox.value = self.logic.EstimateNoise(
+          self.echo2SequenceSelector.currentNode().GetNthDataNode(0), method)
+      noiseLevel = [self.Echo1NoiseSpinBox.value, self.Echo2NoiseSpinBox.value]
+    parameters = self.configureLogic(self.logic)
+    if parameters is None:
+      return
+    (outputThreshold, inputThreshold, minT2s) = parameters
+    ## Each run filters the frames of the sequence with a new temporal filter
+    self.logic.runSequenceInBackground(self.runner, self.echo1SequenceSelector.currentNode(),
+                                       self.echo2SequenceSelector.currentNode(),
+                                       self.tempMapSequenceSelector.currentNode(),
+                                       self.TE1SpinBox.value, self.TE2SpinBox.value, scaleFactor,
+                                       self.paramASpinBox.value, self.paramBSpinBox.value,
+                                       noiseLevel, outputThreshold, inputThreshold, minT2s,
+                                       self.regionSelector.currentNode(), self.regionFillValueSpinBox.value,
+                                       self.createTemporalFilter())
+    self.cancelButton.enabled = self.runner.isRunning()
+
+  def onCancelButton(self):
+    self.runner.cancel()
+
+  def onProgress(self, status):
+    self.statusLabel.text = status
+    self.cancelButton.enabled = self.runner.isRunning()
+
+  def onLiveMonitoring(self, checked):
+    if checked:
+      self.startLiveMonitoring()
+    else:
+      self.stopLiveMonitoring()
+
+  def startLiveMonitoring(self):
+    ## The scale factor and noise levels are estimated once and kept for the session
+    self.logic.resetNoiseEstimates()
+    self.liveCalibration = self.calibrate(self.logic)
+    self.logic.setTemporalFilter(self.createTemporalFilter())
+    self.liveMonitor = LiveMonitor.LiveMonitor([self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode()],
+                                               self.onLiveFrame, self.onLiveLatency, True)
+    self.liveMonitor.start()
+    self.latencyLabel.text = "-"
+
+  def stopLiveMonitoring(self):
+    if self.liveMonitor:
+      self.liveMonitor.stop()
+    self.liveMonitor = None
+    self.liveCalibration = None
+    self.logic.setTemporalFilter(None)
+
+  def createTemporalFilter(self):
+    """
+    Temporal filter of the live temperature maps, or None if disabled
+    """
+    method = self.temporalFilterComboBox.currentText
+    if method == "Off":
+      return None
+    return CryoMonitoringLib.TemporalFilter(method, self.temporalFilterAlphaSpinBox.value,
+                                            self.processVarianceSpinBox.value,
+                                            self.measurementVarianceSpinBox.value)
 
-    minT2s = self.MinT2sSpinBox.value
+  def onLiveFrame(self, frameDone):
+    (scaleFactor, noiseLevel) = self.liveCalibration
+    self.runLogic(self.logic, scaleFactor, noiseLevel, frameDone)
 
-    if self.useOutputThresholdFlagCheckBox.checked == True:
-      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+  def onLiveLatency(self, latency):
+    self.latencyLabel.text = "%.3f" % latency
 
+  def calibrate(self, logic):
+    """
+    Estimate (or read) the scale factor and the noise levels
+    """
+    logic.setScaleCalibrationR2s(self.scaleCalibrationR2sSpinBox.value,
+                                 self.TE1SpinBox.value, self.TE2SpinBox.value)
+    logic.setScannerID(self.scannerIDLineEdit.text)
+    useCalibrationStore = self.useCalibrationStoreFlagCheckBox.checked
+
+    method = "Mean"
+    if self.NoiseCorrectionSD.checked == True:
+      method = "SD"
+
+    ## Values stored for the protocol in an earlier session, used in place of the ROIs
+    (storedScaleFactor, storedNoiseLevel) = (None, None)
+    if useCalibrationStore:
+      (storedScaleFactor, storedNoiseLevel) = logic.loadCalibration(self.echo1ImageSelector.currentNode(), method)
 
     ## Scale factor
     scaleFactor = self.scaleFactorSpinBox.value
@@ -428,46 +821,119 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
                                             self.echo2ImageSelector.currentNode(),
                                             self.scaleEstimationROISelector.currentNode())
       self.scaleFactorSpinBox.value = scaleFactor
+      if useCalibrationStore:
+        logic.saveCalibration(self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode(),
+                              scaleFactor=scaleFactor, scaleROINode=self.scaleEstimationROISelector.currentNode())
+    elif storedScaleFactor is not None:
+      scaleFactor = storedScaleFactor
+      self.scaleFactorSpinBox.value = scaleFactor
 
     ## Noise level
     noiseLevel = None
     if self.NoiseCorrectionOff.checked == False:
       if self.noiseEstimationROISelector.currentNode():
-        method = "Mean"
-        if self.NoiseCorrectionSD.checked == True:
-          method = "SD"
         noiseEcho1 = logic.CalcNoise(self.echo1ImageSelector.currentNode(), None,
                                      self.noiseEstimationROISelector.currentNode(), method)
         noiseEcho2 = logic.CalcNoise(self.echo2ImageSelector.currentNode(), None,
                                      self.noiseEstimationROISelector.currentNode(), method)
         noiseLevel = [noiseEcho1, noiseEcho2]
+        if useCalibrationStore:
+          logic.saveCalibration(self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode(),
+                                noiseLevel=noiseLevel, noiseMethod=method,
+                                noiseROINode=self.noiseEstimationROISelector.currentNode())
+      elif self.autoNoiseFlagCheckBox.checked:
+        noiseLevel = [logic.EstimateNoise(self.echo1ImageSelector.currentNode(), method),
+                      logic.EstimateNoise(self.echo2ImageSelector.currentNode(), method)]
+      elif storedNoiseLevel is not None:
+        noiseLevel = storedNoiseLevel
       else:
         noiseLevel = [self.Echo1NoiseSpinBox.value, self.Echo2NoiseSpinBox.value]
-      self.Echo1NoiseSpinBox.value = noiseEcho1
-      self.Echo2NoiseSpinBox.value = noiseEcho2
+      self.Echo1NoiseSpinBox.value = noiseLevel[0]
+      self.Echo2NoiseSpinBox.value = noiseLevel[1]
     else:
       noiseLevel = [0.0, 0.0]
       self.Echo1NoiseSpinBox.value = 0.0
       self.Echo2NoiseSpinBox.value = 0.0
 
+    return (scaleFactor, noiseLevel)
+
+  def configureLogic(self, logic):
+    """
+    Set the memory and cache budgets, threads and calibration curve of the logic; returns the
+    thresholds (outputThreshold, inputThreshold, minT2s), or None if the curve cannot
+    be loaded
+    """
+    outputThreshold = None
+    inputThreshold = [self.Echo1InputThresholdSpinBox.value, self.Echo2InputThresholdSpinBox.value]
+
+    minT2s = self.MinT2sSpinBox.value
+
+    if self.useOutputThresholdFlagCheckBox.checked == True:
+      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+
+    memoryBudget = None
+    if self.memoryBudgetSpinBox.value > 0:
+      memoryBudget = self.memoryBudgetSpinBox.value * 1024 * 1024
+    logic.setMemoryBudget(memoryBudget)
+    logic.setCacheBudget(self.cacheBudgetSpinBox.value * 1024 * 1024)
+    logic.setThreads(self.threadsSpinBox.value)
+    logic.setPrecision(self.precisionComboBox.currentText)
+
+    try:
+      logic.setCalibrationFile(self.calibrationPathLineEdit.currentPath)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      slicer.util.errorDisplay('Cannot load the calibration curve: %s' % str(e))
+      return None
+
+    return (outputThreshold, inputThreshold, minT2s)
+
+  def runLogic(self, logic, scaleFactor, noiseLevel, onFinished=None):
+    """
+    Start generating the temperature map with the given calibration in the background;
+    onFinished() is called once the temperature map is updated
+    """
+    parameters = self.configureLogic(logic)
+    if parameters is None:
+      return
+    (outputThreshold, inputThreshold, minT2s) = parameters
+
+    isotherms = None
+    if self.useIsothermsFlagCheckBox.checked:
+      try:
+        isotherms = [float(isotherm) for isotherm in self.isothermsLineEdit.text.split(',')]
+      except ValueError:
+        slicer.util.errorDisplay('Invalid isotherms: %s' % self.isothermsLineEdit.text)
+        return
+    logic.setIsotherms(isotherms, self.isothermLabelSelector.currentNode(), self.isothermModelsFlagCheckBox.checked)
+
     ## Generate temperature map
     tmapNode = self.tempMapSelector.currentNode()
-    tmapName = tmapNode.GetName()
-    logic.run(self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode(),
-              tmapNode,
-              self.TE1SpinBox.value, self.TE2SpinBox.value, scaleFactor,
-              self.paramASpinBox.value, self.paramBSpinBox.value,
-              noiseLevel, outputThreshold, inputThreshold, minT2s)
-
-    tmapNode = slicer.util.getNode(tmapName)
-
-    ## Change colormap
-    dispNode = tmapNode.GetDisplayNode()
-    c = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLColorTableNode', 'ColdToHotRainbow')
-    tableNode = c.GetItemAsObject(0)
-    dispNode.SetAutoWindowLevel(0)
-    dispNode.SetWindowLevelMinMax(-50, 30)
-    dispNode.SetAndObserveColorNodeID(tableNode.GetID())
+    self.appliedClamp = (outputThreshold, self.regionFillValueSpinBox.value)
+
+    def onTempMapUpdated():
+      self.onOutputClampChanged()
+      if logic.isothermVolumes:
+        self.isothermVolumesLabel.text = ', '.join(['%g C: %.2f mL' % v for v in logic.isothermVolumes])
+      else:
+        self.isothermVolumesLabel.text = "-"
+
+      ## Change colormap
+      dispNode = tmapNode.GetDisplayNode()
+      c = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLColorTableNode', 'ColdToHotRainbow')
+      tableNode = c.GetItemAsObject(0)
+      dispNode.SetAutoWindowLevel(0)
+      dispNode.SetWindowLevelMinMax(-50, 30)
+      dispNode.SetAndObserveColorNodeID(tableNode.GetID())
+      if onFinished:
+        onFinished()
+
+    logic.runInBackground(self.runner, self.echo1ImageSelector.currentNode(), self.echo2ImageSelector.currentNode(),
+                          tmapNode,
+                          self.TE1SpinBox.value, self.TE2SpinBox.value, scaleFactor,
+                          self.paramASpinBox.value, self.paramBSpinBox.value,
+                          noiseLevel, outputThreshold, inputThreshold, minT2s,
+                          self.regionSelector.currentNode(), self.regionFillValueSpinBox.value, onTempMapUpdated)
+    self.cancelButton.enabled = self.runner.isRunning()
 
   def onReload(self, moduleName="ComputeTemp"):
     # Generic reload method for any scripted module.
@@ -482,6 +948,29 @@ class ComputeTempWidget(ScriptedLoadableModuleWidget):
 
 class ComputeTempLogic(ScriptedLoadableModuleLogic):
 
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.roiStatisticsCache = {}
+    self.statisticsCache = {}
+    self.instrumentation = False
+    self.lastRunRecord = None
+    self.T2StarLogic = ComputeT2Star.ComputeT2StarLogic()
+    self.memoryBudget = None
+    self.intermediateCache = None
+    self.threads = 1
+    self.isothermTracker = None
+    self.isothermLabelVolumeNode = None
+    self.isothermModels = False
+    self.isothermContourModels = {}
+    self.isothermVolumes = []
+    self.temporalFilter = None
+    self.calibrationTable = None
+    self.calibrationTableKey = None
+    self.precision = "Float64"
+    self.dtype = numpy.float64
+    self.keepUnthresholded = False
+    self.unthresholdedMap = (None, None)
+
   def isValidInputOutputData(self, echo1ImageVolumeNode, echo2ImageVolumeNode):
     """Validates if the output is not the same as input
     """
@@ -493,6 +982,176 @@ class ComputeTempLogic(ScriptedLoadableModuleLogic):
       return False
     return True
   
+  def setInstrumentation(self, enabled):
+    """
+    If enabled, the wall time and allocated memory of each stage of run() are
+    recorded in self.lastRunRecord (CryoMonitoringLib.RunRecord)
+    """
+    self.instrumentation = enabled
+
+  def setMemoryBudget(self, memoryBudget):
+    """
+    Limit the intermediate buffers to memoryBudget bytes by streaming the echo images
+    through slabs of slices (None: whole volume at once). The results are identical.
+    """
+    self.memoryBudget = memoryBudget
+    self.T2StarLogic.setMemoryBudget(memoryBudget)
+
+  def setThreads(self, threads):
+    """
+    Process the volume in slabs on a pool of 'threads' threads. The results are
+    identical to the single-threaded computation.
+    """
+    self.threads = max(int(threads), 1)
+    self.T2StarLogic.setThreads(threads)
+
+  def setCacheBudget(self, cacheBudget):
+    """
+    Keep the intermediates of the temperature computation (noise-corrected echoes,
+    scaled echo 2, log-ratio, mask and R2* map) of recent runs in a cache of cacheBudget
+    bytes (see CryoMonitoringLib.computeTempFromEchoesCached()), so that a rerun with
+    other calibration or threshold parameters only recomputes the stages that depend on
+    them (None or 0: no cache). The cache holds full-size images, so it is not used
+    while a memory budget is set. The results are identical.
+    """
+    if not cacheBudget:
+      self.intermediateCache = None
+    elif self.intermediateCache is None:
+      self.intermediateCache = CryoMonitoringLib.IntermediateCache(cacheBudget)
+    else:
+      self.intermediateCache.setByteBudget(cacheBudget)
+
+  def useIntermediateCache(self):
+    return self.intermediateCache is not None and not self.memoryBudget
+
+  def setPrecision(self, precision):
+    """
+    Compute and output the maps as "Float64" (default) or "Float32" (see
+    ComputeT2StarLogic.setPrecision())
+    """
+    self.T2StarLogic.setPrecision(precision)
+    self.precision = precision
+    self.dtype = self.T2StarLogic.dtype
+
+  def setCalibrationFile(self, path):
+    """
+    Use the nonlinear calibration curve of the file (see CryoMonitoringLib.loadCalibrationTable())
+    instead of the linear model; an empty path restores the linear model. The lookup
+    table is only rebuilt when the file changes.
+    """
+    if not path:
+      self.calibrationTable = None
+      self.calibrationTableKey = None
+      return
+    key = (path, os.path.getmtime(path))
+    if key != self.calibrationTableKey:
+      self.calibrationTable = CryoMonitoringLib.loadCalibrationTable(path)
+      self.calibrationTableKey = key
+
+  def setTemporalFilter(self, temporalFilter):
+    """
+    Filter the temperature maps of consecutive runs with a CryoMonitoringLib.TemporalFilter
+    (None: every map is independent). The maps are filtered before the final clamp stage
+    (see clampTempMap()), and the output node receives the clamped filtered map.
+    """
+    self.temporalFilter = temporalFilter
+
+  def setKeepUnthresholded(self, enabled):
+    """
+    Keep the temperature map of the last run before the final clamp stage, so that
+    rethreshold() can apply a new output threshold and region fill value without
+    recomputing the map. The kept map takes as much memory as the output; while a
+    temporal filter is set, the filtered map (the filter state) is kept instead.
+    """
+    self.keepUnthresholded = enabled
+    if not enabled:
+      self.unthresholdedMap = (None, None)
+
+  def keepsUnthresholded(self):
+    return self.keepUnthresholded
+
+  def unthresholdedBuffer(self, arrayTemp, region, keep, temporalFilter=None):
+    """
+    Array the temperature map is computed into before the final clamp stage: a separate
+    array if the map itself is kept, otherwise the output itself (its region bounding
+    box). A filtered map is kept in the filter state.
+    """
+    box = arrayTemp if region is None else region.crop(arrayTemp)
+    if keep and temporalFilter is None:
+      return numpy.empty(box.shape, dtype=box.dtype)
+    return box
+
+  def deferredThreshold(self, outputThreshold, keep, temporalFilter=None):
+    """
+    Output threshold applied during the computation: None if the map is kept or
+    filtered, as these need the map before the final clamp stage
+    """
+    if keep or temporalFilter is not None:
+      return None
+    return outputThreshold
+
+  def clampTempMap(self, arrayTemp, unthresholded, outputThreshold, region, regionFillValue, record, keep, temporalFilter=None):
+    """
+    Final stages of the temperature map: the temporal filter, if given, on the map before
+    the clamp stage (the voxels outside the region hold their filtered state), then the
+    output threshold (unless it was applied during the computation, see
+    deferredThreshold()) and the region fill value. Returns the
+    CryoMonitoringLib.UnthresholdedMap if the map is kept, otherwise None.
+    """
+    if keep or temporalFilter is not None:
+      kept = CryoMonitoringLib.UnthresholdedMap(unthresholded, None, region)
+      if temporalFilter is not None:
+        kept = kept.filter(temporalFilter, record)
+      record.startStage('thresholding')
+      kept.apply(arrayTemp, outputThreshold, 0.0, regionFillValue)
+      return kept if keep else None
+    if region is not None:
+      record.startStage('thresholding')
+      region.fillOutside(arrayTemp, regionFillValue)
+    return None
+
+  def rethreshold(self, outputThreshold, regionFillValue=0.0):
+    """
+    Apply a new output threshold and region fill value to the temperature map of the
+    last run, from the kept map (see setKeepUnthresholded()). Only the final clamp stage
+    is run (one vectorized pass), followed by the isotherm update. Returns False if no
+    map is kept.
+    """
+    (tempMapVolumeNode, unthresholded) = self.unthresholdedMap
+    if unthresholded is None:
+      return False
+    arrayTemp = SlicerBridge.arrayFromVolume(tempMapVolumeNode)
+    if not unthresholded.matches(arrayTemp):
+      return False
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp (rethreshold)', self.instrumentation)
+    record.startStage('thresholding')
+    unthresholded.apply(arrayTemp, outputThreshold, 0.0, regionFillValue)
+    record.startStage('push')
+    SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+    self.updateIsotherms(tempMapVolumeNode, record)
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+    return True
+
+  def setIsotherms(self, isotherms, labelVolumeNode=None, models=False):
+    """
+    Segment the given isotherms (deg C) of every temperature map into the label map node
+    and, if models is True, a surface model per isotherm; the enclosed volumes (mL) are
+    kept in self.isothermVolumes. The segmentation is updated incrementally from the
+    previous frame as long as the settings are the same. None disables the isotherms.
+    """
+    if isotherms is None:
+      self.isothermTracker = None
+      self.isothermVolumes = []
+      return
+    isotherms = tuple(sorted([float(isotherm) for isotherm in isotherms], reverse=True))
+    if (self.isothermTracker is None or self.isothermTracker.isotherms != isotherms
+        or labelVolumeNode != self.isothermLabelVolumeNode or models != self.isothermModels):
+      self.isothermTracker = CryoMonitoringLib.IsothermTracker(isotherms)
+    self.isothermLabelVolumeNode = labelVolumeNode
+    self.isothermModels = models
+
   def setScaleCalibrationR2s(self, r2s, TE1, TE2):
     self.scaleCalibrationR2s = r2s
     self.TE1 = TE1
@@ -504,112 +1163,526 @@ class ComputeTempLogic(ScriptedLoadableModuleLogic):
   ## The 'method' argment must be either "Mean" or "StdDev".
   def CalcNoise(self, image1Node, image2Node, ROINode, method="Mean"):
     
-    labelStatistics = sitk.LabelStatisticsImageFilter()
-    image1 = sitk.Cast(sitkUtils.PullFromSlicer(image1Node.GetID()), sitk.sitkFloat32)
-    roiImage = sitk.Cast(sitkUtils.PullFromSlicer(ROINode.GetID()), sitk.sitkInt8)
-
     if image2Node: # Two-image approach
+      roiStatistics = self.GetROIStatistics(ROINode)
+      values = roiStatistics.values(SlicerBridge.arrayFromVolume(image1Node))
+      values -= roiStatistics.values(SlicerBridge.arrayFromVolume(image2Node))
+      statistics = roiStatistics.statisticsFromValues(values)
 
-      image2 = sitk.Cast(sitkUtils.PullFromSlicer(image2Node.GetID()), sitk.sitkFloat32)
-      subImage = sitk.Subtract(image1, image2)
-      absImage = sitk.Abs(subImage)
+    else: # Single-image approach
+      statistics = self.GetStatistics([image1Node], ROINode)[0]
 
-      #absVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
-      #slicer.mrmlScene.AddNode(absVolumeNode)
-      #absVolumeNode.SetName('abs')
-      #sitkUtils.PushToSlicer(absImage, absVolumeNode.GetName(), 0, True)
-      #absVolumeNode = slicer.util.getNode('abs')
-      #lslogic = LabelStatistics.LabelStatisticsLogic(absVolumeNode, ROINode)
-      #meanAbsDiff = lslogic.labelStats[1,method]
-      #slicer.mrmlScene.RemoveNode(absVolumeNode)
+    return CryoMonitoringLib.noiseFromStatistics(statistics[1], method)
 
-      labelStatistics = sitk.LabelStatisticsImageFilter()
-      labelStatistics.Execute(subImage, roiImage)
 
-    else: # Single-image approach
-        
-      #lslogic = LabelStatistics.LabelStatisticsLogic(image1Node, ROINode)
-      labelStatistics.Execute(image1, roiImage)
+  def EstimateNoise(self, imageNode, method="Mean"):
+    """
+    Noise level of the image from the histogram of its background air, without an ROI;
+    cached per series (see ComputeT2StarLogic.EstimateNoise())
+    """
+    return self.T2StarLogic.EstimateNoise(imageNode, method)
+
+  def resetNoiseEstimates(self):
+    self.T2StarLogic.resetNoiseEstimates()
+
+  def setCalibrationStore(self, calibrationStore):
+    """
+    Keep the calibrations in the given CryoMonitoringLib.CalibrationStore (see
+    ComputeT2StarLogic.setCalibrationStore())
+    """
+    self.T2StarLogic.setCalibrationStore(calibrationStore)
 
-    if method == "Mean":
-      mean = labelStatistics.GetMean(1)
-      return (mean/math.sqrt(math.pi/2.0))
-    else: # method == "StdDev"
-      sd = labelStatistics.GetSigma(1)
-      return sd
+  def setScannerID(self, scannerID):
+    self.T2StarLogic.setScannerID(scannerID)
 
+  def loadCalibration(self, echo1ImageVolumeNode, noiseMethod="Mean"):
+    """
+    (scale factor, noise levels) stored for the protocol of the echo images (TE1 and TE2
+    of setScaleCalibrationR2s()), each None if it is not in the calibration store
+    """
+    return self.T2StarLogic.loadCalibration(echo1ImageVolumeNode, self.TE1, self.TE2, self.scaleCalibrationR2s,
+                                            noiseMethod)
+
+  def saveCalibration(self, echo1ImageVolumeNode, echo2ImageVolumeNode, scaleFactor=None, scaleROINode=None, noiseLevel=None, noiseMethod="Mean", noiseROINode=None):
+    """
+    Store the scale factor and/or the noise levels estimated for the protocol of the echo
+    images, with the statistics of both echoes over the ROIs they were estimated from
+    """
+    (scaleStatistics, noiseStatistics) = (None, None)
+    if scaleROINode:
+      scaleStatistics = self.GetStatistics([echo1ImageVolumeNode, echo2ImageVolumeNode], scaleROINode)
+    if noiseROINode:
+      noiseStatistics = self.GetStatistics([echo1ImageVolumeNode, echo2ImageVolumeNode], noiseROINode)
+    self.T2StarLogic.saveCalibration(echo1ImageVolumeNode, self.TE1, self.TE2, self.scaleCalibrationR2s,
+                                     scaleFactor, noiseLevel, noiseMethod, scaleStatistics, noiseStatistics)
 
   def CalcScalingFactor(self, image1Node, image2Node, ROINode):
 
-    image1 = sitk.Cast(sitkUtils.PullFromSlicer(image1Node.GetID()), sitk.sitkFloat32)
-    image2 = sitk.Cast(sitkUtils.PullFromSlicer(image2Node.GetID()), sitk.sitkFloat32)
-    roiImage = sitk.Cast(sitkUtils.PullFromSlicer(ROINode.GetID()), sitk.sitkInt8)
-    
-    LabelStatistics = sitk.LabelStatisticsImageFilter()
-    LabelStatistics.Execute(image1, roiImage)
-    echo1 = LabelStatistics.GetMean(1)
-    LabelStatistics.Execute(image2, roiImage)
-    echo2 = LabelStatistics.GetMean(1)
+    (statistics1, statistics2) = self.GetStatistics([image1Node, image2Node], ROINode)
 
-    scale = echo1 / (echo2 * numpy.exp(self.scaleCalibrationR2s*(self.TE2-self.TE1)))
+    return CryoMonitoringLib.scalingFactorFromStatistics(statistics1[1], statistics2[1], self.TE1, self.TE2,
+                                                         self.scaleCalibrationR2s)
 
-    return (scale)
+
+  def GetROIStatistics(self, ROINode):
+    """
+    Return the ROIStatistics object (the located ROI voxels) of the label map;
+    cached until the label map is modified
+    """
+    key = (ROINode.GetID(), SlicerBridge.volumeModifiedTime(ROINode))
+    if key not in self.roiStatisticsCache:
+      self.roiStatisticsCache = {key: CryoMonitoringLib.ROIStatistics(SlicerBridge.arrayFromVolume(ROINode))}
+    return self.roiStatisticsCache[key]
 
 
-  def run(self, echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s):
+  def GetStatistics(self, imageNodes, ROINode):
+    """
+    Per-label statistics ({label: {'mean', 'sigma', 'count'}}) of the images over the ROI.
+    Each image is read once per ROI; the results are cached by the modification time
+    of the image and ROI nodes, so repeated calls for unchanged data cost nothing.
     """
-    Run the actual algorithm
+    roiKey = (ROINode.GetID(), SlicerBridge.volumeModifiedTime(ROINode))
+    result = []
+    for imageNode in imageNodes:
+      key = (imageNode.GetID(), SlicerBridge.volumeModifiedTime(imageNode)) + roiKey
+      if key not in self.statisticsCache:
+        roiStatistics = self.GetROIStatistics(ROINode)
+        self.statisticsCache[key] = roiStatistics.statistics(SlicerBridge.arrayFromVolume(imageNode))
+      result.append(self.statisticsCache[key])
+
+    # Drop the entries computed from earlier versions of the same nodes
+    current = dict([(node.GetID(), SlicerBridge.volumeModifiedTime(node)) for node in imageNodes])
+    current[roiKey[0]] = roiKey[1]
+    for key in list(self.statisticsCache.keys()):
+      if current.get(key[0], key[1]) != key[1] or current.get(key[2], key[3]) != key[3]:
+        del self.statisticsCache[key]
+
+    return result
+
+
+  def run(self, echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0):
+    """
+    Run the actual algorithm. If a region node (label map or ROI) is given, noise
+    correction, R2* and temperature are only computed within the region and the voxels
+    outside are set to regionFillValue. The map is filtered over time and the isotherms
+    are updated if enabled (see setTemporalFilter() and setIsotherms()).
     """
     if not self.isValidInputOutputData(echo1ImageVolumeNode, echo2ImageVolumeNode):
       slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
       return False
 
     logging.info('Processing started')
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp', self.instrumentation)
+
+    region = self.T2StarLogic.getRegion(regionNode, echo1ImageVolumeNode)
+    if self.useIntermediateCache():
+      self.computeTempMapCached(echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor,
+                                paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, record,
+                                region, regionFillValue)
+    elif self.memoryBudget or self.threads > 1:
+      self.computeTempMapChunked(echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor,
+                                 paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, record,
+                                 region, regionFillValue)
+    else:
+      # Get R2* image; the map stays in memory and is not added to the scene
+      arrayR2Star = self.T2StarLogic.computeR2Star(echo1ImageVolumeNode, echo2ImageVolumeNode, te1, te2, scaleFactor,
+                                                   noiseLevel, None, inputThreshold, minT2s, record, region)
+      self.computeTempMap(arrayR2Star, tempMapVolumeNode, echo1ImageVolumeNode, paramA, paramB, outputThreshold,
+                          record, region, regionFillValue)
+    self.updateIsotherms(tempMapVolumeNode, record)
+
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+      logging.info('Run record: %s' % record.toDict())
+
+    logging.info('Processing completed')
+
+    return True
+
+  def runInBackground(self, runner, echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0, onFinished=None):
+    """
+    Same as run(), but the temperature map is computed in a worker thread of the runner
+    (CryoMonitoringLib.BackgroundRunner) and pushed to the scene on the main thread when
+    done; onFinished() is called after that. The echo images are copied when the task
+    is submitted.
+    """
+    if not self.isValidInputOutputData(echo1ImageVolumeNode, echo2ImageVolumeNode):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return False
+    if not tempMapVolumeNode:
+      return False
 
-    tempName = tempMapVolumeNode.GetName()
-
-    r2StarVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
-    slicer.mrmlScene.AddNode(r2StarVolumeNode)
-    r2StarVolumeNode.SetName("R2Star-temp")
-
-    T2StarLogic = ComputeT2Star.ComputeT2StarLogic()
-    T2StarLogic.run(echo1ImageVolumeNode, echo2ImageVolumeNode, None, r2StarVolumeNode, te1, te2, scaleFactor, noiseLevel, None, inputThreshold, minT2s)
-
-    ### Since PushToSlicer() called in logic.run() will delete the original node, obtain the new node and
-    ### reset the selector.
-    r2StarVolumeNode = slicer.util.getNode("R2Star-temp")
-
-    # Get R2* image
-    r2StarImage = sitk.Cast(sitkUtils.PullFromSlicer(r2StarVolumeNode.GetID()), sitk.sitkFloat64)
-
-    #if outputThreshold!=None:
-    #  mask = sitk.BinaryThreshold(r2StarImage, 0.000001, float('Inf'), 1, 0) 
-    #  nmask = sitk.BinaryThreshold(r2StarImage, -10e-6, 10e-6, 1, 0) 
-    #  nmask = sitk.Cast(nmask, sitk.sitkFloat64)
-    #  nmask = nmask * threshold[0] # multiply lower limit
-
-    if tempMapVolumeNode:
-      imageTemp = paramA * (r2StarImage) + paramB
-
-      if outputThreshold!=None:
-        # Mask out invalid pixels (ComputeT2Star module output zero, when R2* cannot be
-        # computed accurately.
-        #imageTemp = sitk.Mask(imageTemp, mask)
-        #imageTemp = sitk.Add(imageTemp, nmask)
-        print outputThreshold
-        lowerOutputThreshold = outputThreshold[0]
-        upperOutputThreshold = outputThreshold[1]
-        imageTempThreshold = sitk.Threshold(imageTemp, lowerOutputThreshold, upperOutputThreshold, 0.0)
-        sitkUtils.PushToSlicer(imageTempThreshold, tempMapVolumeNode.GetName(), 0, True)
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp', self.instrumentation)
+    record.startStage('pull')
+    region = self.T2StarLogic.getRegion(regionNode, echo1ImageVolumeNode)
+    arrayTE1 = SlicerBridge.arrayFromVolume(echo1ImageVolumeNode).copy()
+    arrayTE2 = SlicerBridge.arrayFromVolume(echo2ImageVolumeNode).copy()
+    memoryBudget = self.memoryBudget
+    threads = self.threads
+    isothermTracker = self.isothermTracker
+    temporalFilter = self.temporalFilter
+    calibrationTable = self.calibrationTable
+    dtype = self.dtype
+    cache = self.intermediateCache if self.useIntermediateCache() else None
+    keep = self.keepsUnthresholded()
+
+    def compute(progress):
+      arrayTemp = numpy.empty(arrayTE1.shape, dtype=dtype)
+      (echo1, echo2) = (arrayTE1, arrayTE2)
+      if region is not None:
+        (echo1, echo2) = (region.crop(arrayTE1), region.crop(arrayTE2))
+      unthresholded = self.unthresholdedBuffer(arrayTemp, region, keep, temporalFilter)
+      threshold = self.deferredThreshold(outputThreshold, keep, temporalFilter)
+      if cache is not None:
+        CryoMonitoringLib.computeTempFromEchoesCached(cache, echo1, echo2, te1, te2, scaleFactor, noiseLevel,
+                                                      inputThreshold, minT2s, paramA, paramB, threshold,
+                                                      unthresholded, progress, threads, calibrationTable, dtype)
       else:
-        sitkUtils.PushToSlicer(imageTemp, tempMapVolumeNode.GetName(), 0, True)
+        CryoMonitoringLib.computeTempFromEchoesChunked(echo1, echo2, te1, te2, scaleFactor, noiseLevel,
+                                                       inputThreshold, minT2s, paramA, paramB, threshold,
+                                                       memoryBudget, unthresholded, progress, threads,
+                                                       calibrationTable, dtype)
+      if temporalFilter is not None:
+        ## Filtered and clamped in finish()
+        return (arrayTemp, unthresholded, None, None)
+      kept = self.clampTempMap(arrayTemp, unthresholded, outputThreshold, region, regionFillValue, progress, keep)
+      labels = None
+      if isothermTracker:
+        progress.startStage('isotherms')
+        labels = isothermTracker.labelsOf(arrayTemp)
+      return (arrayTemp, None, labels, kept)
+
+    def finish(result):
+      (arrayTemp, unthresholded, labels, kept) = result
+      if unthresholded is not None:
+        ## The filter state is only updated on the main thread, by the task that was not superseded.
+        ## The output threshold was deferred, so it is applied here even if the filter was removed.
+        kept = self.clampTempMap(arrayTemp, unthresholded, outputThreshold, region, regionFillValue, record,
+                                 True, self.temporalFilter)
+        if not keep or self.temporalFilter is None:
+          kept = None
+      self.unthresholdedMap = (tempMapVolumeNode, kept)
+      record.startStage('push')
+      SlicerBridge.updateVolumeFromArray(tempMapVolumeNode, arrayTemp, echo1ImageVolumeNode)
+      ## The labels are recomputed if the isotherm settings changed during the run
+      self.updateIsotherms(tempMapVolumeNode, record, labels if isothermTracker is self.isothermTracker else None)
+      record.finish()
+      if self.instrumentation:
+        self.lastRunRecord = record
+        logging.info('Run record: %s' % record.toDict())
+      logging.info('Processing completed')
+      if onFinished:
+        onFinished()
 
-    slicer.mrmlScene.RemoveNode(r2StarVolumeNode)
+    logging.info('Processing started')
+    runner.submit(compute, finish, record)
+    return True
+
+  def runMultiEcho(self, echoImageVolumeNodes, tempMapVolumeNode, TEs, paramA, paramB, noiseLevels, outputThreshold, inputThreshold, minT2s, scaleFactors=None, regionNode=None, regionFillValue=0.0):
+    """
+    Same as run(), but R2* is fitted to N >= 2 echo volumes (see
+    ComputeT2StarLogic.runMultiEcho())
+    """
+    if len(echoImageVolumeNodes) < 2 or None in echoImageVolumeNodes:
+      slicer.util.errorDisplay('At least two echo volumes are required for the multi-echo fit.')
+      return False
+
+    logging.info('Processing started')
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp (multi-echo)', self.instrumentation)
+
+    region = self.T2StarLogic.getRegion(regionNode, echoImageVolumeNodes[0])
+    arrayR2Star = self.T2StarLogic.computeR2StarMultiEcho(echoImageVolumeNodes, TEs, noiseLevels, None,
+                                                          inputThreshold, minT2s, scaleFactors, record, region)
+
+    self.computeTempMap(arrayR2Star, tempMapVolumeNode, echoImageVolumeNodes[0], paramA, paramB, outputThreshold, record,
+                        region, regionFillValue)
+    self.updateIsotherms(tempMapVolumeNode, record)
+
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+      logging.info('Run record: %s' % record.toDict())
 
     logging.info('Processing completed')
 
     return True
 
+  def runSequence(self, echo1SequenceNode, echo2SequenceNode, tempMapSequenceNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0, temporalFilter=None):
+    """
+    Same as run(), but for all frames of two sequences of echo images. The frames are
+    streamed one at a time, each straight into the frame buffer of the output sequence
+    (within the memory budget and on the thread pool, as in run()), so that no copy of
+    the sequences is made. The temperature maps replace the frames of the output
+    sequence, under the index values of the echo 1 sequence. The region is applied to
+    every frame, and the frames are filtered in order with temporalFilter (a
+    CryoMonitoringLib.TemporalFilter), if given; the filter of live monitoring
+    (setTemporalFilter()) is not used. The isotherms are not segmented in sequence mode.
+    """
+    frames = self.sequenceFrames(echo1SequenceNode, echo2SequenceNode, tempMapSequenceNode)
+    if frames is None:
+      return False
+
+    logging.info('Processing started')
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp (sequence)', self.instrumentation)
+    self.unthresholdedMap = (None, None)
+    region = self.T2StarLogic.getRegion(regionNode, frames[0][0])
+    shape = SlicerBridge.arrayFromVolume(frames[0][0]).shape
+    (frameNode, arrayFrame) = self.startOutputSequence(echo1SequenceNode, tempMapSequenceNode, shape)
+
+    for (echo1Node, echo2Node, indexValue) in frames:
+      record.startStage('pull')
+      arrayTE1 = SlicerBridge.arrayFromVolume(echo1Node)
+      arrayTE2 = SlicerBridge.arrayFromVolume(echo2Node)
+      if arrayTE1.shape != shape or arrayTE2.shape != shape:
+        slicer.util.errorDisplay('Cannot process the sequences: the frame at %s has another size.' % indexValue)
+        return False
+      self.computeSequenceFrame(arrayTE1, arrayTE2, arrayFrame, te1, te2, scaleFactor, paramA, paramB, noiseLevel,
+                                outputThreshold, inputThreshold, minT2s, region, regionFillValue, temporalFilter,
+                                record, self.memoryBudget, self.threads, self.calibrationTable, self.dtype)
+      self.appendOutputFrame(tempMapSequenceNode, frameNode, echo1Node, indexValue, record)
+
+    self.finishSequence(record, len(frames))
+    return True
+
+  def runSequenceInBackground(self, runner, echo1SequenceNode, echo2SequenceNode, tempMapSequenceNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, regionNode=None, regionFillValue=0.0, temporalFilter=None, onFinished=None):
+    """
+    Same as runSequence(), but each frame is computed in a worker thread of the runner
+    (as in runInBackground()) and appended to the output sequence on the main thread,
+    which then submits the next frame. Only the echo images of the current frame are
+    copied. A cancelled run leaves the frames appended so far in the output sequence.
+    """
+    frames = self.sequenceFrames(echo1SequenceNode, echo2SequenceNode, tempMapSequenceNode)
+    if frames is None:
+      return False
+
+    record = CryoMonitoringLib.createRunRecord('ComputeTemp (sequence)', self.instrumentation)
+    self.unthresholdedMap = (None, None)
+    region = self.T2StarLogic.getRegion(regionNode, frames[0][0])
+    shape = SlicerBridge.arrayFromVolume(frames[0][0]).shape
+    (frameNode, arrayFrame) = self.startOutputSequence(echo1SequenceNode, tempMapSequenceNode, shape)
+    memoryBudget = self.memoryBudget
+    threads = self.threads
+    calibrationTable = self.calibrationTable
+    dtype = self.dtype
+
+    def submitFrame(index):
+      (echo1Node, echo2Node, indexValue) = frames[index]
+      record.startStage('pull')
+      arrayTE1 = SlicerBridge.arrayFromVolume(echo1Node).copy()
+      arrayTE2 = SlicerBridge.arrayFromVolume(echo2Node).copy()
+      if arrayTE1.shape != shape or arrayTE2.shape != shape:
+        slicer.util.errorDisplay('Cannot process the sequences: the frame at %s has another size.' % indexValue)
+        return
+
+      def compute(progress):
+        arrayTemp = numpy.empty(shape, dtype=arrayFrame.dtype)
+        self.computeSequenceFrame(arrayTE1, arrayTE2, arrayTemp, te1, te2, scaleFactor, paramA, paramB, noiseLevel,
+                                  outputThreshold, inputThreshold, minT2s, region, regionFillValue, temporalFilter,
+                                  progress, memoryBudget, threads, calibrationTable, dtype)
+        return arrayTemp
+
+      def finish(arrayTemp):
+        arrayFrame[...] = arrayTemp
+        self.appendOutputFrame(tempMapSequenceNode, frameNode, echo1Node, indexValue, record)
+        if index + 1 < len(frames):
+          submitFrame(index + 1)
+          return
+        self.finishSequence(record, len(frames))
+        if onFinished:
+          onFinished()
+
+      runner.submit(compute, finish, record)
+
+    logging.info('Processing started')
+    submitFrame(0)
+    return True
+
+  def sequenceFrames(self, echo1SequenceNode, echo2SequenceNode, tempMapSequenceNode):
+    """
+    (echo 1 node, echo 2 node, index value) of each frame of the echo sequences, or None
+    (with an error message) if they cannot be processed
+    """
+    if not echo1SequenceNode or not echo2SequenceNode or not tempMapSequenceNode:
+      slicer.util.errorDisplay('Select the echo sequences and the output sequence.')
+      return None
+    nFrames = echo1SequenceNode.GetNumberOfDataNodes()
+    if nFrames == 0 or echo2SequenceNode.GetNumberOfDataNodes() != nFrames:
+      slicer.util.errorDisplay('The echo sequences must have the same number of frames (%d and %d).'
+                               % (nFrames, echo2SequenceNode.GetNumberOfDataNodes()))
+      return None
+    return [(echo1SequenceNode.GetNthDataNode(index), echo2SequenceNode.GetNthDataNode(index),
+             echo1SequenceNode.GetNthIndexValue(index)) for index in range(nFrames)]
+
+  def computeSequenceFrame(self, arrayTE1, arrayTE2, arrayTemp, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, region, regionFillValue, temporalFilter, record, memoryBudget, threads, calibrationTable, dtype):
+    """
+    Temperature map of one frame of a sequence into arrayTemp; does not access the scene
+    """
+    (echo1, echo2, out) = (arrayTE1, arrayTE2, arrayTemp)
+    if region is not None:
+      (echo1, echo2, out) = (region.crop(arrayTE1), region.crop(arrayTE2), region.crop(arrayTemp))
+    CryoMonitoringLib.computeTempFromEchoesChunked(echo1, echo2, te1, te2, scaleFactor, noiseLevel, inputThreshold,
+                                                   minT2s, paramA, paramB,
+                                                   self.deferredThreshold(outputThreshold, False, temporalFilter),
+                                                   memoryBudget, out, record, threads, calibrationTable, dtype)
+    self.clampTempMap(arrayTemp, out, outputThreshold, region, regionFillValue, record, False, temporalFilter)
+
+  def startOutputSequence(self, echo1SequenceNode, tempMapSequenceNode, shape):
+    """
+    Clear the output sequence and create the frame node that is appended for every frame
+    (the sequence stores a copy of it, so one node is reused for all frames). Returns the
+    frame node and its voxel array.
+    """
+    tempMapSequenceNode.RemoveAllDataNodes()
+    tempMapSequenceNode.SetIndexName(echo1SequenceNode.GetIndexName())
+    tempMapSequenceNode.SetIndexUnit(echo1SequenceNode.GetIndexUnit())
+    tempMapSequenceNode.SetIndexType(echo1SequenceNode.GetIndexType())
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(shape[::-1])
+    imageData.AllocateScalars(vtk.VTK_FLOAT if self.precision == "Float32" else vtk.VTK_DOUBLE, 1)
+    frameNode = slicer.vtkMRMLScalarVolumeNode()
+    frameNode.SetAndObserveImageData(imageData)
+    return (frameNode, SlicerBridge.arrayFromVolume(frameNode))
+
+  def appendOutputFrame(self, tempMapSequenceNode, frameNode, referenceVolumeNode, indexValue, record):
+    """
+    Append the frame node (with the geometry of the reference volume) to the output sequence
+    """
+    record.startStage('push')
+    ijkToRAS = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+    frameNode.GetImageData().Modified()
+    frameNode.SetIJKToRASMatrix(ijkToRAS)
+    tempMapSequenceNode.SetDataNodeAtValue(frameNode, indexValue)
+
+  def finishSequence(self, record, nFrames):
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+      logging.info('Run record: %s' % record.toDict())
+
+    logging.info('Processing completed (%d frames)' % nFrames)
+
+  def computeTempMap(self, arrayR2Star, tempMapVolumeNode, referenceVolumeNode, paramA, paramB, outputThreshold, record, region=None, regionFillValue=0.0):
+    """
+    Convert the R2* map to temperature directly into the voxel buffer of the output node.
+    If a region is given, the R2* map covers its bounding box only (see computeR2Star()).
+    """
+    if not tempMapVolumeNode:
+      return
+    record.startStage('push')
+    shape = referenceVolumeNode.GetImageData().GetDimensions()[::-1]
+    arrayTemp = SlicerBridge.allocateVolumeArray(tempMapVolumeNode, shape, self.dtype, referenceVolumeNode)
+    keep = self.keepsUnthresholded()
+    unthresholded = self.unthresholdedBuffer(arrayTemp, region, keep, self.temporalFilter)
+    CryoMonitoringLib.computeTemp(arrayR2Star, paramA, paramB,
+                                  self.deferredThreshold(outputThreshold, keep, self.temporalFilter), unthresholded,
+                                  record, self.calibrationTable)
+    kept = self.clampTempMap(arrayTemp, unthresholded, outputThreshold, region, regionFillValue, record, keep,
+                             self.temporalFilter)
+    self.unthresholdedMap = (tempMapVolumeNode, kept)
+    record.startStage('push')
+    SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+
+  ## Display colors of the isotherm models, from the warmest to the coldest isotherm
+  ISOTHERM_COLORS = ((0.6, 0.8, 1.0), (0.2, 0.4, 1.0), (0.2, 0.0, 0.6))
+
+  def updateIsotherms(self, tempMapVolumeNode, record, labels=None):
+    """
+    Update the isotherm segmentation, models and volumes (see setIsotherms()) from the
+    temperature map; labels are the isotherm labels of the map, if already computed
+    """
+    if self.isothermTracker is None or not tempMapVolumeNode:
+      return
+    if labels is None:
+      record.startStage('isotherms')
+      labels = self.isothermTracker.labelsOf(SlicerBridge.arrayFromVolume(tempMapVolumeNode))
+    (slices, changed) = self.isothermTracker.update(labels, record)
+
+    record.startStage('push')
+    if self.isothermLabelVolumeNode and slices:
+      SlicerBridge.updateVolumeFromArray(self.isothermLabelVolumeNode, self.isothermTracker.labels,
+                                         tempMapVolumeNode, slices)
+    if self.isothermModels:
+      ## Only the blocks of the surfaces that read the changed box are contoured again
+      for (index, isotherm) in enumerate(self.isothermTracker.isotherms):
+        contourModel = self.isothermContourModels.get(isotherm)
+        if contourModel is None or slicer.mrmlScene.GetNodeByID(contourModel.modelNode.GetID()) is None:
+          modelNode = self.createIsothermModelNode(isotherm, self.ISOTHERM_COLORS[index % len(self.ISOTHERM_COLORS)])
+          contourModel = SlicerBridge.ContourModel(modelNode, index + 1)
+          self.isothermContourModels[isotherm] = contourModel
+          contourModel.update(self.isothermTracker.labels, tempMapVolumeNode)
+        elif index in changed:
+          contourModel.update(self.isothermTracker.labels, tempMapVolumeNode, slices)
+
+    ## Voxel volume in mL
+    spacing = tempMapVolumeNode.GetSpacing()
+    self.isothermVolumes = self.isothermTracker.volumes(spacing[0] * spacing[1] * spacing[2] / 1000.0)
+    logging.info('Isotherm volumes: %s' % ', '.join(['%g C: %.2f mL' % v for v in self.isothermVolumes]))
+
+  def createIsothermModelNode(self, isotherm, color):
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(slicer.mrmlScene.GenerateUniqueName('Isotherm %g C' % isotherm))
+    slicer.mrmlScene.AddNode(modelNode)
+    modelNode.CreateDefaultDisplayNodes()
+    modelNode.GetDisplayNode().SetColor(color)
+    modelNode.GetDisplayNode().SetOpacity(0.4)
+    return modelNode
+
+  def computeTempMapChunked(self, echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, record, region=None, regionFillValue=0.0):
+    """
+    Stream the echo images through slabs straight into the temperature map, within the
+    memory budget and on the thread pool; the full-size R2* map is never allocated
+    """
+    if not tempMapVolumeNode:
+      return
+    record.startStage('pull')
+    arrayTE1 = SlicerBridge.arrayFromVolume(echo1ImageVolumeNode)
+    arrayTE2 = SlicerBridge.arrayFromVolume(echo2ImageVolumeNode)
+    arrayTemp = SlicerBridge.allocateVolumeArray(tempMapVolumeNode, arrayTE1.shape, self.dtype, echo1ImageVolumeNode)
+    if region is not None:
+      arrayTE1 = region.crop(arrayTE1)
+      arrayTE2 = region.crop(arrayTE2)
+    keep = self.keepsUnthresholded()
+    unthresholded = self.unthresholdedBuffer(arrayTemp, region, keep, self.temporalFilter)
+    CryoMonitoringLib.computeTempFromEchoesChunked(arrayTE1, arrayTE2, te1, te2, scaleFactor, noiseLevel,
+                                                   inputThreshold, minT2s, paramA, paramB,
+                                                   self.deferredThreshold(outputThreshold, keep, self.temporalFilter),
+                                                   self.memoryBudget, unthresholded, record, self.threads,
+                                                   self.calibrationTable, self.dtype)
+    kept = self.clampTempMap(arrayTemp, unthresholded, outputThreshold, region, regionFillValue, record, keep,
+                             self.temporalFilter)
+    self.unthresholdedMap = (tempMapVolumeNode, kept)
+    record.startStage('push')
+    SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+
+  def computeTempMapCached(self, echo1ImageVolumeNode, echo2ImageVolumeNode, tempMapVolumeNode, te1, te2, scaleFactor, paramA, paramB, noiseLevel, outputThreshold, inputThreshold, minT2s, record, region=None, regionFillValue=0.0):
+    """
+    Compute the temperature map straight into the output node, with the intermediates
+    taken from the cache where the inputs and parameters are unchanged (see setCacheBudget())
+    """
+    if not tempMapVolumeNode:
+      return
+    record.startStage('pull')
+    arrayTE1 = SlicerBridge.arrayFromVolume(echo1ImageVolumeNode)
+    arrayTE2 = SlicerBridge.arrayFromVolume(echo2ImageVolumeNode)
+    arrayTemp = SlicerBridge.allocateVolumeArray(tempMapVolumeNode, arrayTE1.shape, self.dtype, echo1ImageVolumeNode)
+    if region is not None:
+      arrayTE1 = region.crop(arrayTE1)
+      arrayTE2 = region.crop(arrayTE2)
+    keep = self.keepsUnthresholded()
+    unthresholded = self.unthresholdedBuffer(arrayTemp, region, keep, self.temporalFilter)
+    CryoMonitoringLib.computeTempFromEchoesCached(self.intermediateCache, arrayTE1, arrayTE2, te1, te2, scaleFactor,
+                                                  noiseLevel, inputThreshold, minT2s, paramA, paramB,
+                                                  self.deferredThreshold(outputThreshold, keep, self.temporalFilter),
+                                                  unthresholded, record, self.threads, self.calibrationTable,
+                                                  self.dtype)
+    kept = self.clampTempMap(arrayTemp, unthresholded, outputThreshold, region, regionFillValue, record, keep,
+                             self.temporalFilter)
+    self.unthresholdedMap = (tempMapVolumeNode, kept)
+    record.startStage('push')
+    SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+
 
 class ComputeTempTest(ScriptedLoadableModuleTest):
   """
@@ -641,7 +1714,12 @@ class ComputeTempTest(ScriptedLoadableModuleTest):
     your test should break so they know that the feature is needed.
     """
 
-    pass
+    ## Logic-level tests of the computation library on synthetic phantoms
+    from CryoMonitoringLib import Testing
+    self.delayDisplay("Starting the test")
+    result = Testing.run()
+    self.assertTrue(result.wasSuccessful())
+    self.delayDisplay('Test passed!')
 
     #self.delayDisplay("Starting the test")
     ##
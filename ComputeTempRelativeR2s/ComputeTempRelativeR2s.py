@@ -1,10 +1,14 @@
 import os
 import unittest
-from __main__ import vtk, qt, ctk, slicer
+from __main__ import qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import SimpleITK as sitk
-import sitkUtils
+import numpy
+import multiprocessing
+import CryoMonitoringLib
+from CryoMonitoringLib import SlicerBridge
+from CryoMonitoringLib import LiveMonitor
+from CryoMonitoringLib import BackgroundRunner
 
 #
 # ComputeTempRelativeR2s
@@ -149,6 +153,15 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
     self.paramBSpinBox.setToolTip("TE for Input Volume 2")
     parametersFormLayout.addRow("Param B: ", self.paramBSpinBox)
 
+    #
+    # Nonlinear calibration curve
+    #
+    self.calibrationPathLineEdit = ctk.ctkPathLineEdit()
+    self.calibrationPathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.calibrationPathLineEdit.nameFilters = ["Calibration curve (*.csv *.json)"]
+    self.calibrationPathLineEdit.setToolTip("CSV file (R2* change, temperature) or JSON file (points or polynomial) of the curve from the R2* change to temperature. If set, the curve replaces the linear model (Param A/B).")
+    parametersFormLayout.addRow("Calibration Curve: ", self.calibrationPathLineEdit)
+
     #
     # Use input threshold
     #
@@ -202,6 +215,38 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
     self.lowerOutputThresholdSpinBox.setToolTip("Lower threshold for the output")
     parametersFormLayout.addRow("Lower OutputThreshold (deg): ", self.lowerOutputThresholdSpinBox)
 
+    #
+    # Fill value for the invalid pixels
+    #
+    self.fillValueSpinBox = qt.QDoubleSpinBox()
+    self.fillValueSpinBox.objectName = 'fillValueSpinBox'
+    self.fillValueSpinBox.setMaximum(1000.0)
+    self.fillValueSpinBox.setMinimum(-1000.0)
+    self.fillValueSpinBox.setDecimals(2)
+    self.fillValueSpinBox.setValue(-40.0)
+    self.fillValueSpinBox.setToolTip("Temperature for the pixels where the baseline or reference R2* is outside the input threshold range")
+    parametersFormLayout.addRow("Fill Value for Invalid Pixels (deg): ", self.fillValueSpinBox)
+
+    #
+    # Number of threads
+    #
+    self.threadsSpinBox = qt.QSpinBox()
+    self.threadsSpinBox.objectName = 'threadsSpinBox'
+    self.threadsSpinBox.setMaximum(256)
+    self.threadsSpinBox.setMinimum(1)
+    self.threadsSpinBox.setValue(multiprocessing.cpu_count())
+    self.threadsSpinBox.setToolTip("Number of threads. The volume is split into slabs that are processed in parallel.")
+    parametersFormLayout.addRow("Threads: ", self.threadsSpinBox)
+
+    #
+    # Precision
+    #
+    self.precisionComboBox = qt.QComboBox()
+    self.precisionComboBox.addItem("Float64")
+    self.precisionComboBox.addItem("Float32")
+    self.precisionComboBox.setToolTip("Pixel type of the computation and the output maps. Float32 halves the memory traffic; run 'python -m CryoMonitoringLib.Precision' for its deviation from Float64.")
+    parametersFormLayout.addRow("Precision: ", self.precisionComboBox)
+
     #
     # Apply Button
     #
@@ -210,12 +255,97 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # Cancel Button and status of the background computation
+    #
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Cancel the running computation."
+    self.cancelButton.enabled = False
+    parametersFormLayout.addRow(self.cancelButton)
+
+    self.statusLabel = qt.QLabel("Idle")
+    self.statusLabel.setToolTip("Stage of the computation running in the background")
+    parametersFormLayout.addRow("Status: ", self.statusLabel)
+
+    #
+    # Live Monitoring Area
+    #
+    monitoringCollapsibleButton = ctk.ctkCollapsibleButton()
+    monitoringCollapsibleButton.text = "Live Monitoring"
+    self.layout.addWidget(monitoringCollapsibleButton)
+    monitoringFormLayout = qt.QFormLayout(monitoringCollapsibleButton)
+
+    #
+    # Check box to start/stop live monitoring
+    #
+    self.liveMonitoringFlagCheckBox = qt.QCheckBox()
+    self.liveMonitoringFlagCheckBox.checked = 0
+    self.liveMonitoringFlagCheckBox.enabled = False
+    self.liveMonitoringFlagCheckBox.setToolTip("If checked, the temperature map is recomputed every time the reference R2* map is updated.")
+    monitoringFormLayout.addRow("Live Monitoring: ", self.liveMonitoringFlagCheckBox)
+
+    #
+    # Temporal filter of the temperature maps
+    #
+    self.temporalFilterComboBox = qt.QComboBox()
+    self.temporalFilterComboBox.addItem("Off")
+    self.temporalFilterComboBox.addItem("EMA")
+    self.temporalFilterComboBox.addItem("Kalman")
+    self.temporalFilterComboBox.setToolTip("Per-voxel temporal filter of the temperature maps during live monitoring: exponential moving average (EMA) or Kalman filter.")
+    monitoringFormLayout.addRow("Temporal Filter: ", self.temporalFilterComboBox)
+
+    self.temporalFilterAlphaSpinBox = qt.QDoubleSpinBox()
+    self.temporalFilterAlphaSpinBox.objectName = 'temporalFilterAlphaSpinBox'
+    self.temporalFilterAlphaSpinBox.setMaximum(1.0)
+    self.temporalFilterAlphaSpinBox.setMinimum(0.01)
+    self.temporalFilterAlphaSpinBox.setDecimals(2)
+    self.temporalFilterAlphaSpinBox.setValue(0.5)
+    self.temporalFilterAlphaSpinBox.setToolTip("Weight of the new frame in the exponential moving average")
+    monitoringFormLayout.addRow("EMA Weight: ", self.temporalFilterAlphaSpinBox)
+
+    self.processVarianceSpinBox = qt.QDoubleSpinBox()
+    self.processVarianceSpinBox.objectName = 'processVarianceSpinBox'
+    self.processVarianceSpinBox.setMaximum(10000.0)
+    self.processVarianceSpinBox.setMinimum(0.0)
+    self.processVarianceSpinBox.setDecimals(4)
+    self.processVarianceSpinBox.setValue(1.0)
+    self.processVarianceSpinBox.setToolTip("Expected variance of the temperature change between frames (Kalman filter)")
+    monitoringFormLayout.addRow("Process Variance (C^2): ", self.processVarianceSpinBox)
+
+    self.measurementVarianceSpinBox = qt.QDoubleSpinBox()
+    self.measurementVarianceSpinBox.objectName = 'measurementVarianceSpinBox'
+    self.measurementVarianceSpinBox.setMaximum(10000.0)
+    self.measurementVarianceSpinBox.setMinimum(0.0001)
+    self.measurementVarianceSpinBox.setDecimals(4)
+    self.measurementVarianceSpinBox.setValue(4.0)
+    self.measurementVarianceSpinBox.setToolTip("Variance of the noise of a single temperature map (Kalman filter)")
+    monitoringFormLayout.addRow("Measurement Variance (C^2): ", self.measurementVarianceSpinBox)
+
+    self.latencyLabel = qt.QLabel("-")
+    self.latencyLabel.setToolTip("End-to-end latency of the last frame (from the update of the reference R2* map to the update of the temperature map).")
+    monitoringFormLayout.addRow("Frame Latency (s): ", self.latencyLabel)
+
+    self.logic = ComputeTempRelativeR2sLogic()
+    self.logic.setKeepUnthresholded(True)
+    self.appliedClamp = None
+    self.runner = BackgroundRunner.BackgroundRunner(self.onProgress)
+    self.liveMonitor = None
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
     self.baselineR2StarSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.referenceR2StarSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.tempMapSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onUseOutputThreshold)
+    self.liveMonitoringFlagCheckBox.connect('toggled(bool)', self.onLiveMonitoring)
+
+    # The output thresholds and fill value are applied to the last temperature map as
+    # they are changed, without rerunning the computation
+    self.lowerOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.upperOutputThresholdSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
+    self.useOutputThresholdFlagCheckBox.connect('toggled(bool)', self.onOutputClampChanged)
+    self.fillValueSpinBox.connect('valueChanged(double)', self.onOutputClampChanged)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -224,10 +354,17 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.stopLiveMonitoring()
+    self.runner.cancel()
+    CryoMonitoringLib.closeThreadPools()
 
   def onSelect(self):
     self.applyButton.enabled = self.baselineR2StarSelector.currentNode() and self.baselineR2StarSelector.currentNode() and self.tempMapSelector.currentNode()
+    self.liveMonitoringFlagCheckBox.enabled = self.applyButton.enabled or self.liveMonitoringFlagCheckBox.checked
+
+    # Selecting another reference ends the monitoring session
+    if self.liveMonitor and self.liveMonitor.volumeNodes != [self.referenceR2StarSelector.currentNode()]:
+      self.liveMonitoringFlagCheckBox.checked = False
 
   def onUseOutputThreshold(self):
     if self.useOutputThresholdFlagCheckBox.checked == True:
@@ -237,31 +374,106 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
       self.lowerOutputThresholdSpinBox.enabled = False;      
       self.upperOutputThresholdSpinBox.enabled = False;      
 
+  def outputClamp(self):
+    """
+    Parameters of the final clamp stage: (output threshold, fill value)
+    """
+    outputThreshold = None
+    if self.useOutputThresholdFlagCheckBox.checked == True:
+      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+    return (outputThreshold, self.fillValueSpinBox.value)
+
+  def onOutputClampChanged(self):
+    """
+    Apply the output threshold and fill value to the last temperature map without
+    recomputing it; a running computation picks them up when it finishes
+    """
+    clamp = self.outputClamp()
+    if clamp == self.appliedClamp or self.runner.isRunning():
+      return
+    if self.logic.rethreshold(*clamp):
+      self.appliedClamp = clamp
+
   def onApplyButton(self):
-    logic = ComputeTempRelativeR2sLogic()
-    #enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
-    #imageOutputThreshold = self.imageOutputThresholdSliderWidget.value
+    self.runLogic(self.logic)
 
-    tempMapName = ''
+  def onCancelButton(self):
+    self.runner.cancel()
 
-    if self.tempMapSelector.currentNode():
-      tempMapName = self.tempMapSelector.currentNode().GetName()
+  def onProgress(self, status):
+    self.statusLabel.text = status
+    self.cancelButton.enabled = self.runner.isRunning()
+
+  def onLiveMonitoring(self, checked):
+    if checked:
+      self.startLiveMonitoring()
+    else:
+      self.stopLiveMonitoring()
+
+  def startLiveMonitoring(self):
+    self.logic.setTemporalFilter(self.createTemporalFilter())
+    self.liveMonitor = LiveMonitor.LiveMonitor([self.referenceR2StarSelector.currentNode()],
+                                               self.onLiveFrame, self.onLiveLatency, True)
+    self.liveMonitor.start()
+    self.latencyLabel.text = "-"
+
+  def stopLiveMonitoring(self):
+    if self.liveMonitor:
+      self.liveMonitor.stop()
+    self.liveMonitor = None
+    self.logic.setTemporalFilter(None)
+
+  def createTemporalFilter(self):
+    """
+    Temporal filter of the live temperature maps, or None if disabled
+    """
+    method = self.temporalFilterComboBox.currentText
+    if method == "Off":
+      return None
+    return CryoMonitoringLib.TemporalFilter(method, self.temporalFilterAlphaSpinBox.value,
+                                            self.processVarianceSpinBox.value,
+                                            self.measurementVarianceSpinBox.value)
+
+  def onLiveFrame(self, frameDone):
+    self.runLogic(self.logic, frameDone)
+
+  def onLiveLatency(self, latency):
+    self.latencyLabel.text = "%.3f" % latency
+
+  def runLogic(self, logic, onFinished=None):
+    """
+    Start the computation in the background; onFinished() is called once the
+    temperature map is updated
+    """
+    #enableScreenshotsFlag = self.enableScreenshotsFlagCheckBox.checked
+    #imageOutputThreshold = self.imageOutputThresholdSliderWidget.value
 
     inputThreshold = None
     if self.useInputThresholdFlagCheckBox.checked == True:
       inputThreshold = [0, self.upperInputThresholdSpinBox.value]
 
-    outputThreshold = None
-    if self.useOutputThresholdFlagCheckBox.checked == True:
-      outputThreshold = [self.lowerOutputThresholdSpinBox.value, self.upperOutputThresholdSpinBox.value]
+    (outputThreshold, fillValue) = self.outputClamp()
+
+    logic.setThreads(self.threadsSpinBox.value)
+    logic.setPrecision(self.precisionComboBox.currentText)
+    try:
+      logic.setCalibrationFile(self.calibrationPathLineEdit.currentPath)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      slicer.util.errorDisplay('Cannot load the calibration curve: %s' % str(e))
+      return
+    self.appliedClamp = (outputThreshold, fillValue)
+
+    def onTempMapUpdated():
+      self.onOutputClampChanged()
+      if onFinished:
+        onFinished()
 
-    logic.run(self.baselineR2StarSelector.currentNode(), self.referenceR2StarSelector.currentNode(),
-              self.tempMapSelector.currentNode(), self.paramASpinBox.value, self.paramBSpinBox.value,
-              outputThreshold, inputThreshold)
+    logic.runInBackground(self.runner, self.baselineR2StarSelector.currentNode(),
+                          self.referenceR2StarSelector.currentNode(), self.tempMapSelector.currentNode(),
+                          self.paramASpinBox.value, self.paramBSpinBox.value, outputThreshold, inputThreshold,
+                          onTempMapUpdated, fillValue)
+    self.cancelButton.enabled = self.runner.isRunning()
 
-    tempMapNode = slicer.util.getNode(tempMapName)
-    self.tempMapSelector.setCurrentNode(tempMapNode)
-      
 
   def onReload(self, moduleName="ComputeTempRelativeR2s"):
     # Generic reload method for any scripted module.
@@ -276,6 +488,21 @@ class ComputeTempRelativeR2sWidget(ScriptedLoadableModuleWidget):
 
 class ComputeTempRelativeR2sLogic(ScriptedLoadableModuleLogic):
 
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.preparedBaseline = None
+    self.preparedBaselineKey = None
+    self.instrumentation = False
+    self.lastRunRecord = None
+    self.threads = 1
+    self.temporalFilter = None
+    self.calibrationTable = None
+    self.calibrationTableKey = None
+    self.precision = "Float64"
+    self.dtype = numpy.float64
+    self.keepUnthresholded = False
+    self.unthresholdedMap = (None, None)
+
   def isValidInputOutputData(self, baselineR2StarVolumeNode, referenceR2StarVolumeNode):
     """Validates if the output is not the same as input
     """
@@ -287,9 +514,144 @@ class ComputeTempRelativeR2sLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def run(self, baselineR2StarVolumeNode, referenceR2StarVolumeNode, tempMapVolumeNode, paramA, paramB, outputThreshold, inputThreshold):
+  def setInstrumentation(self, enabled):
+    """
+    If enabled, the wall time and allocated memory of each stage of run() are
+    recorded in self.lastRunRecord (CryoMonitoringLib.RunRecord)
+    """
+    self.instrumentation = enabled
+
+  def setThreads(self, threads):
+    """
+    Process the volume in slabs on a pool of 'threads' threads. The results are
+    identical to the single-threaded computation.
+    """
+    self.threads = max(int(threads), 1)
+
+  def setPrecision(self, precision):
+    """
+    Compute and output the temperature map as "Float64" (default) or "Float32" (half
+    the memory traffic; see CryoMonitoringLib.Precision for the deviation from Float64)
+    """
+    self.dtype = CryoMonitoringLib.precisionType(precision)
+    self.precision = precision
+
+  def setCalibrationFile(self, path):
+    """
+    Use the nonlinear calibration curve of the file (see CryoMonitoringLib.loadCalibrationTable())
+    instead of the linear model; an empty path restores the linear model. The lookup
+    table is only rebuilt when the file changes.
+    """
+    if not path:
+      self.calibrationTable = None
+      self.calibrationTableKey = None
+      return
+    key = (path, os.path.getmtime(path))
+    if key != self.calibrationTableKey:
+      self.calibrationTable = CryoMonitoringLib.loadCalibrationTable(path)
+      self.calibrationTableKey = key
+
+  def setTemporalFilter(self, temporalFilter):
+    """
+    Filter the temperature maps of consecutive runs with a CryoMonitoringLib.TemporalFilter
+    (None: every map is independent). The maps are filtered before the final clamp stage,
+    only where both R2* maps are valid (see clampTempMap()), and the output node receives
+    the clamped filtered map.
+    """
+    self.temporalFilter = temporalFilter
+
+  def setKeepUnthresholded(self, enabled):
+    """
+    Keep the temperature map of the last run and its mask of valid pixels before the
+    final clamp stage, so that rethreshold() can apply a new output threshold and fill
+    value without recomputing the map. While a temporal filter is set, the filtered map
+    (the filter state) is kept instead.
+    """
+    self.keepUnthresholded = enabled
+    if not enabled:
+      self.unthresholdedMap = (None, None)
+
+  def keepsUnthresholded(self):
+    return self.keepUnthresholded
+
+  def rethreshold(self, outputThreshold, fillValue=-40.0):
+    """
+    Apply a new output threshold and fill value of the invalid pixels to the temperature
+    map of the last run, from the kept map (see setKeepUnthresholded()). Only the final
+    clamp stage is run (one vectorized pass). Returns False if no map is kept.
+    """
+    (tempMapVolumeNode, unthresholded) = self.unthresholdedMap
+    if unthresholded is None:
+      return False
+    arrayTemp = SlicerBridge.arrayFromVolume(tempMapVolumeNode)
+    if not unthresholded.matches(arrayTemp):
+      return False
+    record = CryoMonitoringLib.createRunRecord('ComputeTempRelativeR2s (rethreshold)', self.instrumentation)
+    record.startStage('thresholding')
+    unthresholded.apply(arrayTemp, outputThreshold, fillValue)
+    record.startStage('push')
+    SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+    return True
+
+  def computeTempMap(self, baseline, arrayReference, outputThreshold, fillValue, out, record, threads, keep, temporalFilter=None):
     """
-    Run the actual algorithm
+    Temperature map of the reference R2* map into out, filtered over time with the
+    temporalFilter if given; returns the CryoMonitoringLib.UnthresholdedMap if the map
+    is kept, otherwise None
+    """
+    if not keep and temporalFilter is None:
+      CryoMonitoringLib.computeTempFromBaselineChunked(baseline, arrayReference, outputThreshold, fillValue, None,
+                                                       out, record, threads)
+      return None
+    unthresholded = self.computeUnthresholdedMap(baseline, arrayReference, fillValue, out, record, threads,
+                                                 temporalFilter is None)
+    return self.clampTempMap(unthresholded, out, outputThreshold, fillValue, record, keep, temporalFilter)
+
+  def computeUnthresholdedMap(self, baseline, arrayReference, fillValue, out, record, threads, separate):
+    """
+    Temperature map before the final clamp stage and its mask of valid pixels, as a
+    CryoMonitoringLib.UnthresholdedMap; the map is computed into out unless separate
+    """
+    unthresholded = numpy.empty(out.shape, dtype=out.dtype) if separate else out
+    mask = numpy.empty(out.shape, dtype=numpy.bool_)
+    CryoMonitoringLib.computeTempFromBaselineChunked(baseline, arrayReference, None, fillValue, None, unthresholded,
+                                                     record, threads, mask)
+    return CryoMonitoringLib.UnthresholdedMap(unthresholded, mask)
+
+  def clampTempMap(self, unthresholded, out, outputThreshold, fillValue, record, keep, temporalFilter=None):
+    """
+    Final stages of the temperature map: the temporal filter, if given, on the valid
+    pixels of the map (the others hold their filtered state), then the clamp stage into
+    out. Returns the CryoMonitoringLib.UnthresholdedMap if the map is kept, otherwise None.
+    """
+    if temporalFilter is not None:
+      unthresholded = unthresholded.filter(temporalFilter, record)
+    record.startStage('thresholding')
+    unthresholded.apply(out, outputThreshold, fillValue)
+    return unthresholded if keep else None
+
+  def getPreparedBaseline(self, baselineR2StarVolumeNode, paramA, paramB, inputThreshold):
+    """
+    Return the prepared baseline (validity mask and scaled baseline term). It is
+    reused until the baseline node or the parameters it depends on change.
+    """
+    key = (baselineR2StarVolumeNode.GetID(), SlicerBridge.volumeModifiedTime(baselineR2StarVolumeNode))
+    if (self.preparedBaseline == None or self.preparedBaselineKey != key
+        or not self.preparedBaseline.matches(paramA, paramB, inputThreshold, self.calibrationTable, self.dtype)):
+      logging.info('Preparing baseline R2* map')
+      arrayBaseline = SlicerBridge.arrayFromVolume(baselineR2StarVolumeNode)
+      self.preparedBaseline = CryoMonitoringLib.PreparedBaseline(arrayBaseline, paramA, paramB, inputThreshold,
+                                                                 self.calibrationTable, self.dtype)
+      self.preparedBaselineKey = key
+    return self.preparedBaseline
+
+  def run(self, baselineR2StarVolumeNode, referenceR2StarVolumeNode, tempMapVolumeNode, paramA, paramB, outputThreshold, inputThreshold, fillValue=-40.0):
+    """
+    Run the actual algorithm. The pixels where either R2* map is invalid are set to
+    fillValue. The map is filtered over time if enabled (see setTemporalFilter()).
     """
 
     if not self.isValidInputOutputData(baselineR2StarVolumeNode, referenceR2StarVolumeNode):
@@ -297,35 +659,88 @@ class ComputeTempRelativeR2sLogic(ScriptedLoadableModuleLogic):
       return False
 
     logging.info('Processing started')
+    record = CryoMonitoringLib.createRunRecord('ComputeTempRelativeR2s', self.instrumentation)
 
-    imageBaseline  = sitk.Cast(sitkUtils.PullFromSlicer(baselineR2StarVolumeNode.GetID()), sitk.sitkFloat64)
-    imageReference = sitk.Cast(sitkUtils.PullFromSlicer(referenceR2StarVolumeNode.GetID()), sitk.sitkFloat64)
+    record.startStage('pull')
+    arrayReference = SlicerBridge.arrayFromVolume(referenceR2StarVolumeNode)
 
     if tempMapVolumeNode:
-      imageTemp = paramA * (imageReference - imageBaseline) + paramB
-
-      if inputThreshold != None:
-        mask1 = sitk.BinaryThreshold(imageBaseline, 0.0, inputThreshold[1] - 10e-10, 1, 0) 
-        mask2 = sitk.BinaryThreshold(imageReference, 0.0, inputThreshold[1] - 10e-10, 1, 0) 
-        mask = sitk.And(mask1, mask2)
-        imageTemp = sitk.Mask(imageTemp, mask)
-        imask = sitk.Not(mask)
-        imaskFloat = sitk.Cast(imask, sitk.sitkFloat64)
-        imaskFillTemp = imaskFloat * (-40.0)
-        imageTemp = imageTemp + imaskFillTemp ## TODO: The lower temperature limit
-
-      if outputThreshold != None:
-        lowerOutputThreshold = outputThreshold[0]
-        upperOutputThreshold = outputThreshold[1]
-        imageTempOutputThreshold = sitk.Threshold(imageTemp, lowerOutputThreshold, upperOutputThreshold, 0.0)
-        sitkUtils.PushToSlicer(imageTempOutputThreshold, tempMapVolumeNode.GetName(), 0, True)
-      else:
-        sitkUtils.PushToSlicer(imageTemp, tempMapVolumeNode.GetName(), 0, True)
+      record.startStage('baseline preparation')
+      baseline = self.getPreparedBaseline(baselineR2StarVolumeNode, paramA, paramB, inputThreshold)
+      record.startStage('push')
+      arrayTemp = SlicerBridge.allocateVolumeArray(tempMapVolumeNode, arrayReference.shape,
+                                                   self.dtype, referenceR2StarVolumeNode)
+      kept = self.computeTempMap(baseline, arrayReference, outputThreshold, fillValue, arrayTemp, record,
+                                 self.threads, self.keepsUnthresholded(), self.temporalFilter)
+      self.unthresholdedMap = (tempMapVolumeNode, kept)
+      record.startStage('push')
+      SlicerBridge.arrayFromVolumeModified(tempMapVolumeNode)
+
+    record.finish()
+    if self.instrumentation:
+      self.lastRunRecord = record
+      logging.info('Run record: %s' % record.toDict())
 
     logging.info('Processing completed')
 
     return True
 
+  def runInBackground(self, runner, baselineR2StarVolumeNode, referenceR2StarVolumeNode, tempMapVolumeNode, paramA, paramB, outputThreshold, inputThreshold, onFinished=None, fillValue=-40.0):
+    """
+    Same as run(), but the temperature map is computed in a worker thread of the runner
+    (CryoMonitoringLib.BackgroundRunner) and pushed to the scene on the main thread when
+    done; onFinished() is called after that. The reference R2* map is copied when the
+    task is submitted.
+    """
+    if not self.isValidInputOutputData(baselineR2StarVolumeNode, referenceR2StarVolumeNode):
+      slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
+      return False
+    if not tempMapVolumeNode:
+      return False
+
+    record = CryoMonitoringLib.createRunRecord('ComputeTempRelativeR2s', self.instrumentation)
+    record.startStage('pull')
+    baseline = self.getPreparedBaseline(baselineR2StarVolumeNode, paramA, paramB, inputThreshold)
+    arrayReference = SlicerBridge.arrayFromVolume(referenceR2StarVolumeNode).copy()
+    threads = self.threads
+    keep = self.keepsUnthresholded()
+    filtered = self.temporalFilter is not None
+
+    def compute(progress):
+      arrayTemp = numpy.empty(arrayReference.shape, dtype=baseline.offset.dtype)
+      if filtered:
+        ## Filtered and clamped in finish()
+        unthresholded = self.computeUnthresholdedMap(baseline, arrayReference, fillValue, arrayTemp, progress,
+                                                     threads, False)
+        return (arrayTemp, unthresholded, None)
+      kept = self.computeTempMap(baseline, arrayReference, outputThreshold, fillValue, arrayTemp, progress, threads,
+                                 keep)
+      return (arrayTemp, None, kept)
+
+    def finish(result):
+      (arrayTemp, unthresholded, kept) = result
+      if unthresholded is not None:
+        ## The filter state is only updated on the main thread, by the task that was not superseded.
+        ## The clamp stage was deferred, so it is run here even if the filter was removed.
+        kept = self.clampTempMap(unthresholded, arrayTemp, outputThreshold, fillValue, record, True,
+                                 self.temporalFilter)
+        if not keep or self.temporalFilter is None:
+          kept = None
+      self.unthresholdedMap = (tempMapVolumeNode, kept)
+      record.startStage('push')
+      SlicerBridge.updateVolumeFromArray(tempMapVolumeNode, arrayTemp, referenceR2StarVolumeNode)
+      record.finish()
+      if self.instrumentation:
+        self.lastRunRecord = record
+        logging.info('Run record: %s' % record.toDict())
+      logging.info('Processing completed')
+      if onFinished:
+        onFinished()
+
+    logging.info('Processing started')
+    runner.submit(compute, finish, record)
+    return True
+
 
 class ComputeTempRelativeR2sTest(ScriptedLoadableModuleTest):
   """
@@ -357,7 +772,12 @@ class ComputeTempRelativeR2sTest(ScriptedLoadableModuleTest):
     your test should break so they know that the feature is needed.
     """
 
-    pass
+    ## Logic-level tests of the computation library on synthetic phantoms
+    from CryoMonitoringLib import Testing
+    self.delayDisplay("Starting the test")
+    result = Testing.run()
+    self.assertTrue(result.wasSuccessful())
+    self.delayDisplay('Test passed!')
 
     #self.delayDisplay("Starting the test")
     ##